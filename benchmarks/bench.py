@@ -0,0 +1,241 @@
+"""
+End-to-end benchmarks against the offline NARR stand-in.
+
+    python benchmarks/bench.py                  # run and compare against baseline.json
+    python benchmarks/bench.py --save           # run and overwrite baseline.json
+    python benchmarks/bench.py --latency 0.05 --bandwidth 2e6
+
+Stages whose dependencies are missing (basemap for Draw, ImageMagick for ShapeSVG,
+the Maps key for Weatherer) are reported as skipped rather than failing the run.
+"""
+from __future__ import division
+
+import argparse
+import copy
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+
+from weatherer import Access
+from weatherer.Datasets import Dataset, Result
+from weatherer.Query import QueryParameters
+from weatherer.StandIn import NarrStandIn, SyntheticField, GRID_LAT, GRID_LON, \
+    MISSING_VALUE, monthly_times
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# size: (geo_range, months of monthly data, frames for in-memory stages)
+SIZES = {
+    'small': ([45., 49., -123., -118.], 12, 12),
+    'medium': ([35., 45., -117., -107.], 60, 48),
+    'large': ([24., 50., -125., -65.], 240, 120),
+}
+START = datetime.datetime(1980, 1, 1)
+
+
+def add_months(date, months):
+    return datetime.datetime(date.year + (date.month - 1 + months) // 12,
+                             (date.month - 1 + months) % 12 + 1, 1)
+
+
+def make_dataset(geo_range, frames, measure='tcdc'):
+    la = np.where((GRID_LAT >= geo_range[0]) & (GRID_LAT <= geo_range[1]))[0]
+    lo = np.where((GRID_LON >= geo_range[2]) & (GRID_LON <= geo_range[3]))[0]
+    times = monthly_times()[:frames]
+    field = SyntheticField(measure, times, GRID_LAT, GRID_LON)
+    vals = field[:, la[0]:la[-1] + 1, lo[0]:lo[-1] + 1].astype(float)
+    return Dataset([Result(geo_range, measure, t, 'monthly', '%', measure, MISSING_VALUE,
+                           vals[i], GRID_LAT[la], GRID_LON[lo])
+                    for i, t in enumerate(times)])
+
+
+def timed(fun, repeat, setup=None):
+    """
+    Best-of-repeat wall time of fun(), calling setup() untimed before each run.
+    """
+    best = np.inf
+    for __ in xrange(repeat):
+        if setup is not None:
+            setup()
+        t = time.time()
+        fun()
+        best = min(best, time.time() - t)
+    return best
+
+
+class Skip(Exception):
+    pass
+
+
+def bench_query(server, size, repeat):
+    # Cold: every repeat starts without the per-process DDS/DAS/coordinate cache
+    geo_range, months, __ = SIZES[size]
+    end = add_months(START, months - 1)
+    return timed(lambda: QueryParameters(time_start=START, time_end=end,
+                                         time_resolution='monthly', geo_range=geo_range,
+                                         server=server.url), repeat, Access.close_access)
+
+
+def bench_execute(server, size, repeat):
+    try:
+        from weatherer import Weatherer
+    except (ImportError, IOError) as e:
+        raise Skip(str(e))
+    geo_range, months, __ = SIZES[size]
+    qp = QueryParameters(time_start=START, time_end=add_months(START, months - 1),
+                         time_resolution='monthly', geo_range=geo_range,
+                         server=server.url)
+    return timed(lambda: Weatherer.execute_query(qp.queries), repeat, Access.close_access)
+
+
+def bench_transforms(server, size, repeat):
+    import scipy.ndimage  # Dataset imports it lazily; keep the import out of the timing
+    geo_range, __, frames = SIZES[size]
+    base = make_dataset(geo_range, frames)
+
+    def run():
+        ds = copy.deepcopy(base)
+        ds.fix_nans()
+        ds.zoom(4)
+        ds.interpolate(2)
+        ds.set_extrema()
+
+    return timed(run, repeat)
+
+
+def bench_render(server, size, repeat):
+    try:
+        from weatherer.Draw import Animator
+    except ImportError as e:
+        raise Skip(str(e))
+    geo_range, __, frames = SIZES[size]
+    ds = make_dataset(geo_range, frames)
+    out_dir = tempfile.mkdtemp()
+
+    def run():
+        a = Animator(ds, clear_frames=False, repeat=False, contour_levels=20)
+        a.stack('contour', stroke_width=0.25)
+        a.save_plt(os.path.join(out_dir, 'render.png'), width=11, height=14, dpi=150)
+        a.close()
+
+    try:
+        return timed(run, repeat)
+    finally:
+        shutil.rmtree(out_dir)
+
+
+def bench_render_pooled(server, size, repeat):
+    try:
+        from weatherer import Draw
+    except ImportError as e:
+        raise Skip(str(e))
+    geo_range, __, frames = SIZES[size]
+    ds = make_dataset(geo_range, frames)
+    out_dir = tempfile.mkdtemp()
+    renderer = Draw.Renderer()
+
+    def run():
+        a = renderer.animator(ds, clear_frames=False, repeat=False, contour_levels=20)
+        a.stack('contour', stroke_width=0.25)
+        a.save_plt(os.path.join(out_dir, 'render.png'), width=11, height=14, dpi=150)
+        a.close()
+
+    try:
+        return timed(run, repeat)
+    finally:
+        renderer.close()
+        shutil.rmtree(out_dir)
+
+
+def bench_canvas(server, size, repeat):
+    try:
+        import wand.image
+        from weatherer import ShapeSVG
+    except ImportError as e:
+        raise Skip(str(e))
+    px = {'small': 500, 'medium': 1500, 'large': 4000}[size]
+    out_dir = tempfile.mkdtemp() + os.sep
+    with wand.image.Image(width=px, height=px, background=wand.color.Color('#888888')) as i:
+        i.save(filename=out_dir + 'source.png')
+        i.save(filename=out_dir + 'mask.png')
+
+    try:
+        return timed(lambda: ShapeSVG.build_canvas(
+            width=11, height=14, dpi=100, mask_file='mask.png', source_file='source.png',
+            file_dir=out_dir, out_file='bench', detail_px=None), repeat)
+    finally:
+        shutil.rmtree(out_dir)
+
+
+STAGES = [('query', bench_query), ('execute_query', bench_execute),
+          ('transforms', bench_transforms), ('stack_save_plt', bench_render),
+          ('stack_save_plt_pooled', bench_render_pooled),
+          ('build_canvas', bench_canvas)]
+
+
+def run(sizes, repeat=3, latency=0., bandwidth=None):
+    results = {}
+    with NarrStandIn(latency=latency, bandwidth=bandwidth) as server:
+        for name, fun in STAGES:
+            for size in sizes:
+                key = name + '/' + size
+                try:
+                    results[key] = fun(server, size, repeat)
+                    print '%-28s %8.4f s' % (key, results[key])
+                except Skip as e:
+                    results[key] = None
+                    print '%-28s  skipped (%s)' % (key, str(e).splitlines()[0])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the keys that ran slower than tolerance times their baseline.
+    """
+    regressions = []
+    for key, t in sorted(results.items()):
+        base = baseline.get(key)
+        if t is None or base is None:
+            continue
+        ratio = t / base
+        flag = '  REGRESSION' if ratio > tolerance else ''
+        print '%-28s %6.2fx baseline%s' % (key, ratio, flag)
+        if flag:
+            regressions.append(key)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Weatherer benchmark suite')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium', 'large'],
+                        choices=sorted(SIZES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.,
+                        help='seconds added to every stand-in request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='stand-in bandwidth cap in bytes per second')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    parser.add_argument('--save', action='store_true',
+                        help='store these results as the new baseline')
+    args = parser.parse_args()
+
+    res = run(args.sizes, args.repeat, args.latency, args.bandwidth)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'created': datetime.datetime.now().isoformat(),
+                       'results': res}, f, indent=2, sort_keys=True)
+        print 'saved baseline to ' + args.baseline
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            if compare(res, json.load(f)['results'], args.tolerance):
+                sys.exit(1)
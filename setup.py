@@ -19,7 +19,8 @@ config = {
 	'keywords': '',
 	'install_requires': ['nose'],
 	'packages': ['weatherer'],
-	'scripts': []
+	'scripts': [],
+	'entry_points': {'console_scripts': ['weatherer = weatherer.Cli:main']}
 }
 	
 setup(**config)
@@ -1,11 +1,1066 @@
+import contextlib
+import copy
+import datetime
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+from nose.plugins.skip import SkipTest
 from nose.tools import *
-from .context imort weatherer
+
+from .context import weatherer
+from weatherer import Trace
+from weatherer.Datasets import Dataset, Result
+from weatherer.Query import QueryParameters, USA_BOX, WA_BOX
+from weatherer.StandIn import NarrStandIn, SyntheticField, GRID_LAT, GRID_LON, \
+    monthly_times
+
+SERVER = None
+
 
 def setup():
-	print "SETUP!"
+    global SERVER
+    SERVER = NarrStandIn().start()
+
 
 def teardown():
-	print "TEARDOWN!"
-	
-def test_basic():
-	print "I RAN!"
+    SERVER.stop()
+
+
+def import_weatherer():
+    """
+    Weatherer pulls in every optional dependency (Google Maps key, basemap, wand);
+    skip the tests that need it when the environment cannot provide them.
+    """
+    try:
+        from weatherer import Weatherer
+    except (ImportError, IOError) as e:
+        raise SkipTest('Weatherer unavailable: ' + str(e))
+    return Weatherer
+
+
+def make_results(frames=4, box=WA_BOX, measure='tcdc'):
+    la = np.where((GRID_LAT >= box[0]) & (GRID_LAT <= box[1]))[0]
+    lo = np.where((GRID_LON >= box[2]) & (GRID_LON <= box[3]))[0]
+    times = monthly_times()[:frames]
+    field = SyntheticField(measure, times, GRID_LAT, GRID_LON)
+    vals = field[:, la[0]:la[-1] + 1, lo[0]:lo[-1] + 1].astype(float)
+    return [Result(box, measure, t, 'monthly', '%', measure, 9.999e20,
+                   vals[i], GRID_LAT[la], GRID_LON[lo]) for i, t in enumerate(times)]
+
+
+def make_order(**fields):
+    """
+    An order's visualization parameters, as prepare_requests reads them from the CSV.
+    """
+    p = dict(address='Somewhere', state='WA', prefix='t', measure='tcdc', cmap='Greys',
+             cmap_name='grey', zoom=2, interpolate=2, stroke_width='1', width=36,
+             height=24, dpi=150, bleed=0.25, mat_width=1.0, pad_width=0.25,
+             colorspace='cmyk', mat_color='#ffffff', pad_color='#ffffff', flag='order')
+    p.update(fields)
+    return p
+
+
+@contextlib.contextmanager
+def order_workdir():
+    """
+    Run in a scratch working directory beside the ../outputs folders that Weatherer
+    pickles queries and datasets into.
+    """
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        for d in ('work', 'outputs/ds_queries', 'outputs/pickles'):
+            os.makedirs(os.path.join(tmp, d))
+        os.chdir(os.path.join(tmp, 'work'))
+        yield tmp
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+
+def test_monthly_query():
+    qp = QueryParameters(time_start=datetime.datetime(1980, 1, 1),
+                         time_end=datetime.datetime(1981, 1, 1),
+                         time_resolution='monthly', server=SERVER.url)
+    q = qp.queries.values()[0]
+    assert_equal(len(qp.queries), 1)
+    assert_equal(q['time_indices'], [12, 25, None])
+    lat = GRID_LAT[q['lat_indices'][0]:q['lat_indices'][1]]
+    lon = GRID_LON[q['lon_indices'][0]:q['lon_indices'][1]]
+    assert_true(lat[0] < WA_BOX[0] and lat[-1] > WA_BOX[1])
+    assert_true(lon[0] < WA_BOX[2] and lon[-1] > WA_BOX[3])
+
+
+def test_daily_query_urls():
+    qp = QueryParameters(time_start=datetime.datetime(1980, 1, 3),
+                         time_end=datetime.datetime(1980, 2, 5),
+                         time_resolution='hourly', server=SERVER.url)
+    urls = qp.queries.keys()
+    assert_equal(len(urls), 2)
+    assert_true(urls[0].endswith('NCEP_NARR_DAILY/198001/198001/'
+                                 'narr-a_221_198001dd_hh00_000'))
+    assert_equal(qp.queries[urls[0]]['time_indices'], [16, None, None])
+
+
+def test_execute_query():
+    Weatherer = import_weatherer()
+    qp = QueryParameters(time_start=datetime.datetime(1980, 1, 1),
+                         time_end=datetime.datetime(1980, 6, 1),
+                         time_resolution='monthly', server=SERVER.url)
+    results = Weatherer.execute_query(qp.queries)
+    assert_equal(len(results), 6)
+    assert_equal(results[0].obs_date, datetime.datetime(1980, 1, 1))
+    assert_equal(results[0].val.shape, (len(results[0].lat), len(results[0].lon)))
+
+
+def test_synthetic_field_slicing():
+    field = SyntheticField('tmp2m', monthly_times()[:3], GRID_LAT, GRID_LON)
+    block = field[0:3, 10:20, 30:45]
+    assert_equal(block.shape, (3, 10, 15))
+    assert_equal(field[1, 10:20, 30].shape, (10,))
+    assert_true(np.allclose(block[1, :, 0], field[1, 10:20, 30]))
+
+
+def test_dataset_transforms():
+    ds = Dataset(make_results(frames=4))
+    shape = ds.results[0].val.shape
+    ds.fix_nans()
+    ds.zoom(2)
+    assert_equal(ds.results[0].val.shape, (shape[0] * 2, shape[1] * 2))
+    ds.interpolate(3)
+    assert_equal(ds.length, 3 * 3 + 1)
+    assert_true(ds.globals['val_min'] < ds.globals['val_max'])
+
+
+def test_trace_stages():
+    tracer = Trace.enable()
+    try:
+        with Trace.stage('fetch'):
+            Trace.count(bytes=100, frames=2)
+            with Trace.stage('zoom', multiplier=2):
+                Trace.count(frames=1)
+            Trace.count(bytes=50)
+    finally:
+        assert_is(Trace.disable(), tracer)
+    summary = tracer.summary()
+    assert_equal(summary.keys(), ['fetch', 'zoom'])
+    assert_equal(summary['fetch']['counters'], {'bytes': 150, 'frames': 2})
+    assert_equal(summary['zoom']['counters'], {'frames': 1})
+    events = tracer.to_chrome()['traceEvents']
+    assert_equal([e['name'] for e in events], ['fetch', 'zoom'])
+    assert_equal(events[1]['args']['multiplier'], 2)
+
+
+def test_trace_disabled():
+    with Trace.stage('fetch') as s:
+        Trace.count(bytes=1)
+        s.count(frames=1)
+    assert_is(s, Trace.NULL_STAGE)
+
+
+def test_gmaps_cache():
+    from weatherer import Gmaps
+    tmp = tempfile.mkdtemp()
+    cache = Gmaps.GmapsCache(os.path.join(tmp, 'cache.sqlite'), ttl=60)
+    try:
+        key = Gmaps.normalize('geocode', {'address': 'Georgia,  United States'})
+        assert_equal(key, Gmaps.normalize('geocode', {'address': 'georgia, united states'}))
+        assert_is_none(cache.get(key))
+        cache.put(key, 'geocode', [{'geometry': {'location': {'lat': 1., 'lng': 2.}}}])
+        cache.memo.clear()
+        assert_equal(cache.get(key)[0]['geometry']['location']['lat'], 1.)
+        assert_equal((cache.hits, cache.misses), (1, 1))
+
+        cache.db.execute('UPDATE responses SET created = 0')
+        cache.memo.clear()
+        assert_is_none(cache.get(key))
+        assert_equal(cache.expire(), 1)
+    finally:
+        cache.close()
+        shutil.rmtree(tmp)
+
+
+def test_geocode_many():
+    from weatherer import Gmaps
+    tmp = tempfile.mkdtemp()
+    calls = []
+
+    def fake_api(gm_fun, query):
+        calls.append(query['address'])
+        return [{'address': query['address']}]
+
+    saved = Gmaps._cache, Gmaps.call_api
+    Gmaps._cache = Gmaps.GmapsCache(os.path.join(tmp, 'cache.sqlite'))
+    Gmaps.call_api = fake_api
+    try:
+        Gmaps.geocode_many(['Utah', 'Ohio'])
+        found = Gmaps.geocode_many(['utah', 'Ohio', 'Iowa'])
+        assert_equal(sorted(calls), ['Iowa', 'Ohio', 'Utah'])
+        assert_equal(found['utah'], [{'address': 'Utah'}])
+        assert_equal(Gmaps.gm_request('geocode', {'address': 'IOWA'}),
+                     [{'address': 'Iowa'}])
+        assert_equal(len(calls), 3)
+    finally:
+        Gmaps._cache.close()
+        Gmaps._cache, Gmaps.call_api = saved
+        shutil.rmtree(tmp)
+
+
+def write_polygons(shp_file, rings):
+    """
+    Write a bare-bones polygon shapefile (.shp only) with one single-ring record per
+    entry of rings, each a list of (lon, lat) vertices.
+    """
+    records = ''
+    for i, ring in enumerate(rings):
+        pts = np.array(ring + ring[:1], '<f8')
+        content = struct.pack('<i4d2ii', 5, pts[:, 0].min(), pts[:, 1].min(),
+                              pts[:, 0].max(), pts[:, 1].max(), 1, len(pts), 0)
+        content += pts.tobytes()
+        records += struct.pack('>2i', i + 1, len(content) // 2) + content
+    header = struct.pack('>7i', 9994, 0, 0, 0, 0, 0, (100 + len(records)) // 2)
+    header += struct.pack('<2i', 1000, 5) + '\0' * 64
+    with open(shp_file, 'wb') as f:
+        f.write(header + records)
+
+
+def copy_rows(resource, out_dir, keep):
+    """
+    Copy the rows of a bundled attribute CSV for which keep(line) is true.
+    """
+    with open(os.path.join(os.path.dirname(__file__), '..', 'weatherer', 'resources',
+                           resource)) as f:
+        lines = f.readlines()
+    with open(os.path.join(out_dir, resource), 'w') as f:
+        f.writelines([lines[0]] + [l for l in lines[1:] if keep(l)])
+
+
+def box(lon0, lat0, lon1, lat1):
+    return [(lon0, lat0), (lon0, lat1), (lon1, lat1), (lon1, lat0)]
+
+
+def test_gazetteer():
+    from weatherer import Gazetteer
+    tmp = tempfile.mkdtemp()
+    try:
+        # Alaska is split over two rows of the attribute table
+        states = ('Alaska', 'Georgia', 'Texas', 'Virginia', 'Washington')
+        copy_rows('USA_adm1.csv', tmp, lambda l: any('"%s"' % n in l for n in states))
+        write_polygons(os.path.join(tmp, 'USA_adm1.shp'),
+                       [box(-170., 55., -150., 65.), box(-150., 60., -140., 70.),
+                        box(-85., 30., -81., 35.), box(-106., 26., -94., 36.),
+                        box(-83., 36.5, -75., 39.5), box(-125., 45., -117., 49.)])
+        # Harris and Houston in Texas, and Bedford City and Bedford in Virginia, which
+        # share a HASC code
+        copy_rows('USA_adm2.csv', tmp,
+                  lambda l: l.split(',')[0] in ('2628', '2640', '2835', '2836'))
+        write_polygons(os.path.join(tmp, 'USA_adm2.shp'),
+                       [box(-95.9, 29.5, -94.9, 30.2), box(-95.7, 31., -95., 31.6),
+                        box(-79.55, 37.3, -79.5, 37.35), box(-79.9, 37., -79., 37.6)])
+
+        index = os.path.join(tmp, 'gazetteer.json')
+        Gazetteer.build(tmp, index)
+        gz = Gazetteer.Gazetteer.load(index)
+        assert_equal(gz.get_bounding_box('Georgia, United States of America'),
+                     [30., 35., -85., -81.])
+        assert_equal(gz.lookup('US.WA')['name'], 'Washington')
+        assert_equal(gz.lookup('Washingtin')['name'], 'Washington')
+        assert_equal(gz.lookup('GA')['name'], 'Georgia')
+        assert_true(np.allclose(gz.lookup('Georgia')['centroid'], [32.5, -83.]))
+        assert_is_none(gz.lookup('Paris, France'))
+
+        assert_equal(gz.get_bounding_box('Alaska'), [55., 70., -170., -140.])
+        assert_equal(gz.get_bounding_box('Harris County, Texas'),
+                     [29.5, 30.2, -95.9, -94.9])
+        assert_equal(gz.lookup('Houston County, TX')['name'], 'Houston')
+        # A city that shares a county's name is left to geocoding
+        for address in ('Houston, Texas', 'Houston, Texas, USA', 'Houston, TX'):
+            assert_is_none(gz.lookup(address))
+        assert_equal(gz.lookup('Bedford County, Virginia')['name'], 'Bedford')
+        assert_equal(gz.lookup('Bedford City, Virginia')['name'], 'Bedford City')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_dataset_sample():
+    ds = Dataset(make_results(frames=5))
+    cube = ds.cube()
+    lat, lon = ds.lat_array, ds.lon_array
+    values = ds.sample([lat[2], (lat[3] + lat[4]) / 2, 0.],
+                       [lon[5], lon[6], lon[0]])
+    assert_equal(values.shape, (3, 5))
+    assert_true(np.allclose(values[0], cube[:, 2, 5]))
+    assert_true(np.allclose(values[1], (cube[:, 3, 6] + cube[:, 4, 6]) / 2))
+    assert_true(np.isnan(values[2]).all())
+
+
+def test_route_densify():
+    from weatherer import Gmaps
+    step = lambda lat, lng, km: {'start_location': {'lat': lat, 'lng': lng},
+                                 'distance': {'value': km * 1000}}
+    route = [{'bounds': {'southwest': {'lat': 40., 'lng': -110.},
+                         'northeast': {'lat': 41., 'lng': -100.}},
+              'legs': [{'steps': [step(40., -110., 50), step(40., -109., 200),
+                                  step(41., -105., 10), step(41., -100., 0)]}]}]
+    saved = Gmaps.gm_request
+    Gmaps.gm_request = lambda gm_fun, query: route
+    try:
+        points, bounds = Gmaps.get_route('a', 'b')
+    finally:
+        Gmaps.gm_request = saved
+    assert_equal(points.shape, (1 + 4 + 1, 2))
+    assert_true(np.allclose(bounds, [35., 46., -115., -95.]))
+    assert_true(np.allclose(points[:, 1],
+                            np.floor(np.array([-110., -109., -107.6667, -106.3333, -105.,
+                                               -105.]) * 16 / 3) * 3 / 16))
+
+
+def test_point_query():
+    Weatherer = import_weatherer()
+    pts = [[40.1, -111.9], [47.6, -122.3], [40.1, -111.9]]
+    kw = dict(time_start=datetime.datetime(1980, 1, 1),
+              time_end=datetime.datetime(1980, 6, 1), time_resolution='monthly',
+              server=SERVER.url)
+    qp = QueryParameters(points=pts, **kw)
+    assert_true('_3pts' in qp.query_name)
+    order = dict(kw, measure=qp.measure, state=qp.state, geo_range=qp.geo_range,
+                 points=pts)
+    assert_equal(QueryParameters.generate_query_name(order), qp.query_name)
+    order['points'] = [[40.1, -111.9], [47.6, -122.4], [40.1, -111.9]]
+    assert_not_equal(QueryParameters.generate_query_name(order), qp.query_name)
+
+    # One request for the times plus one per cluster of touching stencils per month
+    blocks = sum(len(Weatherer.stencil_blocks(zip(q['points']['i'], q['points']['j'])))
+                 for q in qp.queries.values())
+    SERVER.reset()
+    tracer = Trace.enable()
+    try:
+        with Trace.stage('fetch'):
+            times, values = Weatherer.execute_point_query(qp.queries)
+    finally:
+        Trace.disable()
+    assert_equal(values.shape, (3, 6))
+    assert_equal(SERVER.requests, len(qp.queries) + blocks)
+    assert_true(tracer.summary()['fetch']['counters']['bytes'] > 0)
+
+    box = QueryParameters(geo_range=[39., 49., -124., -110.], **kw)
+    ds = Dataset(Weatherer.execute_query(box.queries))
+    expected = ds.sample(np.array(pts)[:, 0], np.array(pts)[:, 1])
+    assert_true(np.allclose(values, expected))
+
+    # Neighbouring points share one hyperslab, far apart ones do not
+    assert_equal(Weatherer.stencil_blocks([(5, 5), (6, 6), (20, 3)]),
+                 [([5, 8, 5, 8], [(5, 5), (6, 6)]), ([20, 22, 3, 5], [(20, 3)])])
+    assert_equal(len(Weatherer.stencil_blocks([(0, 0), (2, 0), (4, 0)])), 1)
+
+
+def test_cli_parser():
+    from weatherer import Cli
+    args = Cli.build_parser().parse_args(['--server', SERVER.url, 'fetch', 'orders.csv'])
+    assert_equal((args.func, args.orders, args.server), (Cli.fetch, 'orders.csv', SERVER.url))
+    args = Cli.build_parser().parse_args(['cache', '--expire'])
+    assert_true(args.expire)
+    args = Cli.build_parser().parse_args(['swatches', 'dir', '--processes', '2'])
+    assert_equal((args.func, args.directory, args.processes), (Cli.swatches, 'dir', 2))
+    args = Cli.build_parser().parse_args(['masks', 'dir'])
+    assert_equal((args.func, args.force), (Cli.masks, False))
+    assert_true(Cli.build_parser().parse_args(['masks', 'dir', '--force']).force)
+
+
+_asset = None
+
+
+def load_asset(value):
+    global _asset
+    _asset = (value, os.getpid())
+
+
+def copy_job(job):
+    src, out_file = job
+    with open(src) as f, open(out_file, 'w') as g:
+        g.write(f.read() + _asset[0])
+    return _asset[1]
+
+
+def test_workers():
+    from weatherer import Workers
+    tmp = tempfile.mkdtemp()
+    try:
+        jobs = []
+        for i in xrange(6):
+            src = os.path.join(tmp, 'in%d' % i)
+            with open(src, 'w') as f:
+                f.write(str(i))
+            jobs.append((src, os.path.join(tmp, 'out%d' % i)))
+
+        def skip(job):
+            return not Workers.is_stale(job[1], job[0])
+
+        pids, stats = Workers.run(copy_job, jobs, 3, load_asset, ('!',), skip=skip)
+        assert_equal((stats['jobs'], stats['skipped'], stats['processes']), (6, 0, 3))
+        assert_true(len(set(pids)) <= 3)
+        with open(jobs[4][1]) as f:
+            assert_equal(f.read(), '4!')
+
+        # Only outputs older than their inputs are redone
+        os.utime(jobs[2][1], (0, 0))
+        pids, stats = Workers.run(copy_job, jobs, 3, load_asset, ('?',), skip=skip)
+        assert_equal((stats['jobs'], stats['skipped']), (1, 5))
+        with open(jobs[2][1]) as f:
+            assert_equal(f.read(), '2?')
+    finally:
+        shutil.rmtree(tmp)
+
+
+class StubBasemap(object):
+    """
+    Stands in for basemap's Basemap: a plain (lon, lat) projection over the extent.
+    """
+
+    def __init__(self, llcrnrlat, urcrnrlat, llcrnrlon, urcrnrlon, ax=None, **kwargs):
+        self.extent = (llcrnrlat, urcrnrlat, llcrnrlon, urcrnrlon)
+        self.xmax, self.ymax = urcrnrlon - llcrnrlon, urcrnrlat - llcrnrlat
+
+    def __call__(self, lon, lat):
+        return lon - self.extent[2], lat - self.extent[0]
+
+
+def import_draw():
+    """
+    Draw with StubBasemap in place of basemap, on a non-interactive backend.
+    """
+    import sys
+    import types
+    from matplotlib import pyplot as plt
+    plt.switch_backend('Agg')
+    stub = types.ModuleType('mpl_toolkits.basemap')
+    stub.Basemap = StubBasemap
+    saved = sys.modules.get('mpl_toolkits.basemap')
+    sys.modules['mpl_toolkits.basemap'] = stub
+    sys.modules.pop('weatherer.Draw', None)
+    try:
+        from weatherer import Draw
+    finally:
+        sys.modules.pop('weatherer.Draw', None)
+        if saved is None:
+            del sys.modules['mpl_toolkits.basemap']
+        else:
+            sys.modules['mpl_toolkits.basemap'] = saved
+    return Draw
+
+
+def import_shapesvg():
+    """
+    ShapeSVG with empty stand-ins for the wand (ImageMagick) modules, for tests that
+    replace the functions calling into them.
+    """
+    import sys
+    import types
+    names = ('wand', 'wand.color', 'wand.display', 'wand.image')
+    saved = dict((n, sys.modules.get(n)) for n in names)
+    for n in names:
+        sys.modules[n] = types.ModuleType(n)
+    sys.modules.pop('weatherer.ShapeSVG', None)
+    try:
+        from weatherer import ShapeSVG
+    finally:
+        sys.modules.pop('weatherer.ShapeSVG', None)
+        for n, module in saved.items():
+            if module is None:
+                del sys.modules[n]
+            else:
+                sys.modules[n] = module
+    return ShapeSVG
+
+
+def test_renderer_pool():
+    from matplotlib import pyplot as plt
+    Draw = import_draw()
+    renderer = Draw.Renderer(map_pool=2)
+    try:
+        first = Dataset(make_results(frames=3))
+        a = renderer.animator(first, contour_levels=5)
+        figure, axis = a.figure, a.axis
+        a.stack('contour')
+        assert_true(len(axis.collections) > 0)
+        a.fit_figure(36, 24, 100)
+        a.close()
+        assert_equal(len(axis.collections), 0)
+
+        # The second order draws on the same, emptied figure at the default size
+        box = [42., 46.3, -124.6, -116.5]
+        second = Dataset(make_results(frames=2, box=box))
+        b = renderer.animator(second, contour_levels=5)
+        assert_true(b.figure is figure and b.axis is axis)
+        assert_equal(len(axis.collections), 0)
+        assert_true(np.allclose(figure.get_size_inches(), plt.rcParams['figure.figsize']))
+        b.stack('contour')
+        assert_equal(len(axis.collections), sum(len(v.collections) for v in b.views))
+        assert_true(np.allclose(axis.get_ylim(), (b.y.min(), b.y.max())))
+        b.close()
+
+        # Basemaps are pooled by extent, least recently used first out
+        m = renderer.basemap(Draw.map_extent(first))
+        assert_true(renderer.basemap(Draw.map_extent(first)) is m)
+        renderer.basemap((30., 35., -100., -95.))
+        assert_equal(len(renderer.maps), 2)
+        assert_true(Draw.map_extent(second) not in renderer.maps)
+        assert_true(renderer.basemap(Draw.map_extent(first)) is m)
+    finally:
+        renderer.close()
+    assert_false(plt.fignum_exists(figure.number))
+
+    shared = Draw.get_renderer()
+    assert_true(Draw.get_renderer() is shared)
+    Draw.close_renderer()
+    assert_false(plt.fignum_exists(shared.figure.number))
+    assert_true(Draw.get_renderer() is not shared)
+    Draw.close_renderer()
+
+
+def test_multi_query():
+    Weatherer = import_weatherer()
+    kw = dict(time_start=datetime.datetime(1980, 1, 3),
+              time_end=datetime.datetime(1980, 2, 10), time_resolution='hourly',
+              server=SERVER.url)
+    qp = QueryParameters(measure=['tcdc', 'tmp2m'], **kw)
+    assert_true('_tcdc+tmp2m_' in qp.query_name)
+
+    SERVER.reset()
+    tracer = Trace.enable()
+    try:
+        with Trace.stage('fetch'):
+            cube = Weatherer.execute_multi_query(qp.queries)
+    finally:
+        Trace.disable()
+    multi_requests = SERVER.requests
+    assert_equal(cube.measures, ['tcdc', 'tmp2m'])
+    # Frames are counted once per time slab, not once per measure
+    assert_equal(tracer.summary()['fetch']['counters']['frames'], len(cube.time))
+
+    SERVER.reset()
+    for m in cube.measures:
+        single = Weatherer.execute_query(QueryParameters(measure=m, **kw).queries)
+        assert_equal(len(single), len(cube.time))
+        assert_true(np.allclose(single[-1].val, cube.values[m][-1]))
+        assert_true(np.allclose(single[0].lat, cube.lat))
+    assert_true(multi_requests < SERVER.requests)
+
+    ds = cube.dataset('tmp2m')
+    assert_equal(ds.results[5].obs_date, single[5].obs_date)
+    assert_equal(ds.results[0].unit, 'K')
+
+
+def test_load_multi_query():
+    from weatherer import Climatology, Planner
+    Weatherer = import_weatherer()
+    try:
+        with order_workdir():
+            order = dict(measure=['tcdc', 'tmp2m'],
+                         time_start=datetime.datetime(1980, 1, 30),
+                         time_end=datetime.datetime(1980, 2, 2), time_resolution='hourly',
+                         geo_range=WA_BOX, state='WA', server=SERVER.url)
+            qp = Weatherer.load_query(order)
+            assert_true('_tcdc+tmp2m_' in qp.query_name)
+            assert_equal(qp.query_name, QueryParameters.generate_query_name(order))
+            assert_equal(os.listdir('../outputs/ds_queries'), [qp.query_name])
+
+            # Split into bands, every measure comes back stitched into one cube
+            direct = Weatherer.execute_multi_query(qp.queries)
+            plan = Planner.QueryPlan(qp, max_bytes=2 ** 14)
+            assert_true(any(len(b) > 1 for b in plan.blocks))
+            cube = Weatherer.execute_plan(plan)
+            assert_equal(cube.measures, ['tcdc', 'tmp2m'])
+            assert_true(np.array_equal(cube.time, direct.time))
+            assert_true(np.array_equal(cube.lat, direct.lat))
+            for m in cube.measures:
+                assert_true(np.array_equal(cube.values[m], direct.values[m]))
+
+            data = Weatherer.load_ds(qp)
+            assert_equal(data.measures, ['tcdc', 'tmp2m'])
+            assert_equal(Weatherer.first_measure(data).results[0].measurement, 'tcdc')
+    finally:
+        Climatology._stores.clear()
+
+
+def test_pooled_access():
+    from weatherer import Access
+    kw = dict(measure='tcdc', time_start=datetime.datetime(1980, 1, 3),
+              time_end=datetime.datetime(1980, 3, 10), time_resolution='hourly',
+              server=SERVER.url)
+    Weatherer = import_weatherer()
+    Access.close_access()
+    SERVER.reset()
+    qp = QueryParameters(**kw)
+    first = Weatherer.execute_query(qp.queries)
+    first_requests, first_connections = SERVER.requests, SERVER.connections
+    assert_true(0 < first_connections <= Access.DEFAULT_POOL_SIZE)
+
+    SERVER.reset()
+    QueryParameters(**kw)
+    second = Weatherer.execute_query(qp.queries)
+    assert_equal(SERVER.requests, len(qp.queries))
+    assert_equal(len(first), len(second))
+    assert_true(SERVER.requests < first_requests)
+    assert_equal(SERVER.connections, 0)
+    Access.close_access()
+
+
+def test_query_plan():
+    from weatherer import Planner
+    Weatherer = import_weatherer()
+    qp = QueryParameters(measure='tcdc', time_start=datetime.datetime(1980, 1, 30),
+                         time_end=datetime.datetime(1980, 2, 2), time_resolution='hourly',
+                         geo_range=USA_BOX, server=SERVER.url)
+    whole = Planner.QueryPlan(qp, max_bytes=2 ** 40)
+    assert_equal(whole.requests, len(qp.queries))
+
+    plan = Planner.QueryPlan(qp, max_bytes=2 ** 17)
+    assert_true(plan.requests > whole.requests)
+    assert_true(all(c['estimate']['bytes'] <= 2 ** 17 + Planner.RESPONSE_OVERHEAD
+                    for c in plan.chunks))
+    assert_equal(plan.frames, whole.frames)
+    assert_true(abs(plan.bytes - whole.bytes) <=
+                plan.requests * Planner.RESPONSE_OVERHEAD)
+    assert_true(any(len(b) > 1 for b in plan.blocks))
+
+    stitched = Weatherer.execute_plan(plan)
+    direct = Weatherer.execute_query(qp.queries)
+    assert_equal(len(stitched), len(direct))
+    assert_equal(len(stitched), plan.frames)
+    for a, b in [(stitched[0], direct[0]), (stitched[-1], direct[-1])]:
+        assert_equal(a.obs_date, b.obs_date)
+        assert_true(np.array_equal(a.lat, b.lat))
+        assert_true(np.array_equal(a.val, b.val))
+
+
+def test_shared_regions():
+    from weatherer import Climatology
+    Weatherer = import_weatherer()
+    try:
+        with order_workdir():
+            kw = dict(measure='tcdc', time_start=datetime.datetime(1980, 1, 1),
+                      time_end=datetime.datetime(1980, 6, 1), time_resolution='monthly',
+                      server=SERVER.url)
+            # Regions far apart gain nothing from a shared fetch
+            wa = [45.5, 49., -124.8, -116.9]
+            apart = [({'flag': 'order'}, dict(kw, state=st, geo_range=box))
+                     for st, box in [('WA', wa), ('FL', [24.4, 31.1, -87.7, -80.])]]
+            assert_equal(Weatherer.share_fetches(apart), 0)
+            assert_equal(Weatherer._shared_queries, {})
+
+            boxes = [('WA', wa), ('OR', [42., 46.3, -124.6, -116.5]),
+                     ('ID', [42., 49., -117.3, -111.])]
+            requests = [({'flag': 'order'}, dict(kw, state=st, geo_range=box))
+                        for st, box in boxes]
+            assert_equal(Weatherer.share_fetches(requests), 1)
+
+            SERVER.reset()
+            regions = [Weatherer.load_ds(Weatherer.load_query(q)) for v, q in requests]
+            shared_requests = SERVER.requests
+            assert_equal(len(Weatherer._shared_datasets), 1)
+            assert_equal(len(os.listdir('../outputs/pickles')), 1)
+            shared = Weatherer._shared_datasets.values()[0]
+
+            SERVER.reset()
+            for ds, (v, q) in zip(regions, requests):
+                direct = Weatherer.execute_query(Weatherer.load_query(q).queries)
+                assert_equal(ds.length, len(direct))
+                assert_true(np.array_equal(ds.lat_array, direct[0].lat))
+                assert_true(np.array_equal(ds.lon_array, direct[0].lon))
+                assert_true(np.array_equal(ds.results[-1].val, direct[-1].val))
+                assert_true(np.may_share_memory(ds.results[0].val, shared.results[0].val))
+            assert_true(shared_requests < SERVER.requests)
+    finally:
+        Weatherer._shared_queries.clear()
+        Weatherer._shared_datasets.clear()
+        Climatology._stores.clear()
+
+
+def test_climatology():
+    from weatherer import Climatology, Query
+    Weatherer = import_weatherer()
+    tmp = tempfile.mkdtemp()
+    try:
+        kw = dict(measure='tmp2m', time_resolution='monthly', server=SERVER.url)
+        qp = QueryParameters(time_start=datetime.datetime(1980, 1, 1),
+                             time_end=datetime.datetime(1982, 12, 1), **kw)
+        results = Weatherer.execute_query(qp.queries)
+        store = Climatology.get_store(qp, tmp)
+
+        # Merging two batches matches the statistics of all frames at once
+        added = store.update(results[:13]) + store.update(results[13:])
+        assert_equal(store.update(results[:5]), 0)
+        january = np.array([r.val for r in results if r.obs_date.month == 1])
+        count, mean, std = store.normals(1, results[0].lat, results[0].lon)
+        assert_equal(added, january.size * 12)
+        assert_true(np.all(count == 3))
+        assert_true(np.allclose(mean, january.mean(axis=0)))
+        assert_true(np.allclose(std, january.std(axis=0, ddof=1)))
+
+        # The index holds one run of months for the box, however many were fetched
+        assert_equal(len(store.coverage), 1)
+        assert_equal(len(store.coverage.values()[0]), 1)
+        assert_equal(Climatology.runs([1, 2, 3, 5, 7, 9]), [[1, 3, 1], [5, 9, 2]])
+        assert_equal(Climatology.add_runs([[1, 3, 1], [8, 8, 1]], [[4, 7, 1], [9, 13, 2]]),
+                     [[1, 8, 1], [9, 13, 2]])
+
+        # The store reopens from disk, and anomalies of a recorded month are centred
+        # Stand-in data is kept apart from any NOMADS climatology in the directory
+        assert_equal(os.path.dirname(store.path), os.path.join(
+            tmp, Query.server_name(SERVER.url)))
+        reopened = Climatology.ClimatologyStore('tmp2m', 'monthly', store.lat, store.lon,
+                                                os.path.dirname(store.path))
+        assert_true(np.allclose(reopened.mean, store.mean))
+        assert_equal(reopened.update(results[20:30]), 0)
+        ds = Dataset([r for r in results if r.obs_date.month == 1])
+        ds.anomaly(reopened, zscore=True)
+        assert_true(np.allclose(ds.cube().mean(axis=0), 0))
+        assert_equal(ds.results[0].unit, 'sd')
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_preview_plan():
+    Weatherer = import_weatherer()
+    order = dict(time_start=datetime.datetime(1980, 1, 1),
+                 time_end=datetime.datetime(1981, 1, 1), time_resolution='hourly')
+    step = Weatherer.preview_time_step(order)
+    assert_true(step >= 366 * 8 / float(Weatherer.PREVIEW_FRAMES) and step % 2 == 1)
+    # A monthly proof still stacks every calendar month (index 0 is January 1979)
+    monthly = dict(time_start=datetime.datetime(1979, 1, 1),
+                   time_end=datetime.datetime(2016, 12, 1), time_resolution='monthly')
+    start, end, every = QueryParameters(time_step=Weatherer.preview_time_step(monthly),
+                                        server=SERVER.url, **monthly).time_indices[0]
+    assert_equal(set(i % 12 for i in xrange(start, end, every)), set(range(12)))
+    qp = QueryParameters(time_step=step, server=SERVER.url, **order)
+    assert_true(('_every%d_' % step) in qp.query_name)
+    assert_equal(qp.query_name, QueryParameters.generate_query_name(
+        dict(order, measure='tcdc', state='NA', geo_range=WA_BOX, time_step=step,
+             server=SERVER.url)))
+    # Stand-in data never takes the name of the same order from NOMADS
+    assert_equal(qp.query_name.rsplit('_', 1)[0], QueryParameters.generate_query_name(
+        dict(order, measure='tcdc', state='NA', geo_range=WA_BOX, time_step=step)))
+    assert_true(all(ti[2] == step for ti in qp.time_indices))
+
+    p = dict(flag='proof', zoom=8, interpolate=10, dpi=600, width=36, height=24)
+    ds = Dataset(make_results(frames=24, box=USA_BOX))
+    plan = Weatherer.preview_plan(p, ds)
+    assert_true(Weatherer.is_preview(p))
+    assert_true(plan['decimate'] > 1)
+    assert_true(plan['dpi'] * 36 >= Weatherer.PREVIEW_SIZE and plan['dpi'] < 600)
+    assert_equal(plan['interpolate'], Weatherer.PREVIEW_FRAMES // 24)
+
+    cells = len(ds.lon_array)
+    ds.decimate(plan['decimate'])
+    assert_equal(len(ds.lon_array), -(-cells // plan['decimate']))
+    assert_equal(ds.results[0].val.shape, (len(ds.lat_array), len(ds.lon_array)))
+    assert_true(max(ds.results[0].val.shape) * plan['zoom'] <=
+                Weatherer.PREVIEW_SIZE // Weatherer.PREVIEW_CELL_PX)
+
+
+def test_preview_anomaly():
+    from weatherer import Climatology
+    Weatherer = import_weatherer()
+    tmp = tempfile.mkdtemp()
+    try:
+        qp = QueryParameters(measure='tmp2m', time_start=datetime.datetime(1980, 1, 1),
+                             time_end=datetime.datetime(1982, 12, 1),
+                             time_resolution='monthly', server=SERVER.url)
+        store = Climatology.get_store(qp, tmp)
+        store.update(Weatherer.execute_query(qp.queries))
+
+        results = Weatherer.execute_query(qp.queries)[:12]
+        full = Dataset(copy.deepcopy(results))
+        full.anomaly(store)
+        p = dict(flag='proof', zoom=1, interpolate=1, dpi=600, width=36, height=24)
+        plan = dict(Weatherer.preview_plan(p, Dataset(results)), decimate=3, zoom=1,
+                    interpolate=1)
+        ds = Weatherer.transform(Dataset(results), plan, store)
+        assert_equal(ds.length, 12)
+        assert_true(np.allclose(ds.results[5].val, full.results[5].val[::3, ::3],
+                                equal_nan=True))
+        assert_true(ds.results[0].long_name.endswith(' anomaly'))
+    finally:
+        Climatology._stores.clear()
+        shutil.rmtree(tmp)
+
+
+def test_preview_composite():
+    import sys
+    import types
+    Weatherer = import_weatherer()
+    tmp = tempfile.mkdtemp()
+    calls = []
+    stub = types.ModuleType('ShapeSVG')
+    stub.build_canvas = lambda **kw: calls.append(kw)
+    saved = Weatherer.SAVEDIR, sys.modules.get('weatherer.ShapeSVG')
+    p = make_order(dpi=600)
+    try:
+        Weatherer.SAVEDIR = tmp
+        sys.modules['weatherer.ShapeSVG'] = stub
+        Weatherer.composite(dict(p, flag='order'), 'landscape')
+        Weatherer.composite(dict(p, flag='proof'), 'landscape')
+        assert_equal(calls[0]['dpi'], 600)
+        assert_equal(calls[1]['dpi'], Weatherer.preview_dpi(dict(p, flag='proof')))
+        assert_true(calls[1]['dpi'] * 36 < 2 * Weatherer.PREVIEW_SIZE)
+        assert_equal(calls[1]['final_size'], Weatherer.PREVIEW_SIZE)
+    finally:
+        Weatherer.SAVEDIR = saved[0]
+        if saved[1] is None:
+            del sys.modules['weatherer.ShapeSVG']
+        else:
+            sys.modules['weatherer.ShapeSVG'] = saved[1]
+        shutil.rmtree(tmp)
+
+
+def test_artifact_cache():
+    from weatherer import Artifacts
+    Weatherer = import_weatherer()
+    tmp = tempfile.mkdtemp()
+    saved = (Weatherer.SAVEDIR, Weatherer.render, Weatherer.composite,
+             Weatherer.load_query, Artifacts._cache)
+    calls = []
+
+    def fake_render(p, query, raster=False):
+        calls.append('raster' if raster else 'render')
+        if raster:
+            np.savez_compressed(Weatherer.raster_file(p), dpi=72,
+                                scalar=np.full((2, 3), 200, np.uint8),
+                                coverage=np.full((2, 3), 128, np.uint8))
+        else:
+            for f in Weatherer.render_files(p):
+                with open(f, 'w') as out:
+                    out.write(p['cmap'])
+        if not os.path.exists(Weatherer.output_names(p)[0] + 'mask.png'):
+            with open(Weatherer.outline_file(p), 'w') as out:
+                out.write('outline')
+        return 'landscape'
+
+    def fake_composite(p, dims=None):
+        calls.append('composite')
+        assert_equal(dims, 'landscape')
+        assert_true(os.path.exists(Weatherer.data_file(p)))
+        for f in Weatherer.composite_outputs(p):
+            with open(f, 'w') as out:
+                out.write(p['mat_color'])
+
+    p = make_order()
+    qp = dict(time_start=datetime.datetime(1980, 1, 1),
+              time_end=datetime.datetime(1981, 1, 1), measure='tcdc',
+              time_resolution='monthly', geo_range=WA_BOX, state='WA')
+    try:
+        Weatherer.SAVEDIR = tmp
+        Weatherer.render, Weatherer.composite = fake_render, fake_composite
+        Weatherer.load_query = lambda query_params: None
+        Artifacts._cache = Artifacts.ArtifactCache(os.path.join(tmp, 'artifacts'))
+
+        keys = Weatherer.order_keys(p, qp)
+        rematted = Weatherer.order_keys(dict(p, mat_color='#000000'), qp)
+        recoloured = Weatherer.order_keys(dict(p, cmap='Blues'), qp)
+        assert_equal(keys['render'], rematted['render'])
+        assert_not_equal(keys['composite'], rematted['composite'])
+        assert_equal(keys['transform'], recoloured['transform'])
+        assert_not_equal(keys['render'], recoloured['render'])
+
+        Weatherer.composite_stage(p, qp, Weatherer.render_stage(p, qp))
+        assert_equal(calls, ['render', 'composite'])
+
+        # Re-matting composites against the cached render; repeating it does nothing
+        p['mat_color'] = '#000000'
+        for f in Weatherer.composite_outputs(p):
+            os.remove(f)
+        Weatherer.composite_stage(p, qp, Weatherer.render_stage(p, qp))
+        Weatherer.composite_stage(p, qp, Weatherer.render_stage(p, qp))
+        assert_equal(calls, ['render', 'composite', 'composite'])
+
+        # Fields that only rename the outputs hit the cache under the new names
+        for q in (dict(p, bleed=0.5), dict(p, mat_width=2.0), dict(p, address='Elsewhere'),
+                  dict(p, prefix='u')):
+            Weatherer.composite_stage(q, qp, Weatherer.render_stage(q, qp))
+            assert_true(os.path.exists(Weatherer.data_file(q)))
+        assert_equal(calls[:3], ['render', 'composite', 'composite'])
+        del calls[3:]
+
+        # A cache hit in a new directory still leaves the outline masks are cut from
+        ShapeSVG = import_shapesvg()
+        masked = []
+        ShapeSVG.make_mask = lambda mask_dir, mask_file: masked.append(mask_file)
+        ShapeSVG.make_masks(Weatherer.output_names(dict(p, address='Elsewhere'))[0],
+                            processes=1)
+        assert_equal(masked, [os.path.basename(Weatherer.outline_file(
+            dict(p, address='Elsewhere')))])
+
+        # A deleted output is restored from the cache
+        mockup = Weatherer.composite_outputs(p)[0]
+        os.remove(mockup)
+        Weatherer.composite_stage(p, qp)
+        with open(mockup) as f:
+            assert_equal(f.read(), '#000000')
+        assert_equal(len(calls), 3)
+
+        # Asking for a vector export renders again, and the export is cached with it
+        vector = dict(p, vector='svg')
+        assert_not_equal(Weatherer.order_keys(vector, qp)['render'], keys['render'])
+        Weatherer.render_stage(vector, qp)
+        os.remove(Weatherer.vector_file(vector))
+        Weatherer.render_stage(vector, qp)
+        assert_true(os.path.exists(Weatherer.vector_file(vector)))
+        assert_equal(calls[3:], ['render'])
+        del calls[3:]
+
+        # Colormap variants share one raster, drawn once and recolored
+        variants = [dict(p, cmap=c, cmap_name=c) for c in ('Blues', 'Reds', 'Greens')]
+        assert_equal(Weatherer.render_palettes(variants, qp, processes=1), 'landscape')
+        assert_equal(Weatherer.render_stage(dict(p, cmap='Oranges', cmap_name='o'), qp),
+                     'landscape')
+        assert_equal(calls[3:], ['raster'])
+        for v in variants:
+            assert_true(os.path.getsize(Weatherer.data_file(v)) > 0)
+
+        # A raster cached by one order is recolored under another's names
+        moved = dict(p, cmap='PuRd', cmap_name='pr', bleed=0.75)
+        Weatherer.render_palettes([moved], qp, processes=1)
+        assert_true(os.path.exists(Weatherer.raster_file(moved)))
+        assert_true(os.path.getsize(Weatherer.data_file(moved)) > 0)
+        assert_equal(calls[3:], ['raster'])
+    finally:
+        (Weatherer.SAVEDIR, Weatherer.render, Weatherer.composite,
+         Weatherer.load_query, Artifacts._cache) = saved
+        shutil.rmtree(tmp)
+
+
+def test_palette_recolor():
+    from matplotlib import cm, image
+    from weatherer import Palette
+    tmp = tempfile.mkdtemp()
+    try:
+        # Two lines at either end of the colormap, drawn at alpha 0.5 over white
+        scalar = np.zeros((4, 6), np.uint8)
+        coverage = np.zeros((4, 6), np.uint8)
+        scalar[1, :3], scalar[2, 3:] = Palette.encode(0.), Palette.encode(1.)
+        coverage[1, :3] = coverage[2, 3:] = 128
+        scalar[1, 3] = 0  # an antialiased fringe pixel missed by the scalar pass
+        coverage[1, 3] = 64
+        raster = os.path.join(tmp, 'raster.npz')
+        np.savez_compressed(raster, scalar=scalar, coverage=coverage, dpi=72)
+
+        variants = [(c, os.path.join(tmp, c + '.png')) for c in ('viridis', 'Greys')]
+        assert_equal(Palette.recolor_many(raster, variants, processes=2),
+                     [v[1] for v in variants])
+        for cmap, out_file in variants:
+            rgb = image.imread(out_file)[..., :3] * 255
+            for pos, t in [((1, 0), 0.), ((2, 5), 1.)]:
+                expected = np.array(cm.get_cmap(cmap)(t)[:3]) * 255 * 0.5 + 127.5
+                assert_true(np.allclose(rgb[pos], expected, atol=1.5))
+            assert_true(np.allclose(rgb[0, 0], 255))
+            assert_true(np.all(rgb[1, 3] < 255))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_transform_chunked():
+    from weatherer import Datasets
+    tmp = tempfile.mkdtemp()
+    try:
+        def with_gap():
+            results = make_results(frames=9)
+            results[3].val[2, 5] = 9.999e20
+            return Dataset(results)
+
+        expected = with_gap()
+        expected.fix_nans()
+        expected.zoom(2)
+        expected.interpolate(3)
+        expected.globals.update(val_min=np.inf, val_max=-np.inf)
+        expected.set_extrema()
+
+        for processes in (1, 2):
+            ds = with_gap().transform_chunked(
+                os.path.join(tmp, 'cube%d.npy' % processes), zoom=2, interpolate=3,
+                block=4, processes=processes)
+            assert_equal(ds.length, expected.length)
+            assert_true(isinstance(ds.results[0].val, np.memmap))
+            for r, e in zip(ds.results, expected.results):
+                assert_true(np.allclose(r.val, e.val, equal_nan=True))
+                assert_true(abs((r.obs_date - e.obs_date).total_seconds()) < 1)
+            assert_true(np.allclose(ds.lat_array, expected.lat_array))
+            assert_equal((ds.globals['val_min'], ds.globals['val_max']),
+                         (expected.globals['val_min'], expected.globals['val_max']))
+        del ds
+
+        # A failing block leaves no scratch files behind
+        def fail(job):
+            raise ValueError('block failed')
+        transform_block = Datasets.transform_block
+        Datasets.transform_block = fail
+        try:
+            assert_raises(ValueError, with_gap().transform_chunked,
+                          os.path.join(tmp, 'failed.npy'), zoom=2, processes=1)
+        finally:
+            Datasets.transform_block = transform_block
+        assert_false(any(f.startswith('failed') for f in os.listdir(tmp)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_vector_export():
+    from weatherer import Vector
+    tmp = tempfile.mkdtemp()
+    try:
+        # Fifty frames of the same two rings, jittered well below a print pixel
+        rng = np.random.RandomState(0)
+        theta = np.linspace(0, 2 * np.pi, 400)
+        layers = []
+        for frame in xrange(50):
+            for radius, color in [(100., (0., 0., 1., .5)), (200., (1., 0., 0., .5))]:
+                ring = np.column_stack([300 + radius * np.cos(theta),
+                                        300 + radius * np.sin(theta)])
+                layers.append((color, [ring + rng.uniform(-1e-3, 1e-3, ring.shape)]))
+
+        svg = os.path.join(tmp, 'stack.svg')
+        stats = Vector.export(svg, layers, 600, 600, dpi=300)
+        assert_equal(stats['vertices_in'], 50 * 2 * 400)
+        assert_true(stats['vertices_out'] < 400)
+        with open(svg) as f:
+            text = f.read()
+        assert_equal(text.count('<path'), 2)
+        assert_equal(stats['bytes'], len(text))
+
+        pdf = Vector.export(os.path.join(tmp, 'stack.pdf'), layers, 600, 600, dpi=300)
+        assert_equal(pdf['vertices_out'], stats['vertices_out'])
+
+        # Stretches already drawn are dropped; straight runs reduce to their ends
+        line = np.column_stack([np.arange(0., 50.), np.zeros(50) + 5])
+        merged, s = Vector.merge_layers([('k', [line[:30], line[10:]])], 0.5, 60, 10, 1.)
+        assert_equal(s['vertices_out'], 2)
+        path = merged['k'][0][0]
+        assert_true(np.abs(path[:, 1] - 10).max() <= 1)
+        assert_true(path[0, 0] <= 0 and path[-1, 0] >= 98)
+
+        # Output never exceeds the input, and stops growing once the frames cover
+        # the page: drifting rings, then the same rings drawn with only 12 vertices
+        def rings(frames, points=100):
+            theta = np.linspace(0, 2 * np.pi, points)
+            out = []
+            for f in xrange(frames):
+                for k, r in enumerate((20., 40.)):
+                    c = 100 + 20 * np.array([np.sin(f * .37 + k), np.cos(f * .23 + k)])
+                    rr = r * (1 + .1 * np.sin(3 * theta + f * .5))
+                    out.append((k, [np.column_stack([c[0] + rr * np.cos(theta),
+                                                     c[1] + rr * np.sin(theta)])]))
+            return out
+
+        sizes = []
+        for frames in (48, 192, 768):
+            merged, s = Vector.merge_layers(rings(frames), 0.25, 200, 200, 1.)
+            assert_true(s['vertices_out'] <= s['vertices_in'])
+            sizes.append(s['vertices_out'])
+        assert_true(sizes[2] <= sizes[1] <= 2 * sizes[0])
+        merged, s = Vector.merge_layers(rings(12, 12), 0.25, 200, 200, 1.)
+        assert_true(s['vertices_out'] <= s['vertices_in'])
+    finally:
+        shutil.rmtree(tmp)
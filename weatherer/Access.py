@@ -0,0 +1,115 @@
+import copy
+import threading
+from io import BytesIO
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from pydap.handlers.dap import StreamReader, unpack_data
+from pydap.parsers.das import add_attributes, parse_das
+from pydap.parsers.dds import build_dataset
+
+DEFAULT_POOL_SIZE = 16
+DEFAULT_TIMEOUT = 120
+DEFAULT_RETRIES = 2
+
+_access = None
+
+
+class DataAccess(object):
+    """
+    The single path to the OPeNDAP server: one keep-alive HTTP connection pool shared
+    by every month and query, plus caches of each URL's DDS/DAS metadata and
+    coordinate axes.  Close it (or use it as a context manager) to release the
+    sockets deterministically.
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.metadata = {}
+        self.coords = {}
+        self.requests = 0
+        self.bytes = 0
+
+    def get(self, url):
+        r = self.session.get(url, timeout=self.timeout)
+        r.raise_for_status()
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(r.content)
+        return r.content
+
+    def describe(self, url):
+        """
+        The (DDS text, parsed DAS) pair for url, downloaded once per process.
+        """
+        if url not in self.metadata:
+            dds = self.get(url + '.dds').decode('ascii')
+            das = parse_das(self.get(url + '.das').decode('ascii'))
+            with self.lock:
+                self.metadata[url] = (dds, das)
+        return self.metadata[url]
+
+    def open(self, url):
+        """
+        A data-less pydap DatasetType describing url, with attributes.
+        """
+        dds, das = self.describe(url)
+        return add_attributes(build_dataset(dds), copy.deepcopy(das))
+
+    def fetch(self, url, ce):
+        """
+        Download the variables selected by constraint expression ce in one request,
+        returning a DatasetType whose variables hold numpy data and attributes.
+        """
+        __, das = self.describe(url)
+        body = self.get(url + '.dods?' + ce)
+        dds, data = body.split(b'\nData:\n', 1)
+        dataset = build_dataset(dds.decode('ascii'))
+        dataset.data = unpack_data(StreamReader(BytesIO(data)), dataset)
+        return add_attributes(dataset, copy.deepcopy(das))
+
+    def coordinates(self, url):
+        """
+        The full (lat, lon) axes of url, downloaded once per process.
+        """
+        if url not in self.coords:
+            d = self.fetch(url, 'lat,lon')
+            with self.lock:
+                self.coords[url] = (np.array(d['lat'].data), np.array(d['lon'].data))
+        return self.coords[url]
+
+    def close(self):
+        self.session.close()
+        self.metadata.clear()
+        self.coords.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def get_access():
+    """
+    The shared DataAccess, created on first use.
+    """
+    global _access
+    if _access is None:
+        _access = DataAccess()
+    return _access
+
+
+def close_access():
+    global _access
+    if _access is not None:
+        _access.close()
+        _access = None
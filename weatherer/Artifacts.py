@@ -0,0 +1,127 @@
+import hashlib
+import json
+import os
+import shutil
+
+SAVEDIR = os.path.join('outputs', '_orders', 'artifacts')
+MANIFEST = 'manifest.json'
+
+# Order parameters that each stage's output depends on, beyond its input stage
+TRANSFORM_PARAMS = ('zoom', 'interpolate', 'anomaly')
+RASTER_PARAMS = ('stroke_width', 'width', 'height', 'dpi', 'state')
+RENDER_PARAMS = ('cmap', 'vector')
+COMPOSITE_PARAMS = ('width', 'height', 'dpi', 'bleed', 'mat_width', 'pad_width',
+                    'colorspace', 'mat_color', 'pad_color')
+
+_cache = None
+
+
+def digest(stage, params, parent=None):
+    """
+    Content key for a stage: a hash of its parameters chained onto its input's key.
+    """
+    text = json.dumps([stage, parent, params], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:20]
+
+
+def file_stamp(filename):
+    """
+    Cheap stand-in for a file's content hash (size and modification time), or None.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return [st.st_size, int(st.st_mtime)]
+
+
+def stage_keys(p, query_name, preview=False, mask=None):
+    """
+    Keys of the dataset, transform, raster, render, outline and composite artifacts
+    of an order.  Changing a parameter only invalidates the stage that reads it and those
+    after; in particular orders differing only in colormap share one raster.
+    """
+    def pick(names):
+        return dict((k, p.get(k)) for k in names)
+
+    keys = {'dataset': digest('dataset', query_name)}
+    keys['transform'] = digest('transform', dict(pick(TRANSFORM_PARAMS), preview=preview),
+                               keys['dataset'])
+    keys['raster'] = digest('raster', dict(pick(RASTER_PARAMS), preview=preview),
+                            keys['transform'])
+    keys['render'] = digest('render', pick(RENDER_PARAMS), keys['raster'])
+    # The region outline is drawn alongside and does not depend on the colormap
+    keys['outline'] = digest('outline', {}, keys['raster'])
+    keys['composite'] = digest('composite', dict(pick(COMPOSITE_PARAMS), preview=preview,
+                                                 mask=file_stamp(mask) if mask else None),
+                               keys['render'])
+    return keys
+
+
+class ArtifactCache(object):
+    """
+    Stage outputs stored by key, one directory per artifact holding the files and a
+    manifest of their original names plus any metadata (e.g. image orientation).
+    Files are copied rather than linked, since the renderers overwrite their outputs
+    in place.
+    """
+
+    def __init__(self, directory=SAVEDIR):
+        self.directory = directory
+
+    def manifest_file(self, key):
+        return os.path.join(self.directory, key, MANIFEST)
+
+    def get(self, key):
+        """
+        The manifest of an artifact, or None if it is missing or incomplete.
+        """
+        try:
+            with open(self.manifest_file(key)) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return None
+        for name in manifest['files']:
+            if not os.path.exists(os.path.join(self.directory, key, name)):
+                return None
+        return manifest
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def put(self, key, files, **meta):
+        """
+        Store files (paths) under key; the manifest is written last, so an
+        interrupted put is never mistaken for a complete artifact.
+        """
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        names = []
+        for f in files:
+            names.append(os.path.basename(f))
+            shutil.copyfile(f, os.path.join(path, names[-1]))
+        manifest = dict(meta, files=names, sources=list(files))
+        with open(self.manifest_file(key), 'w') as f:
+            json.dump(manifest, f, indent=1)
+        return manifest
+
+    def restore(self, key, destinations=None):
+        """
+        Copy an artifact's files to destinations (paths, in the order they were put),
+        or back where they were produced, returning its manifest.  Orders sharing an
+        artifact name their outputs differently, so callers pass their own paths.
+        """
+        manifest = self.get(key)
+        for name, dst in zip(manifest['files'], destinations or manifest['sources']):
+            if not os.path.exists(os.path.dirname(dst) or '.'):
+                os.makedirs(os.path.dirname(dst))
+            shutil.copyfile(os.path.join(self.directory, key, name), dst)
+        return manifest
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ArtifactCache()
+    return _cache
@@ -0,0 +1,159 @@
+"""
+Command-line entry point.  Run from the weatherer directory, e.g.
+
+    python Cli.py fetch ../inputs/20170131_order.csv
+    python Cli.py --trace run.trace.json batch ../inputs/20170131_order.csv
+    python Cli.py plan ../inputs/20170131_order.csv
+    python Cli.py cache --expire
+    python Cli.py climatology tmp2m 1979 2016
+    python Cli.py masks ../outputs/visualizations
+
+Only argparse is imported up front; each subcommand imports what its stages need.
+"""
+import argparse
+import os
+import sys
+
+
+def run_stages(args, stages):
+    import Weatherer
+    budget = args.budget * 2 ** 20 if args.budget is not None else None
+    Weatherer.batch(args.orders, server=args.server, stages=stages, budget=budget,
+                    shared=args.shared)
+
+
+def fetch(args):
+    run_stages(args, ('fetch',))
+
+
+def render(args):
+    run_stages(args, ('render',))
+
+
+def composite(args):
+    run_stages(args, ('composite',))
+
+
+def batch(args):
+    run_stages(args, ('render', 'composite'))
+
+
+def plan(args):
+    import Weatherer
+    plans = Weatherer.plan_orders(args.orders, server=args.server,
+                                  max_bytes=args.chunk_mb * 2 ** 20)
+    for p in plans:
+        print p.report()
+    print '%d orders to fetch: %d requests, %.1f MB, about %.0f s' % (
+        len(plans), sum(p.requests for p in plans),
+        sum(p.bytes for p in plans) / 2. ** 20, sum(p.seconds for p in plans))
+
+
+def dir_usage(path):
+    files = [os.path.join(path, f) for f in os.listdir(path)] if os.path.isdir(path) else []
+    files = [f for f in files if os.path.isfile(f) and not f.endswith('.gitignore')]
+    return len(files), sum(os.path.getsize(f) for f in files)
+
+
+def cache(args):
+    import Gmaps
+    c = Gmaps.get_cache()
+    if args.expire:
+        print 'expired %d geocoding entries' % c.expire()
+    stats = c.stats()
+    print '%-24s %6d entries  %s' % ('geocoding', stats['rows'], stats['file'])
+    for name, path in [('queries', os.path.join('..', 'outputs', 'ds_queries')),
+                       ('datasets', os.path.join('..', 'outputs', 'pickles')),
+                       ('climatology', os.path.join('..', 'outputs', 'climatology'))]:
+        n, size = dir_usage(path)
+        print '%-24s %6d files  %8.1f MB  %s' % (name, n, size / 2. ** 20, path)
+
+
+def climatology(args):
+    import Climatology
+    added = Climatology.backfill(args.measure, args.start, args.end,
+                                 time_resolution=args.resolution, server=args.server)
+    print 'added %d cell-observations to the %s climatology' % (added, args.measure)
+
+
+def masks(args):
+    import ShapeSVG
+    ShapeSVG.make_masks(args.directory, processes=args.processes, force=args.force)
+
+
+def swatches(args):
+    import ShapeSVG
+    ShapeSVG.crop(args.directory, out_dir=args.out_dir or ShapeSVG.dest,
+                  processes=args.processes)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='weatherer',
+        description='Accesses, downloads, and creatively visualizes weather pattern data '
+                    'from NOAA.')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='record per-stage timings; FILE ending in .trace.json is '
+                             'written as Chrome trace events')
+    parser.add_argument('--server', help='NARR OPeNDAP root (default: NOMADS)')
+    sub = parser.add_subparsers()
+
+    for name, fun, text in [('fetch', fetch, 'download or unpickle each order\'s dataset'),
+                            ('render', render, 'fetch, transform and draw data images'),
+                            ('composite', composite, 'mask and mat existing renders'),
+                            ('batch', batch, 'render and composite every order')]:
+        p = sub.add_parser(name, help=text)
+        p.add_argument('orders', help='order CSV')
+        p.add_argument('--budget', type=float, metavar='MB',
+                       help='refuse orders estimated to download more than this')
+        p.add_argument('--shared', action='store_true',
+                       help='fetch orders that differ only in region once, together')
+        p.set_defaults(func=fun)
+
+    p = sub.add_parser('plan', help='estimate the downloads of every order (dry run)')
+    p.add_argument('orders', help='order CSV')
+    p.add_argument('--chunk-mb', type=float, default=128,
+                   help='largest single request (default 128)')
+    p.set_defaults(func=plan)
+
+    p = sub.add_parser('cache', help='show cache sizes')
+    p.add_argument('--expire', action='store_true', help='drop stale geocoding entries')
+    p.set_defaults(func=cache)
+
+    p = sub.add_parser('climatology', help='add whole years to a measure\'s climatology')
+    p.add_argument('measure')
+    p.add_argument('start', type=int, help='first year')
+    p.add_argument('end', type=int, help='last year')
+    p.add_argument('--resolution', default='monthly', choices=['monthly', 'hourly'])
+    p.set_defaults(func=climatology)
+
+    p = sub.add_parser('masks', help='make the mask of every output directory')
+    p.add_argument('directory')
+    p.add_argument('--processes', type=int, help='default: one per core')
+    p.add_argument('--force', action='store_true', help='remake masks that already exist')
+    p.set_defaults(func=masks)
+
+    p = sub.add_parser('swatches', help='cut a swatch from every image')
+    p.add_argument('directory')
+    p.add_argument('--processes', type=int, help='default: one per core')
+    p.add_argument('--out-dir', help='where to write the swatches')
+    p.set_defaults(func=swatches)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.trace:
+        import Trace
+        Trace.enable()
+
+    args.func(args)
+
+    if args.trace:
+        tracer = Trace.disable()
+        tracer.save(args.trace)
+        print tracer.report()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
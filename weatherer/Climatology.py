@@ -0,0 +1,260 @@
+from __future__ import division
+
+import datetime
+import json
+import os
+
+import numpy as np
+
+SAVEDIR = os.path.join('..', 'outputs', 'climatology')
+
+_stores = {}
+
+
+def month_stats(frames):
+    """
+    (count, mean, M2) of a (time x lat x lon) stack for every cell, ignoring NaNs.
+    """
+    valid = ~np.isnan(frames)
+    count = valid.sum(axis=0).astype(float)
+    total = np.where(valid, frames, 0.).sum(axis=0)
+    mean = np.where(count > 0, total / np.maximum(count, 1), 0.)
+    m2 = np.where(valid, (frames - mean) ** 2, 0.).sum(axis=0)
+    return count, mean, m2
+
+
+def merge(count, mean, m2, count_b, mean_b, m2_b):
+    """
+    Fold the statistics of a new batch into running ones, in place (Chan et al.'s
+    pairwise form of Welford's update, so batches of any size merge exactly).
+    """
+    n = count + count_b
+    safe = np.maximum(n, 1)
+    delta = mean_b - mean
+    mean += np.where(n > 0, delta * count_b / safe, 0.)
+    m2 += m2_b + np.where(n > 0, delta ** 2 * count * count_b / safe, 0.)
+    count[...] = n
+
+
+def locate(axis, values):
+    """
+    Start index of values within axis, which must contain them as a contiguous run.
+    """
+    start = int(np.abs(axis - values[0]).argmin())
+    if start + len(values) > len(axis) or \
+            not np.allclose(axis[start:start + len(values)], values):
+        raise ValueError('coordinates are not on the climatology grid')
+    return start
+
+
+def overlap(a, b):
+    """
+    Intersection of two [i0, i1, j0, j1] rectangles, or None.
+    """
+    r = [max(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), min(a[3], b[3])]
+    return r if r[0] < r[1] and r[2] < r[3] else None
+
+
+def slot(time, time_resolution):
+    """
+    Integer position of a Result time (days, as in Result.time) on the store's time
+    grid: months for monthly stores, 3-hour periods for hourly ones.
+    """
+    if time_resolution == 'monthly':
+        date = datetime.datetime.fromordinal(int(time) - 1)
+        return date.year * 12 + date.month - 1
+    return int(round(time * 8))
+
+
+def runs(slots):
+    """
+    Split sorted, distinct slots into [first, last, stride] arithmetic runs.
+    """
+    out = []
+    for t in slots:
+        if out and out[-1][0] == out[-1][1] and out[-1][1] < t:
+            out[-1][1:] = [t, t - out[-1][0]]
+        elif out and t - out[-1][1] == out[-1][2]:
+            out[-1][1] = t
+        else:
+            out.append([t, t, 1])
+    return out
+
+
+def covers(run, t):
+    return run[0] <= t <= run[1] and (t - run[0]) % run[2] == 0
+
+
+def add_runs(coverage, new):
+    """
+    Add runs to a list of them, merging contiguous (stride 1) runs that touch, so a
+    box fetched year after year stays a single interval.
+    """
+    out = []
+    for r in sorted(coverage + new):
+        if out and out[-1][2] == 1 and r[2] == 1 and r[0] <= out[-1][1] + 1:
+            out[-1][1] = max(out[-1][1], r[1])
+        elif out and r[0] == r[1] and covers(out[-1], r[0]):
+            continue
+        else:
+            out.append(list(r))
+    return out
+
+
+class ClimatologyStore(object):
+    """
+    Running count, mean and M2 per calendar month and grid cell for one measure,
+    kept as memory-mapped .npy files over the full model grid.  Fetched frames are
+    folded in as they arrive, and the times each box has already contributed are
+    remembered as runs of time slots, so overlapping or repeated fetches are never
+    counted twice while the index stays a few entries per box.
+    """
+
+    def __init__(self, measure, time_resolution, lat, lon, directory=SAVEDIR):
+        self.measure = measure
+        self.time_resolution = time_resolution
+        self.name = '%s_%s' % (measure, time_resolution)
+        self.path = os.path.join(directory, self.name)
+        self.index_file = self.path + '.json'
+        self.lat = np.asarray(lat, float)
+        self.lon = np.asarray(lon, float)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        shape = (12, len(self.lat), len(self.lon))
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+            self.coverage = index.get('coverage', {})
+            # Indexes written before coverage runs listed every timestamp
+            for time, rects in index.get('seen', {}).iteritems():
+                for rect in rects:
+                    self.cover(rect, [slot(float(time), self.time_resolution)])
+            mode = 'r+'
+        else:
+            self.coverage = {}
+            mode = 'w+'
+        self.count, self.mean, self.m2 = [
+            np.lib.format.open_memmap('%s_%s.npy' % (self.path, s), mode=mode,
+                                      dtype=np.float64, shape=shape)
+            for s in ('count', 'mean', 'm2')]
+
+    def save(self):
+        for a in (self.count, self.mean, self.m2):
+            a.flush()
+        with open(self.index_file, 'w') as f:
+            json.dump({'measure': self.measure, 'time_resolution': self.time_resolution,
+                       'coverage': self.coverage}, f, separators=(',', ':'))
+
+    def cover(self, rect, slots):
+        key = ','.join(str(int(x)) for x in rect)
+        self.coverage[key] = add_runs(self.coverage.get(key, []),
+                                      runs(sorted(set(slots))))
+
+    def covered(self, t):
+        """
+        [i0, i1, j0, j1] boxes already recorded for time slot t.
+        """
+        return [[int(x) for x in key.split(',')] for key, rs in self.coverage.iteritems()
+                if any(covers(r, t) for r in rs)]
+
+    def update(self, results):
+        """
+        Fold a list of Results (one box, any number of times) into the store, and
+        return how many new cell-observations were added.
+        """
+        if not results:
+            return 0
+        i0 = locate(self.lat, results[0].lat)
+        j0 = locate(self.lon, results[0].lon)
+        rect = [i0, i0 + len(results[0].lat), j0, j0 + len(results[0].lon)]
+
+        months, slots = {}, set()
+        for r in results:
+            t = slot(r.time, self.time_resolution)
+            if t in slots:
+                continue
+            val = np.array(r.val, float)
+            val[val >= r.missing_value] = np.nan
+            for old in self.covered(t):
+                o = overlap(rect, old)
+                if o is not None:
+                    val[o[0] - rect[0]:o[1] - rect[0], o[2] - rect[2]:o[3] - rect[2]] = np.nan
+            slots.add(t)
+            months.setdefault(r.obs_date.month - 1, []).append(val)
+        self.cover(rect, slots)
+
+        added = 0
+        s = (slice(rect[0], rect[1]), slice(rect[2], rect[3]))
+        for m, frames in months.iteritems():
+            batch = month_stats(np.array(frames))
+            merge(self.count[m][s], self.mean[m][s], self.m2[m][s], *batch)
+            added += int(batch[0].sum())
+        self.save()
+        return added
+
+    def normals(self, month, lat, lon):
+        """
+        (count, mean, standard deviation) for calendar month (1-12) over the cells
+        spanned by the lat and lon axes; std is NaN with fewer than two observations.
+        """
+        i0, j0 = locate(self.lat, lat), locate(self.lon, lon)
+        s = (month - 1, slice(i0, i0 + len(lat)), slice(j0, j0 + len(lon)))
+        count, mean = np.array(self.count[s]), np.array(self.mean[s])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(count > 1, np.sqrt(self.m2[s] / (count - 1)), np.nan)
+        mean[count == 0] = np.nan
+        return count, mean, std
+
+
+def store_resolution(time_resolution):
+    # Daily orders are drawn from the same 3-hourly files as hourly ones
+    return 'monthly' if time_resolution == 'monthly' else 'hourly'
+
+
+def get_store(query_params, directory=SAVEDIR):
+    """
+    The shared store for a query's measure and time resolution, created over the
+    full grid of its first domain URL on first use.  Data from servers other than
+    NOMADS is kept in a store of its own, under a subdirectory named for the server.
+    """
+    from Query import server_name
+    server = server_name(getattr(query_params, 'server', None))
+    if server:
+        directory = os.path.join(directory, server)
+    key = (query_params.measures[0], store_resolution(query_params.time_resolution),
+           directory)
+    if key not in _stores:
+        import Access
+        lat, lon = Access.get_access().coordinates(query_params.domain_urls[0])
+        _stores[key] = ClimatologyStore(key[0], key[1], lat, lon, directory)
+    return _stores[key]
+
+
+def record(query_params, dataset, directory=SAVEDIR):
+    """
+    Update the climatology with a freshly fetched dataset.
+    """
+    return get_store(query_params, directory).update(dataset.results)
+
+
+def backfill(measure, year_start, year_end, time_resolution='monthly', geo_range=None,
+             server=None, directory=SAVEDIR):
+    """
+    Build the climatology for geo_range (the contiguous US by default) one year at a
+    time, so memory stays bounded; years already recorded add nothing.
+    """
+    from Query import NOMADS_URL, USA_BOX, QueryParameters
+    from Weatherer import execute_query
+
+    added = 0
+    for year in xrange(year_start, year_end + 1):
+        qp = QueryParameters(time_start=datetime.datetime(year, 1, 1),
+                             time_end=datetime.datetime(year, 12, 1)
+                             if time_resolution == 'monthly'
+                             else datetime.datetime(year + 1, 1, 1),
+                             time_resolution=time_resolution,
+                             geo_range=geo_range or USA_BOX, measure=measure,
+                             server=server or NOMADS_URL)
+        added += get_store(qp, directory).update(execute_query(qp.queries))
+    return added
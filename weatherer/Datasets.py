@@ -1,8 +1,79 @@
 import copy
 import datetime
+import os
+from collections import OrderedDict
 
 import numpy as np
-import scipy.ndimage
+
+import Workers
+
+DEFAULT_BLOCK = 32  # input frames per chunk
+
+
+def bilinear_weights(axis_lat, axis_lon, lats, lons):
+    """
+    Locate every (lat, lon) point on a regular grid in one batched lookup.
+
+    Returns the lower-left cell indices (i, j) and the fractional offsets (wy, wx)
+    needed for bilinear interpolation.  Points outside the grid get NaN offsets.
+    """
+    lats = np.asarray(lats, float)
+    lons = np.asarray(lons, float)
+    i = np.clip(np.searchsorted(axis_lat, lats, side='right') - 1, 0, len(axis_lat) - 2)
+    j = np.clip(np.searchsorted(axis_lon, lons, side='right') - 1, 0, len(axis_lon) - 2)
+    wy = (lats - axis_lat[i]) / (axis_lat[i + 1] - axis_lat[i])
+    wx = (lons - axis_lon[j]) / (axis_lon[j + 1] - axis_lon[j])
+    outside = (wy < 0) | (wy > 1) | (wx < 0) | (wx > 1)
+    wy[outside] = np.nan
+    wx[outside] = np.nan
+    return i, j, wy, wx
+
+
+def bilinear_sample(cube, i, j, wy, wx):
+    """
+    Gather cube (time x lat x lon) at the stencils from bilinear_weights, returning
+    a (points x time) array.
+    """
+    v00 = cube[:, i, j]
+    v01 = cube[:, i, j + 1]
+    v10 = cube[:, i + 1, j]
+    v11 = cube[:, i + 1, j + 1]
+    out = (v00 * (1 - wy) * (1 - wx) + v01 * (1 - wy) * wx +
+           v10 * wy * (1 - wx) + v11 * wy * wx)
+    return out.T
+
+
+def transform_block(job):
+    """
+    fix_nans, zoom and interpolate input frames [b0, b1) of the cube in src, writing
+    their output frames into dst.  Reads one halo frame past the block, which the
+    interpolation toward the next block needs.  Returns the block's (min, max).
+    """
+    src, dst, b0, b1, zoom, interpolate, missing_value = job
+    cube = np.load(src, mmap_mode='r')
+    out = np.load(dst, mmap_mode='r+')
+    n = len(cube)
+
+    frames = np.array(cube[b0:min(b1 + 1, n)], dtype=out.dtype)
+    frames[frames >= missing_value] = np.nan
+    if zoom != 1:
+        import scipy.ndimage
+        frames = np.array([scipy.ndimage.zoom(f, zoom) for f in frames])
+
+    if interpolate == 1:
+        written = out[b0:b1]
+        written[...] = frames[:b1 - b0]
+    else:
+        for i in xrange(b0, min(b1, n - 1)):
+            v = frames[i - b0]
+            vd = (frames[i - b0 + 1] - v) / interpolate
+            for j in xrange(interpolate):
+                out[i * interpolate + j] = v + vd * (j + 1)
+        if b1 >= n:
+            out[-1] = frames[-1]
+        written = out[b0 * interpolate:min(b1 * interpolate, len(out))]
+    out.flush()
+    return np.nanmin(written), np.nanmax(written)
 
 
 class Result:
@@ -45,10 +116,16 @@ class Result:
                              " (" + self.unit + ")"
 
     def zoom(self, multiplier):
+        import scipy.ndimage
         self.val = scipy.ndimage.zoom(self.val, multiplier)
         self.lat = scipy.ndimage.zoom(self.lat, multiplier)
         self.lon = scipy.ndimage.zoom(self.lon, multiplier)
 
+    def decimate(self, step):
+        self.val = self.val[::step, ::step]
+        self.lat = self.lat[::step]
+        self.lon = self.lon[::step]
+
     def fix_nans(self):
         self.val[self.val >= self.missing_value] = np.nan
         self.val[self.val == np.nan] = np.nanmean(self.val)
@@ -60,7 +137,7 @@ class Dataset:
     statistics and values for use in plotting and animating.
     """
 
-    def __init__(self, results, agg=None):
+    def __init__(self, results, agg=None, extrema=None):
         self.results = results
         if agg is not None:
             self.aggregate(agg)
@@ -76,7 +153,10 @@ class Dataset:
         print self.globals
 
         self.lon_array, self.lat_array = self.results[0].lon, self.results[0].lat
-        self.set_extrema()
+        if extrema is None:
+            self.set_extrema()
+        else:
+            self.globals['val_min'], self.globals['val_max'] = extrema
         return
 
     def set_extrema(self):
@@ -85,8 +165,8 @@ class Dataset:
             # self.globals['lat_max'] = max(self.globals['lat_max'], np.max(v.lat))
             # self.globals['lon_min'] = min(self.globals['lon_min'], np.min(v.lon))
             # self.globals['lon_max'] = max(self.globals['lon_max'], np.max(v.lon))
-            self.globals['val_min'] = min(self.globals['val_min'], np.min(v.val))
-            self.globals['val_max'] = max(self.globals['val_max'], np.max(v.val))
+            self.globals['val_min'] = min(self.globals['val_min'], np.nanmin(v.val))
+            self.globals['val_max'] = max(self.globals['val_max'], np.nanmax(v.val))
         return
 
     def aggregate(self, results, step):
@@ -121,10 +201,164 @@ class Dataset:
             r.zoom(multiplier)
         self.lon_array, self.lat_array = self.results[0].lon, self.results[0].lat
 
+    def decimate(self, step):
+        """
+        Keep every step-th grid cell along each axis.
+        """
+        if step == 1:
+            return
+        for r in self.results:
+            r.decimate(step)
+        self.lon_array, self.lat_array = self.results[0].lon, self.results[0].lat
+
     def fix_nans(self):
         for r in self.results:
             r.fix_nans()
 
+    def region(self, rows, cols, geo_range):
+        """
+        A Dataset over the cells rows x cols (slices) whose frames are views into this
+        one's, so many regions can be rendered from one fetched cube without copying
+        it.  Views share memory: of the transforms, only fix_nans writes in place, and
+        it does the same thing whichever region runs it.
+        """
+        return Dataset([Result(geo_range, r.measurement, r.time, r.time_resolution, r.unit,
+                               r.long_name, r.missing_value, r.val[rows, cols],
+                               r.lat[rows], r.lon[cols]) for r in self.results])
+
+    def cube(self):
+        """
+        Stack every result into a single (time x lat x lon) array.
+        """
+        return np.array([r.val for r in self.results])
+
+    def sample(self, lats, lons):
+        """
+        Bilinearly sample the dataset at many points for every time at once,
+        returning a (points x time) array.
+        """
+        i, j, wy, wx = bilinear_weights(self.lat_array, self.lon_array, lats, lons)
+        return bilinear_sample(self.cube(), i, j, wy, wx)
+
+    def anomaly(self, store, zscore=False, min_count=2):
+        """
+        Replace every frame by its departure from the climatology in store (a
+        Climatology.ClimatologyStore), or by that departure in standard deviations if
+        zscore.  Cells with fewer than min_count past observations become NaN.
+        """
+        for r in self.results:
+            count, mean, std = store.normals(r.obs_date.month, r.lat, r.lon)
+            val = np.array(r.val, float)
+            val[val >= r.missing_value] = np.nan
+            val -= mean
+            if zscore:
+                val /= std
+                r.unit = 'sd'
+            val[count < min_count] = np.nan
+            r.val = val
+            r.long_name = r.long_name + (' z-score' if zscore else ' anomaly')
+            r.update_labels()
+        self.globals['val_min'], self.globals['val_max'] = np.inf, -np.inf
+        self.set_extrema()
+
+    def transform_chunked(self, filename, zoom=1, interpolate=1, block=DEFAULT_BLOCK,
+                          processes=None):
+        """
+        Out-of-core equivalent of fix_nans, zoom and interpolate: the frames are
+        processed in time blocks by a process pool and written straight into a .npy
+        memmap at filename, so memory use is bounded by the blocks in flight rather
+        than the whole series.  Returns a new Dataset whose frames are views of that
+        file.  The input cube is staged next to it as filename + '.in.npy' while the
+        blocks run, and neither file is left behind if one fails.
+        """
+        import scipy.ndimage
+
+        src = filename + '.in.npy'
+        r0, n = self.results[0], len(self.results)
+        shape = scipy.ndimage.zoom(r0.val, zoom).shape if zoom != 1 else r0.val.shape
+        length = (n - 1) * interpolate + 1
+        dtype = np.asarray(r0.val).dtype
+        jobs = [(src, filename, b0, min(b0 + block, n), zoom, interpolate,
+                 r0.missing_value) for b0 in xrange(0, n, block)]
+        try:
+            # Spilled a frame at a time, so the input is never held twice in memory
+            cube = np.lib.format.open_memmap(src, mode='w+', dtype=dtype,
+                                             shape=(n,) + np.shape(r0.val))
+            for i, r in enumerate(self.results):
+                cube[i] = r.val
+            cube.flush()
+            del cube
+            out = np.lib.format.open_memmap(filename, mode='w+',
+                                            dtype=dtype if dtype.kind == 'f' else float,
+                                            shape=(length,) + shape)
+            del out
+            extrema = Workers.run(transform_block, jobs, processes, label='blocks')[0]
+        except BaseException:
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
+        finally:
+            if os.path.exists(src):
+                os.remove(src)
+
+        lat, lon = r0.lat, r0.lon
+        if zoom != 1:
+            lat, lon = scipy.ndimage.zoom(lat, zoom), scipy.ndimage.zoom(lon, zoom)
+        times = np.array([r.time for r in self.results], float)
+        if interpolate != 1:
+            steps = np.arange(1, interpolate + 1) / float(interpolate)
+            times = np.append((times[:-1, None] + np.diff(times)[:, None] * steps).ravel(),
+                              times[-1])
+
+        out = np.load(filename, mmap_mode='r')
+        results = [Result(r0.geo_range, r0.measurement, t, r0.time_resolution, r0.unit,
+                          r0.long_name, r0.missing_value, out[i], lat, lon)
+                   for i, t in enumerate(times)]
+        return Dataset(results, extrema=(np.nanmin([e[0] for e in extrema]),
+                                         np.nanmax([e[1] for e in extrema])))
+
     def concat_results(self, trim=10):
         self.results = self.results[:trim]
         self.length = trim
+
+
+class Cube:
+    """
+    Several measures sharing one (time, lat, lon) grid, as returned by a
+    multi-variable query.  values and attributes are keyed by measure.
+    """
+
+    def __init__(self, geo_range, time_resolution, time, lat, lon, values, attributes):
+        self.geo_range = geo_range
+        self.time_resolution = time_resolution
+        self.time = time
+        self.lat = lat
+        self.lon = lon
+        self.values = values
+        self.attributes = attributes
+
+    @property
+    def measures(self):
+        return self.values.keys()
+
+    def results(self, measure):
+        a = self.attributes[measure]
+        return [Result(self.geo_range, measure, t, self.time_resolution,
+                       a.get('units', 'NA'), a['long_name'], a['missing_value'],
+                       self.values[measure][i], self.lat, self.lon)
+                for i, t in enumerate(self.time)]
+
+    def dataset(self, measure):
+        """
+        A Dataset for one measure whose frames are views into this cube.
+        """
+        return Dataset(self.results(measure))
+
+    def region(self, rows, cols, geo_range):
+        """
+        A Cube over the cells rows x cols (slices), as views into this one.
+        """
+        return Cube(geo_range, self.time_resolution, self.time, self.lat[rows],
+                    self.lon[cols],
+                    OrderedDict((m, v[:, rows, cols]) for m, v in self.values.items()),
+                    self.attributes)
@@ -1,12 +1,91 @@
 from __future__ import division
 
 import os
+from collections import OrderedDict
+
 import numpy as np
 from matplotlib import pyplot as plt, animation
 from matplotlib.patches import Polygon
 from mpl_toolkits.basemap import Basemap
 
 OUTPUT_REL = os.path.join('.', 'outputs', 'visualizations')
+MAP_POOL = 8  # Basemaps (with their shapefiles) kept per Renderer
+
+_renderer = None
+
+
+def map_extent(dataset):
+    g = dataset.globals
+    return g['lat_min'], g['lat_max'], g['lon_min'], g['lon_max']
+
+
+class Renderer(object):
+    """
+    A long-lived figure and axes that Animators draw on in turn, plus a small pool
+    of Basemaps keyed by extent (which also keep any shapefile read into them).
+    Between orders only the data artists are removed, so a batch does not pay for
+    building and tearing down a figure, or grow in memory, order after order.
+    """
+
+    def __init__(self, map_pool=MAP_POOL):
+        self.figure = plt.figure()
+        self.axis = plt.Axes(self.figure, [0., 0., 1., 1.])
+        self.axis.set_axis_off()
+        self.figure.add_axes(self.axis)
+        self.map_pool = map_pool
+        self.maps = OrderedDict()
+
+    def basemap(self, extent):
+        """
+        The Basemap for (lat_min, lat_max, lon_min, lon_max), built on first use.
+        """
+        if extent in self.maps:
+            self.maps[extent] = self.maps.pop(extent)
+        else:
+            lat_min, lat_max, lon_min, lon_max = extent
+            self.maps[extent] = Basemap(projection='merc', resolution='c', ax=self.axis,
+                                        lat_ts=(lat_min + lat_max) / 2,
+                                        llcrnrlat=lat_min, urcrnrlat=lat_max,
+                                        llcrnrlon=lon_min, urcrnrlon=lon_max)
+            if len(self.maps) > self.map_pool:
+                self.maps.popitem(last=False)
+        return self.maps[extent]
+
+    def reset(self):
+        """
+        Remove everything the last order drew, and return the figure to the size and
+        scaling a new one would have.
+        """
+        self.figure.set_size_inches(plt.rcParams['figure.figsize'])
+        for artists in (self.axis.collections, self.axis.patches, self.axis.lines,
+                        self.axis.images):
+            for a in list(artists):
+                a.remove()
+        self.axis.ignore_existing_data_limits = True
+        self.axis.set_autoscale_on(True)
+        plt.figure(self.figure.number)
+
+    def animator(self, dataset, **kwargs):
+        self.reset()
+        return Animator(dataset, renderer=self, **kwargs)
+
+    def close(self):
+        plt.close(self.figure)
+        self.maps.clear()
+
+
+def get_renderer():
+    global _renderer
+    if _renderer is None:
+        _renderer = Renderer()
+    return _renderer
+
+
+def close_renderer():
+    global _renderer
+    if _renderer is not None:
+        _renderer.close()
+        _renderer = None
 
 
 class Animator:
@@ -16,11 +95,12 @@ class Animator:
     """
 
     def __init__(self, dataset, cmap="Greys", contour_levels=10, clear_frames=False,
-                 repeat=True):
+                 repeat=True, renderer=None):
         """
         Does a few things:
             -> Assigns a local copy of the dataset and various switches
-            -> Clears the current axis of plt
+            -> Clears the current axis of plt, or borrows the figure, axis and
+               Basemap of renderer (a Renderer) if given
             -> Creates a new Basemap instance
             -> Sets coordinate matrices, value maxima, and the colormap
         """
@@ -28,22 +108,24 @@ class Animator:
         self.clear_frames = clear_frames
         self.repeat = repeat
         self.init_frame = False
+        self.renderer = renderer
 
-        # Construction of mpl table components
-        plt.cla()
-        self.figure = plt.figure()
-        self.axis = plt.Axes(self.figure, [0., 0., 1., 1.])
-        self.axis.set_axis_off()
-        self.figure.add_axes(self.axis)
+        if renderer is not None:
+            self.figure, self.axis = renderer.figure, renderer.axis
+            self.bmap = renderer.basemap(map_extent(dataset))
+        else:
+            # Construction of mpl table components
+            plt.cla()
+            self.figure = plt.figure()
+            self.axis = plt.Axes(self.figure, [0., 0., 1., 1.])
+            self.axis.set_axis_off()
+            self.figure.add_axes(self.axis)
 
-        middle_lat = self.dataset.globals['lat_min'] + self.dataset.globals['lat_max']
-        middle_lat /= 2
-        self.bmap = Basemap(projection='merc', resolution='c', ax=self.axis,
-                            lat_ts=middle_lat,
-                            llcrnrlat=self.dataset.globals['lat_min'],
-                            urcrnrlat=self.dataset.globals['lat_max'],
-                            llcrnrlon=self.dataset.globals['lon_min'],
-                            urcrnrlon=self.dataset.globals['lon_max'])
+            lat_min, lat_max, lon_min, lon_max = map_extent(dataset)
+            self.bmap = Basemap(projection='merc', resolution='c', ax=self.axis,
+                                lat_ts=(lat_min + lat_max) / 2,
+                                llcrnrlat=lat_min, urcrnrlat=lat_max,
+                                llcrnrlon=lon_min, urcrnrlon=lon_max)
 
         self.lon, self.lat = np.meshgrid(self.dataset.lon_array, self.dataset.lat_array)
         self.x, self.y = self.bmap(self.lon, self.lat)
@@ -54,6 +136,7 @@ class Animator:
 
         self.levels = np.linspace(self.val_min, self.val_max, contour_levels)
         self.cmap = plt.get_cmap(cmap)
+        self.views = []
 
     def adjust_dimensions(self, goal_w=36, goal_h=24):
         '''
@@ -109,33 +192,114 @@ class Animator:
         plt.gca().xaxis.set_major_locator(plt.NullLocator())
         plt.gca().yaxis.set_major_locator(plt.NullLocator())
 
-    def save_plt(self, filename='', width=6, height=4, dpi=100):
+    def save_plt(self, filename='', width=6, height=4, dpi=100, max_size=None):
         """
         Saves the plot with the specified dimensions.  At high DPIs the DPI must be
         adjusted as MPL has a hardcoded limit of <= 32768 for any image dimension.
+        If max_size is given the DPI is lowered so that neither side exceeds it.
+        """
+        scale, dpi = self.fit_figure(width, height, dpi, max_size)
+        self.clear_whitespace()
+        self.figure.savefig(filename, dpi=dpi, bbox_inches='tight', pad_inches=0)
+
+        return scale['orientation']
+
+    def fit_figure(self, width, height, dpi, max_size=None):
+        """
+        Size the figure for the target medium and return (scale, dpi) with the DPI
+        lowered to respect max_size and MPL's dimension limit.
         """
         scale = self.adjust_dimensions(goal_w=width, goal_h=height)
         self.figure.set_size_inches(w=scale['w'], h=scale['h'])
 
+        if max_size is not None:
+            dpi = max(1, min(dpi, int(max_size / max(scale['w'], scale['h']))))
+
         if scale['h'] * dpi > 32768:
             dpi = int(32768 / scale['h'])
             print 'to ' + str(dpi)
         if scale['w'] * dpi > 32768:
             dpi = int(32768 / scale['w'])
             print 'to ' + str(dpi)
-        self.clear_whitespace()
-        self.figure.savefig(filename, dpi=dpi, bbox_inches='tight', pad_inches=0)
+        return scale, dpi
+
+    def save_raster(self, filename='', width=6, height=4, dpi=100, max_size=None):
+        """
+        Saves the stacked contours as rasters instead of an image: the colormap
+        position of the topmost line at each pixel and the lines' alpha coverage.
+        Palette.recolor_many turns these into images for any colormap.
+        """
+        from io import BytesIO
+        from matplotlib import image
+        import Palette
 
+        scale, dpi = self.fit_figure(width, height, dpi, max_size)
+        self.clear_whitespace()
+        lines = [(c, (level - self.val_min) / (self.val_max - self.val_min))
+                 for view in self.views for c, level in zip(view.collections, view.levels)]
+
+        def draw(background):
+            # Same geometry as save_plt, so the recolored images are interchangeable
+            buf = BytesIO()
+            self.figure.savefig(buf, dpi=dpi, bbox_inches='tight', pad_inches=0,
+                                facecolor=background)
+            buf.seek(0)
+            return np.round(image.imread(buf)[..., 0] * 255).astype(np.uint8)
+
+        # Scalar pass: unblended grey levels encoding the colormap position on black
+        for c, t in lines:
+            g = Palette.encode(t) / 255
+            c.set_color((g, g, g, 1.))
+            c.set_antialiased(False)
+        scalar = draw('k')
+
+        # Coverage pass: the lines as originally blended, in black on white
+        for c, t in lines:
+            c.set_color((0., 0., 0., 0.5))
+            c.set_antialiased(True)
+        coverage = 255 - draw('w')
+
+        np.savez_compressed(filename, scalar=scalar, coverage=coverage, dpi=dpi)
         return scale['orientation']
 
+    def save_vector(self, filename, width=6, height=4, dpi=1200, stroke_width=1.0):
+        """
+        Saves the stacked contours as a compact SVG or PDF (by extension): isolines
+        of the same level are merged across frames and simplified to the print
+        resolution, so the file grows with the visual detail rather than the number
+        of frames.  Returns vertex counts before and after, and the file size.
+        """
+        import Vector
+
+        scale, dpi = self.fit_figure(width, height, dpi)
+        w, h = scale['w'] * Vector.POINTS_PER_INCH, scale['h'] * Vector.POINTS_PER_INCH
+        to_axes = self.axis.transData + self.axis.transAxes.inverted()
+        layers = []
+        for view in self.views:
+            for c in view.collections:
+                if not len(c.get_edgecolor()):
+                    continue
+                lines = []
+                for path in c.get_paths():
+                    for line in path.to_polygons(closed_only=False):
+                        f = to_axes.transform(line)
+                        lines.append(np.column_stack([f[:, 0] * w, (1 - f[:, 1]) * h]))
+                layers.append((tuple(np.round(c.get_edgecolor()[0], 4)), lines))
+
+        stats = Vector.export(filename, layers, w, h, dpi, stroke_width=stroke_width)
+        print '%s: %d -> %d vertices, %d paths, %d bytes' % (
+            filename, stats['vertices_in'], stats['vertices_out'], stats['paths'],
+            stats['bytes'])
+        return stats
+
     def draw_region(self, stroke_width=1.0, state='NA'):
         """
         Draws the specified region (states for now, later, provinces or smaller countries)
         """
         if state != 'NA':
-            sh = os.path.join('.', 'resources', 'sa_adm1')
-            shp_info = self.bmap.readshapefile(shapefile=sh, name='states',
-                                               drawbounds=False)
+            if not hasattr(self.bmap, 'states'):
+                sh = os.path.join('.', 'resources', 'sa_adm1')
+                self.bmap.readshapefile(shapefile=sh, name='states', drawbounds=False)
             for seg_num, seg in enumerate(self.bmap.states):
                 if self.bmap.states_info[seg_num]['NAME_1'] in [state]:
                     p = Polygon(seg, facecolor=None, edgecolor='#000000',
@@ -157,6 +321,7 @@ class Animator:
             c.set_color((0., 0., 0., 0.))
         for i in range(0, self.dataset.length):
             view = self.anim_type(plot_type, self.dataset.results[i].val)
+            self.views.append(view)
             # This allows us to change the linewidth post-hoc
             for c in view.collections:
                 c.set_linewidth(stroke_width)
@@ -235,8 +400,13 @@ class Animator:
     def close(self):
         """
         Closes all figures, axes, and PLT instances.  Appears to serve its function of
-        clearing memory.
+        clearing memory.  A pooled figure is only cleared of this Animator's data.
         """
+        if self.renderer is not None:
+            self.renderer.reset()
+            self.views = []
+            del self.dataset
+            return
         self.figure.clf()
         plt.close()
         del self.dataset
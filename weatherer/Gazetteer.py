@@ -0,0 +1,289 @@
+from __future__ import division
+
+import csv
+import difflib
+import json
+import os
+import re
+import struct
+
+import numpy as np
+
+RESOURCE_DIR = os.path.join('.', 'resources')
+INDEX_FILE = os.path.join(RESOURCE_DIR, 'gazetteer.json')
+
+# (shapefile base name, attribute CSV or None for the .dbf, admin level)
+SOURCES = [('USA_adm1', 'USA_adm1.csv', 1),
+           ('USA_adm2', 'USA_adm2.csv', 2),
+           ('ne_10m_admin_1_states_provinces', None, 1)]
+
+COUNTRY_NAMES = ['united states of america', 'united states', 'usa', 'us', 'u.s.',
+                 'u.s.a.', 'america']
+COUNTY_WORDS = re.compile(r'\b(county|parish|borough|census area|municipality)\b')
+# Admin-2 regions that are cities themselves, so "Name, State" may mean them
+CITY_TYPES = ('City', 'Independent City', 'City And Borough', 'City And County')
+POLYGON_TYPES = (5, 15, 25)
+MATCH_CUTOFF = 0.85
+
+_gazetteer = None
+
+
+def read_shape_extents(shp_file):
+    """
+    Yield (bbox, centroid, area) for each record of a polygon shapefile, where bbox
+    is [lat_min, lat_max, lon_min, lon_max] and centroid [lat, lon] is area-weighted.
+    Null shapes yield (None, None, 0) so records stay aligned with their attributes.
+    """
+    with open(shp_file, 'rb') as f:
+        f.seek(100)
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            __, length = struct.unpack('>2i', header)
+            content = f.read(length * 2)
+            shape_type = struct.unpack('<i', content[:4])[0]
+            if shape_type not in POLYGON_TYPES:
+                yield None, None, 0.
+                continue
+
+            xmin, ymin, xmax, ymax = struct.unpack('<4d', content[4:36])
+            n_parts, n_points = struct.unpack('<2i', content[36:44])
+            parts = np.frombuffer(content, '<i4', n_parts, 44)
+            pts = np.frombuffer(content, '<f8', n_points * 2, 44 + 4 * n_parts)
+            pts = pts.reshape(-1, 2)
+
+            area, cx, cy = 0., 0., 0.
+            for ring in np.split(pts, parts[1:]):
+                x, y = ring[:, 0], ring[:, 1]
+                x1, y1 = np.roll(x, -1), np.roll(y, -1)
+                cross = x * y1 - x1 * y
+                area += cross.sum() / 2
+                cx += ((x + x1) * cross).sum() / 6
+                cy += ((y + y1) * cross).sum() / 6
+            if area != 0:
+                centroid = [cy / area, cx / area]
+            else:
+                centroid = [(ymin + ymax) / 2, (xmin + xmax) / 2]
+            yield [ymin, ymax, xmin, xmax], centroid, abs(area)
+
+
+def read_dbf(dbf_file):
+    """
+    Minimal dBase III reader returning a list of {field: value} rows.
+    """
+    with open(dbf_file, 'rb') as f:
+        n_records, header_len, record_len = struct.unpack('<xxxxIHH20x', f.read(32))
+        fields = []
+        while True:
+            desc = f.read(32)
+            if desc[0] == '\r':
+                break
+            fields.append((desc[:11].split('\0')[0], ord(desc[16])))
+        f.seek(header_len)
+        rows = []
+        for __ in xrange(n_records):
+            record = f.read(record_len)
+            pos, row = 1, {}
+            for name, size in fields:
+                row[name] = record[pos:pos + size].strip().decode('utf-8', 'replace')
+                pos += size
+            rows.append(row)
+    return rows
+
+
+def read_attributes(resource_dir, base, attr_csv):
+    if attr_csv is not None:
+        with open(os.path.join(resource_dir, attr_csv)) as f:
+            return [dict((k, v.decode('utf-8')) for k, v in row.items())
+                    for row in csv.DictReader(f)]
+    return read_dbf(os.path.join(resource_dir, base + '.dbf'))
+
+
+def make_entry(level, row):
+    """
+    Map a GADM or Natural Earth attribute row to a gazetteer entry.
+    """
+    if 'NAME_1' in row:
+        if level == 1:
+            return {'level': 1, 'name': row['NAME_1'], 'state': row['NAME_1'],
+                    'hasc': row['HASC_1'], 'type': 'State',
+                    'aliases': [a for a in row['VARNAME_1'].split('|') if a]}
+        return {'level': 2, 'name': row['NAME_2'], 'state': row['NAME_1'],
+                'hasc': row['HASC_2'], 'type': row['TYPE_2'],
+                'aliases': [a for a in row['VARNAME_2'].split('|') if a]}
+    if row.get('iso_a2') != 'US':
+        return None
+    return {'level': 1, 'name': row['name'], 'state': row['name'],
+            'hasc': row['code_hasc'], 'type': 'State', 'aliases': [row['postal']]}
+
+
+def merge_extent(e, bbox, centroid, area, e_area):
+    """
+    Grow entry e (of area e_area) by another part of the same region.
+    """
+    b = e['bbox']
+    e['bbox'] = [min(b[0], bbox[0]), max(b[1], bbox[1]), min(b[2], bbox[2]),
+                 max(b[3], bbox[3])]
+    if area + e_area > 0:
+        e['centroid'] = [(c * e_area + d * area) / (area + e_area)
+                         for c, d in zip(e['centroid'], centroid)]
+
+
+def build(resource_dir=RESOURCE_DIR, index_file=INDEX_FILE):
+    """
+    Precompute the gazetteer index from the bundled admin shapefiles.  Sources whose
+    geometry (.shp) is absent are skipped; earlier sources win over later ones.
+    Records of one source sharing a name and HASC code (a region split over several
+    rows, like Alaska) are merged into one entry.
+    """
+    entries, seen = [], set()
+    for base, attr_csv, level in SOURCES:
+        shp = os.path.join(resource_dir, base + '.shp')
+        if not os.path.exists(shp):
+            continue
+        rows = read_attributes(resource_dir, base, attr_csv)
+        added, areas = {}, {}
+        for row, (bbox, centroid, area) in zip(rows, read_shape_extents(shp)):
+            e = make_entry(level, row)
+            if e is None or bbox is None:
+                continue
+            key = (e['level'], e['state'], e['name'])
+            if key in added and added[key]['hasc'] == e['hasc']:
+                merge_extent(added[key], bbox, centroid, area, areas[key])
+                areas[key] += area
+                continue
+            if key in seen or key in added:
+                continue
+            e['bbox'] = bbox
+            e['centroid'] = centroid
+            added[key], areas[key] = e, area
+            entries.append(e)
+        seen.update(added)
+
+    if not entries:
+        raise IOError('no admin shapefiles (.shp) found in ' + resource_dir)
+
+    with open(index_file, 'w') as f:
+        json.dump(entries, f, separators=(',', ':'))
+    return Gazetteer(entries)
+
+
+def normalize(name):
+    name = name.lower().replace('.', '').replace('-', ' ')
+    return ' '.join(COUNTY_WORDS.sub(' ', name).split())
+
+
+class Gazetteer(object):
+    """
+    Offline lookup of US state and county bounding boxes and centroids by name,
+    abbreviation or HASC code ("US.GA", "US.AL.AU"), with fuzzy matching.
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.states = {}
+        self.counties = {}
+        for e in entries:
+            keys = [e['name'], e['hasc']] + e['aliases']
+            if e['level'] == 1:
+                for k in keys:
+                    self.states[normalize(k)] = e
+            else:
+                for k in keys:
+                    self.counties[(normalize(k), normalize(e['state']))] = e
+                # HASC codes are not unique (Bedford and Bedford City); the first wins
+                self.counties.setdefault((normalize(e['hasc']), ''), e)
+
+    @classmethod
+    def load(cls, index_file=INDEX_FILE):
+        with open(index_file) as f:
+            return cls(json.load(f))
+
+    def match_state(self, name):
+        name = normalize(name)
+        if name in self.states:
+            return self.states[name]
+        close = difflib.get_close_matches(name, self.states.keys(), 1, MATCH_CUTOFF)
+        return self.states[close[0]] if close else None
+
+    def match_county(self, name, state, cities_only=False):
+        """
+        The admin-2 region called name in state, or with cities_only one of the
+        regions that are cities themselves (Virginia's independent cities).
+        """
+        key = (normalize(name), normalize(state['state']) if state else '')
+        candidates = [k[0] for k, e in self.counties.iteritems() if k[1] == key[1] and
+                      (not cities_only or e.get('type') in CITY_TYPES)]
+        if key[0] in candidates:
+            return self.counties[key]
+        close = difflib.get_close_matches(key[0], candidates, 1, MATCH_CUTOFF)
+        return self.counties[(close[0], key[1])] if close else None
+
+    def lookup(self, address):
+        """
+        Resolve "State", "County, State" or a HASC code (optionally followed by the
+        country) to an entry, or None when the address is not an admin region.
+        "Name, State" without a county word is taken for a city, so it only matches
+        regions that are cities; other places are left to geocoding.
+        """
+        parts = [p.strip() for p in address.split(',') if p.strip()]
+        while parts and parts[-1].lower() in COUNTRY_NAMES:
+            parts.pop()
+        if len(parts) == 1:
+            if parts[0].upper().startswith('US.') and parts[0].count('.') == 2:
+                return self.counties.get((normalize(parts[0]), ''))
+            return self.match_state(parts[0])
+        if len(parts) == 2:
+            state = self.match_state(parts[1])
+            if state is None:
+                return None
+            return self.match_county(parts[0], state,
+                                     cities_only=not COUNTY_WORDS.search(parts[0].lower()))
+        return None
+
+    def get_bounding_box(self, address, pad=0):
+        e = self.lookup(address)
+        if e is None:
+            return None
+        b = e['bbox']
+        return [b[0] - pad, b[1] + pad, b[2] - pad, b[3] + pad]
+
+    def get_point(self, address):
+        e = self.lookup(address)
+        return None if e is None else {'lat': e['centroid'][0], 'lng': e['centroid'][1]}
+
+
+def get_gazetteer():
+    """
+    The shared Gazetteer, loaded from the index (or built from the shapefiles on
+    first use).  None if neither is available.
+    """
+    global _gazetteer
+    if _gazetteer is None:
+        try:
+            _gazetteer = Gazetteer.load()
+        except IOError:
+            try:
+                _gazetteer = build()
+            except IOError:
+                return None
+    return _gazetteer
+
+
+def get_bounding_box(address, pad=0):
+    """
+    Bounding box for address, from the gazetteer when it is an admin region and from
+    Google Maps otherwise.
+    """
+    g = get_gazetteer()
+    bbox = g.get_bounding_box(address, pad) if g is not None else None
+    if bbox is None:
+        import Gmaps
+        bbox = Gmaps.get_bounding_box(address, pad)
+    return bbox
+
+
+if __name__ == '__main__':
+    gz = build()
+    print 'indexed %d regions into %s' % (len(gz.entries), INDEX_FILE)
@@ -1,37 +1,169 @@
 from __future__ import division
-import pickle
+import json
 import os
+import sqlite3
+import time
 from datetime import datetime
-import googlemaps
 import numpy as np
 
 
-SAVEDIR = os.path.join('.', 'outputs','gmap_queries')
-
-with open(os.path.join('config', 'api_key.txt'), 'r') as f:
-            t = []
-            for line in f.readlines():
-                t.append(tuple(line[:-1].split(' = ')))
-            token = dict(t)
-
-GM = googlemaps.Client(key=token['api_key'])
-NOW = datetime.now()
+SAVEDIR = os.path.join('.', 'outputs', 'gmap_queries')
+CACHE_FILE = os.path.join(SAVEDIR, 'gmaps_cache.sqlite')
+KEY_FILE = os.path.join('config', 'api_key.txt')
+DEFAULT_TTL = 90 * 24 * 3600  # seconds; bounds and routes change rarely
+
+_client = None
+_cache = None
+
+
+def read_token(key_file=KEY_FILE):
+    with open(key_file, 'r') as f:
+        t = []
+        for line in f.readlines():
+            t.append(tuple(line.rstrip('\n').split(' = ')))
+    return dict(t)
+
+
+def get_client():
+    """
+    The googlemaps.Client, created on first use so that importing this module (or
+    answering every request from the cache) needs neither the library nor a key.
+    """
+    global _client
+    if _client is None:
+        import googlemaps
+        _client = googlemaps.Client(key=read_token()['api_key'])
+    return _client
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = GmapsCache()
+    return _cache
+
+
+def normalize(gm_fun, query):
+    """
+    Cache key for a request: case, whitespace and argument order do not matter.
+    """
+    args = ['%s=%s' % (k, ' '.join(unicode(v).lower().replace(',', ', ').split()))
+            for k, v in sorted(query.items())]
+    return '|'.join([gm_fun] + args)
+
+
+class GmapsCache(object):
+    """
+    A single SQLite file holding every Maps response, indexed on the normalized
+    request.  Rows older than ttl seconds are treated as misses.  Rows read during
+    this process are also memoized, so repeated lookups never touch the database.
+    """
+
+    def __init__(self, filename=CACHE_FILE, ttl=DEFAULT_TTL):
+        self.filename = filename
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.memo = {}
+        self.db = sqlite3.connect(filename)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                        'key TEXT PRIMARY KEY, fun TEXT, created REAL, response TEXT)')
+        self.db.commit()
+
+    def fresh_after(self):
+        return 0 if self.ttl is None else time.time() - self.ttl
+
+    def get_many(self, keys):
+        """
+        Look up several keys with as few queries as possible, returning
+        {key: response} for those present and fresh.
+        """
+        found = dict((k, self.memo[k]) for k in keys if k in self.memo)
+        todo = list(set(k for k in keys if k not in found))
+        # SQLite caps the number of bound parameters per statement at 999
+        for i in xrange(0, len(todo), 900):
+            chunk = todo[i:i + 900]
+            rows = self.db.execute(
+                'SELECT key, response FROM responses WHERE created >= ? AND key IN (%s)'
+                % ','.join('?' * len(chunk)), [self.fresh_after()] + chunk)
+            for k, r in rows:
+                found[k] = self.memo[k] = json.loads(r)
+        self.hits += sum(1 for k in keys if k in found)
+        self.misses += sum(1 for k in keys if k not in found)
+        return found
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items):
+        """
+        Store [(key, gm_fun, response), ...] in one transaction.
+        """
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                            [(k, f, now, json.dumps(r)) for k, f, r in items])
+        self.db.commit()
+        for k, f, r in items:
+            self.memo[k] = r
+
+    def put(self, key, gm_fun, response):
+        self.put_many([(key, gm_fun, response)])
+
+    def expire(self):
+        """
+        Delete stale rows, returning how many were removed.
+        """
+        n = self.db.execute('DELETE FROM responses WHERE created < ?',
+                            [self.fresh_after()]).rowcount
+        self.db.commit()
+        return n
+
+    def stats(self):
+        rows = self.db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+        return {'rows': rows, 'hits': self.hits, 'misses': self.misses,
+                'file': self.filename}
+
+    def close(self):
+        self.db.close()
+
+
+def call_api(gm_fun, query):
+    if gm_fun == 'geocode':
+        return get_client().geocode(address=query['address'])
+    elif gm_fun == 'directions':
+        return get_client().directions(query['start'], query['end'], mode='driving',
+                                       departure_time=datetime.now())
+    raise ValueError('unknown Maps function ' + gm_fun)
 
 
 def gm_request(gm_fun, query):
-    name = gm_fun + '_'.join(query.itervalues())
-    try:
-        dataset = pickle.load(open(SAVEDIR + name, 'rb'))
-    except IOError:
-        if gm_fun == 'geocode':
-            dataset = GM.geocode(address=query['address'])
-        elif gm_fun == 'directions':
-            dataset = GM.directions(query['start'], query['end'], mode='driving',
-                                    departure_time=NOW)
-        pickle.dump(dataset, open(SAVEDIR + name, 'wb'))
+    cache = get_cache()
+    key = normalize(gm_fun, query)
+    dataset = cache.get(key)
+    if dataset is None:
+        dataset = call_api(gm_fun, query)
+        cache.put(key, gm_fun, dataset)
     return dataset
 
 
+def geocode_many(addresses):
+    """
+    Geocode a batch of addresses with one cache query; only misses reach the API.
+    Returns {address: geocode response}.
+    """
+    cache = get_cache()
+    keys = dict((a, normalize('geocode', {'address': a})) for a in addresses)
+    found = cache.get_many(keys.values())
+    new = []
+    for a, k in keys.iteritems():
+        if k not in found:
+            found[k] = call_api('geocode', {'address': a})
+            new.append((k, 'geocode', found[k]))
+    if new:
+        cache.put_many(new)
+    return dict((a, found[k]) for a, k in keys.iteritems())
+
+
 def get_bounding_box(address, pad=0):
     geocode = gm_request(gm_fun='geocode', query={'address': address})
     choices = [g[u'geometry'][u'bounds'] for g in geocode]
@@ -60,39 +192,27 @@ def get_route(start, end):
          b[u'southwest'][u'lng'] - pad,
          b[u'northeast'][u'lng'] + pad])
 
-    r = []
-    dist = []
     s = u'start_location'
-    e = u'end_location'
+    steps = geocode[0][u'legs'][0][u'steps']
+    r = np.array([[a[s][u'lat'], a[s][u'lng']] for a in steps])
+    dist = np.array([a[u'distance'][u'value'] for a in steps]) / 1000
 
-    for a in geocode[0][u'legs'][0][u'steps']:
-        r.append([a[s][u'lat'], a[s][u'lng']])
-        dist.append(a[u'distance'][u'value'] / 1000)
-
-    r_fine = []
+    # Split each step into ~50 km pieces; steps that would give <= 2 points keep
+    # only their start.  All segments are interpolated in one pass.
     st = 50
+    ct = dist[:-1] / st
+    counts = np.where(ct <= 2, 1, np.around(ct)).astype(int)
+    seg = np.repeat(np.arange(len(counts)), counts)
+    pos = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts)
+    frac = pos / np.maximum(counts[seg] - 1, 1)
+    r_fine = r[seg] + frac[:, np.newaxis] * (r[seg + 1] - r[seg])
 
-    for i, coord in enumerate(r[:-1]):
-        s = r[i]
-        e = r[i + 1]
-        d = dist[i]
-        ct = d / st
-        # If the linspace would make <= 2 points, just return start/end
-        if ct <= 2:
-            r_fine.append(s)
-            continue
-
-        ct = int(np.around(ct, 0))
-
-        spaced = zip(np.linspace(s[0], e[0], ct), np.linspace(s[1], e[1], ct))
-        for p in spaced: r_fine.append(list(p))
-
-    r_fine = np.floor(np.array(r_fine) * (16 / 3)) * (3 / 16)
+    r_fine = np.floor(r_fine * (16 / 3)) * (3 / 16)
 
     print len(r_fine)
     return r_fine, new_bounds
 
 
 if __name__ == '__main__':
-    usa = GM.geocode(address="United States of America")
-    washington = GM.geocode(address="Washington, USA")
+    usa = get_client().geocode(address="United States of America")
+    washington = get_client().geocode(address="Washington, USA")
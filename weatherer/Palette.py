@@ -0,0 +1,76 @@
+from __future__ import division
+
+import numpy as np
+
+import Workers
+
+# Scalar rasters hold 0 where no line was drawn and 1-255 for the line's position
+# along the colormap, so 254 steps span the whole palette.
+LEVELS = 254
+
+_raster = None
+
+
+def encode(t):
+    """
+    Raster value for colormap positions t in [0, 1].
+    """
+    return 1 + np.round(np.clip(t, 0, 1) * LEVELS).astype(np.uint8)
+
+
+def lut(cmap):
+    """
+    RGB lookup table (256 x 3, uint8) for a colormap name, indexed by raster value.
+    """
+    from matplotlib import cm
+    colors = cm.get_cmap(cmap)(np.arange(LEVELS + 1) / LEVELS)[:, :3]
+    return np.vstack([[0, 0, 0], np.round(colors * 255)]).astype(np.uint8)
+
+
+def fill_gaps(scalar):
+    """
+    Give antialiased edge pixels, which the scalar pass leaves empty, the value of
+    their neighbouring line.
+    """
+    import scipy.ndimage
+    return np.where(scalar == 0, scipy.ndimage.grey_dilation(scalar, size=3), scalar)
+
+
+def recolor(scalar, coverage, table, background=255):
+    """
+    Apply a lookup table to a scalar raster and blend it over the background by the
+    coverage raster, as the contour lines were blended when drawn.
+    """
+    alpha = coverage[..., np.newaxis] / 255
+    rgb = table[scalar] * alpha + background * (1 - alpha)
+    return np.round(rgb).astype(np.uint8)
+
+
+def load_raster(filename):
+    with np.load(filename) as f:
+        return fill_gaps(f['scalar']), f['coverage'], int(f['dpi'])
+
+
+def init_worker(filename):
+    """
+    Pool initializer: each worker reads the raster once, not once per palette.
+    """
+    global _raster
+    _raster = load_raster(filename)
+
+
+def recolor_file(job):
+    from matplotlib import image
+    cmap, out_file = job
+    scalar, coverage, dpi = _raster
+    image.imsave(out_file, recolor(scalar, coverage, lut(cmap)), dpi=dpi)
+    return out_file
+
+
+def recolor_many(raster_file, variants, processes=None):
+    """
+    Write one PNG per (cmap, out_file) in variants from a single scalar raster,
+    recoloring in parallel (one process per core by default).
+    """
+    return Workers.run(recolor_file, variants, processes, init_worker, (raster_file,),
+                       label='palettes')[0]
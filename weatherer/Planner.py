@@ -0,0 +1,97 @@
+from __future__ import division
+
+import copy
+
+import numpy as np
+
+DEFAULT_MAX_BYTES = 128 * 2 ** 20  # per request
+DEFAULT_LATENCY = 0.5  # seconds per request
+DEFAULT_BANDWIDTH = 2e6  # bytes per second
+RESPONSE_OVERHEAD = 2048  # DDS header and coordinate maps, roughly
+
+
+class QueryPlan(object):
+    """
+    The requests a QueryParameters will make, with estimated bytes and time, and any
+    month whose hyperslab exceeds max_bytes split into time x latitude chunks.
+
+    Chunks are queries in the usual portable format, so Weatherer.execute_query can
+    run any of them; each belongs to a block (one time range of one month) whose
+    chunks are latitude bands to be stitched back together.  Chunks are ordered by
+    domain URL, then time, then latitude, so consecutive requests read neighbouring
+    parts of the same file.
+    """
+
+    def __init__(self, query_params, max_bytes=DEFAULT_MAX_BYTES,
+                 latency=DEFAULT_LATENCY, bandwidth=DEFAULT_BANDWIDTH):
+        import Access
+        self.name = query_params.query_name
+        self.max_bytes = max_bytes
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunks = []
+        self.blocks = []
+
+        access = Access.get_access()
+        for q in query_params.queries.values():
+            model = access.open(q['domain_url'])
+            var = model[q['measurement']]
+            itemsize = sum(np.dtype(model[m].dtype).itemsize for m in q['measurements'])
+            self.split(q, var.shape, itemsize)
+
+    def split(self, q, shape, itemsize):
+        t0, t1, step = slice(*q['time_indices']).indices(shape[0])
+        i0, i1, __ = slice(*q['lat_indices']).indices(shape[1])
+        j0, j1, __ = slice(*q['lon_indices']).indices(shape[2])
+        frames = len(xrange(t0, t1, step))
+        if frames == 0 or i1 <= i0 or j1 <= j0:
+            return
+
+        row_bytes = (j1 - j0) * itemsize
+        bands = int(np.ceil((i1 - i0) * row_bytes / self.max_bytes))
+        band_rows = int(np.ceil((i1 - i0) / bands))
+        per_chunk = max(1, int(self.max_bytes // (band_rows * row_bytes)))
+
+        for f in xrange(0, frames, per_chunk):
+            block = []
+            n = min(per_chunk, frames - f)
+            for b in xrange(i0, i1, band_rows):
+                chunk = copy.copy(q)
+                chunk['time_indices'] = [t0 + f * step, t0 + (f + n - 1) * step + 1,
+                                         q['time_indices'][2]]
+                chunk['lat_indices'] = [b, min(b + band_rows, i1)]
+                chunk['lon_indices'] = [j0, j1]
+                rows = chunk['lat_indices'][1] - b
+                chunk['estimate'] = {'frames': n,
+                                     'bytes': n * rows * row_bytes + RESPONSE_OVERHEAD}
+                block.append(chunk)
+                self.chunks.append(chunk)
+            self.blocks.append(block)
+
+    @property
+    def requests(self):
+        return len(self.chunks)
+
+    @property
+    def bytes(self):
+        return sum(c['estimate']['bytes'] for c in self.chunks)
+
+    @property
+    def frames(self):
+        return sum(c['estimate']['frames'] for b in self.blocks for c in b[:1])
+
+    @property
+    def seconds(self):
+        return self.requests * self.latency + self.bytes / self.bandwidth
+
+    def summary(self):
+        return {'query': self.name, 'requests': self.requests, 'frames': self.frames,
+                'bytes': self.bytes, 'seconds': self.seconds,
+                'largest': max([c['estimate']['bytes'] for c in self.chunks] or [0])}
+
+    def report(self):
+        s = self.summary()
+        return '%-60s %5d req %7d frames %9.1f MB (max %6.1f MB) %8.1f s' % (
+            s['query'], s['requests'], s['frames'], s['bytes'] / 2 ** 20,
+            s['largest'] / 2 ** 20, s['seconds'])
+
@@ -1,10 +1,12 @@
 import datetime
+import hashlib
 from collections import OrderedDict
 
-import netCDF4
 import numpy as np
 from dateutil.relativedelta import relativedelta
 
+from Datasets import bilinear_weights
+
 DEFAULT_START = datetime.datetime(1979, 1, 1)
 DEFAULT_END = datetime.datetime(1989, 1, 1)
 DEFAULT_STEP = 'monthly'
@@ -13,10 +15,37 @@ DEFAULT_BOX = [35., 45., -117., -107.]
 USA_BOX = [24., 50., -133., -65.]
 WA_BOX = [45., 51., -125., -116.]
 DEFAULT_DATA = 'tcdc'
+NOMADS_URL = 'http://nomads.ncdc.noaa.gov/dods/NCEP_NARR'
 DEFAULT_URL = 'http://nomads.ncdc.noaa.gov/dods/NCEP_NARR_DAILY/200001/200001/' \
               'narr-a_221_200001dd_hh00_000'
 
 
+def measure_name(measure):
+    """
+    A measure, or a list of measures fetched together, as it appears in query names.
+    """
+    return '+'.join(measure) if isinstance(measure, (list, tuple)) else measure
+
+
+def server_name(server):
+    """
+    Name suffix for data from a server other than NOMADS (a mirror or the offline
+    stand-in), so it never shares query names, pickles or artifacts with NOMADS data;
+    '' for NOMADS itself.
+    """
+    if server in (None, NOMADS_URL):
+        return ''
+    return 'srv' + hashlib.md5(server).hexdigest()[:6]
+
+
+def points_name(points):
+    """
+    Name suffix identifying a set of query points ([[lat, lon], ...]).
+    """
+    points = np.asarray(points, float).reshape(-1, 2)
+    return '%dpts%s' % (len(points), hashlib.md5(points.tobytes()).hexdigest()[:8])
+
+
 def get_month_span(start, end):
     return (end.year - start.year) * 12 + (end.month - start.month)
 
@@ -26,28 +55,48 @@ class QueryParameters:
     This class holds and generates the parameters needed to send a complete query to the
     NOMADS NCDC database, most importantly the correct time, geographic,
     and observation domains.
+
+    measure may also be a list of measures, which are then fetched together (see
+    Weatherer.execute_multi_query).
+
+    If points ([[lat, lon], ...]) are given, the query is for point time series
+    instead of a box: each query then carries the 2x2 interpolation stencil of every
+    point rather than a padded tile.
+
+    time_step > 1 keeps only every time_step-th time of each domain (used for previews).
     """
 
     def __init__(self,
                  time_start=DEFAULT_START, time_end=DEFAULT_END,
                  time_resolution=DEFAULT_STEP, geo_range=WA_BOX,
-                 measure=DEFAULT_DATA, state='NA'):
+                 measure=DEFAULT_DATA, state='NA', server=NOMADS_URL, points=None,
+                 time_step=None):
+
+        self.points = None
+        if points is not None:
+            self.points = np.asarray(points, float).reshape(-1, 2)
+            geo_range = [self.points[:, 0].min(), self.points[:, 0].max(),
+                         self.points[:, 1].min(), self.points[:, 1].max()]
 
         self.time_start = time_start
         self.time_end = time_end
         self.time_resolution = time_resolution
+        self.time_step = time_step if time_step > 1 else None
         self.geo_range = geo_range
         self.state = state
-        self.measure = measure
+        self.measures = list(measure) if isinstance(measure, (list, tuple)) else [measure]
+        self.measure = measure_name(measure)
 
         self.months = get_month_span(self.time_start, self.time_end)
-        self.master_url = 'http://nomads.ncdc.noaa.gov/dods/NCEP_NARR'
+        self.server = server
+        self.master_url = server
 
         self.domain_urls = []
         self.time_indices = []
         self.models = []
         self.lat_indices, self.lon_indices = [], []
         self.geo_range_indices = []
+        self.point_indices = []
         self.query_name = ''
         self.queries = OrderedDict()
 
@@ -116,37 +165,43 @@ class QueryParameters:
                     self.time_indices.append([None, None])
 
                 # And the final month has no bound on the left side
-                self.time_indices.append([None, (self.time_start.day - 1) * 8])
+                self.time_indices.append([None, (self.time_end.day - 1) * 8])
 
             for i, td in enumerate(self.time_indices):
                 if self.time_resolution in ['daily']:
                     # Should include 'aggregate' variable, but for now let 'daily' imply
                     # an aggregate of the 8 hourly periods
-                    self.time_indices[i].append(None)
+                    self.time_indices[i].append(self.time_step)
                 else:
-                    self.time_indices[i].append(None)
+                    self.time_indices[i].append(self.time_step)
         # Monthly is contained in a single domain
         elif self.time_resolution in ['monthly']:
             start = get_month_span(datetime.datetime(1979, 1, 1), self.time_start)
             end = start + get_month_span(self.time_start, self.time_end)
-            self.time_indices.append([start, end + 1, None])
+            self.time_indices.append([start, end + 1, self.time_step])
 
         return
 
     def get_models(self):
         """
-        Connect to each model in the measurement period via netCDF4.
+        Describe each model in the measurement period via the shared data-access layer,
+        which downloads each URL's metadata only once.
         """
+        import Access
+        access = Access.get_access()
         for url_date in self.domain_urls:
-            self.models.append(netCDF4.Dataset(url_date))
+            self.models.append(access.open(url_date))
 
     def get_indices(self):
         """
         Retrieve latitude and longitude ranges for each model in the measurement period.
         """
-        for m in self.models:
-            self.lat_indices.append(m.variables[u'lat'][:])
-            self.lon_indices.append(m.variables[u'lon'][:])
+        import Access
+        access = Access.get_access()
+        for url_date in self.domain_urls:
+            lat, lon = access.coordinates(url_date)
+            self.lat_indices.append(lat)
+            self.lon_indices.append(lon)
 
     def set_geo_range_indices(self):
         """
@@ -154,6 +209,13 @@ class QueryParameters:
         """
         gr = self.geo_range
         for la, lo in zip(self.lat_indices, self.lon_indices):
+            if self.points is not None:
+                i, j, wy, wx = bilinear_weights(la, lo, self.points[:, 0],
+                                                self.points[:, 1])
+                self.point_indices.append({'i': i, 'j': j, 'wy': wy, 'wx': wx})
+                self.geo_range_indices.append([i.min(), i.max() + 2,
+                                               j.min(), j.max() + 2])
+                continue
             indices = [np.abs(la - gr[0]).argmin() - 4,
                        np.abs(la - gr[1]).argmin() + 4,
                        np.abs(lo - gr[2]).argmin() - 4,
@@ -166,13 +228,16 @@ class QueryParameters:
         """
         for i, date in enumerate(self.domain_urls):
             self.queries[date] = {'geo_range': self.geo_range,
-                                  'measurement': self.measure,
+                                  'measurement': self.measures[0],
+                                  'measurements': self.measures,
                                   'domain_url': self.domain_urls[i],
                                   'time_indices': self.time_indices[i],
                                   'time_resolution': self.time_resolution,
                                   'lat_indices': self.geo_range_indices[i][0:2],
                                   'lon_indices': self.geo_range_indices[i][2:4]
                                   }
+            if self.points is not None:
+                self.queries[date]['points'] = self.point_indices[i]
 
     def set_query_name(self):
         """
@@ -185,6 +250,12 @@ class QueryParameters:
                   self.state,
                   str(int(self.geo_range[0])) + "," + str(int(self.geo_range[2])),
                   str(int(self.geo_range[1])) + "," + str(int(self.geo_range[3]))]
+        if self.time_step is not None:
+            string.append('every%d' % self.time_step)
+        if self.points is not None:
+            string.append(points_name(self.points))
+        if server_name(self.server):
+            string.append(server_name(self.server))
 
         self.query_name = '_'.join(string)
 
@@ -199,11 +270,17 @@ class QueryParameters:
         """
         string = [d['time_start'].strftime("%Y%m%d"),
                   d['time_end'].strftime("%Y%m%d"),
-                  d['measure'],
+                  measure_name(d['measure']),
                   d['time_resolution'],
                   d['state'],
                   str(int(d['geo_range'][0])) + "," + str(int(d['geo_range'][2])),
                   str(int(d['geo_range'][1])) + "," + str(int(d['geo_range'][3]))]
+        if d.get('time_step') > 1:
+            string.append('every%d' % d['time_step'])
+        if d.get('points') is not None:
+            string.append(points_name(d['points']))
+        if server_name(d.get('server')):
+            string.append(server_name(d['server']))
 
         query_name = '_'.join(string)
         return query_name
@@ -7,8 +7,13 @@ import wand.color
 import wand.display
 import wand.image
 
+import Workers
+
 dest = os.path.join('.', 'outputs', 'visualizations')
 sample_file = "_tcdc_Greys_4xzoom_0.25px_150dpi_0.25in_bleed_1.0in_border_outline.png"
+CIRCLE_MASK = 'circle_mask_no_aa.png'
+
+_circle_mask = None
 
 
 def make_mask(mask_dir, mask_file):
@@ -21,32 +26,43 @@ def make_mask(mask_dir, mask_file):
     :return:
     :rtype:
     """
-    with wand.image.Image(filename=mask_dir + '/' + mask_file) as img:
+    with wand.image.Image(filename=os.path.join(mask_dir, mask_file)) as img:
+        # This fuzz value (120) minimizes the appearance of blue without clipping the
+        # outside portion of the border.  Determined empirically.
         with wand.color.Color('#0000FF') as blue:
             img.transparent_color(blue, alpha=0.0, fuzz=120)
-        img.save(filename=mask_dir + '/' + 'mask.png')
+        img.save(filename=os.path.join(mask_dir, 'mask.png'))
+    return os.path.join(mask_dir, 'mask.png')
 
 
-def make_masks(mask_dir):
-    for sub_dir in os.walk(mask_dir, topdown=False):
-        if 'mask.png' in sub_dir[2]:
-            print 'already created mask, continuing...'
-            continue
-        if len(sub_dir[2]) == 0:
-            print 'no files in sub_dir, please generate at least one for masking'
-            continue
+def mask_source(files):
+    """
+    The image a directory's mask is cut from: its outline render if there is one.
+    """
+    outlines = [f for f in files if f.endswith('_outline.png')]
+    return (outlines or files)[0]
 
-        print sub_dir
-        with wand.image.Image(filename=sub_dir[0] + '/' + sub_dir[2][0]) as img:
-            with wand.color.Color('#0000FF') as white:
-                img.transparent_color(white, alpha=0.0, fuzz=120)
-            img.save(filename=sub_dir[0] + '/' + 'mask.png')
-            # with wand.image.Image(filename=dir + '/' + file) as img:
-            #     with wand.color.Color('#0000FF') as blue:
-            #         # This fuzz value (120) minimizes the appearance of blue without clipping the
-            #         # outside portion of the border.  Determined empirically.
-            #         img.transparent_color(blue, alpha=0.0, fuzz=120)
-            #     img.save(filename=dir + '/' + 'test_mask_' + str(120) + '.png')
+
+def mask_job(job):
+    return make_mask(*job)
+
+
+def make_masks(mask_dir, processes=None, force=False):
+    """
+    Make the mask.png of every directory under mask_dir, in parallel, skipping those
+    that already have one (they may have been touched up by hand) unless force.
+    """
+    jobs = []
+    for path, dirs, files in os.walk(mask_dir, topdown=False):
+        files = sorted(f for f in files if f != 'mask.png')
+        if not files:
+            if not dirs:
+                print 'no files in %s, please generate at least one for masking' % path
+            continue
+        jobs.append((path, mask_source(files)))
+    return Workers.run(mask_job, jobs, processes, label='masks',
+                       skip=lambda j: not force and
+                       os.path.exists(os.path.join(j[0], 'mask.png')))
 
 
 def build_canvas(width, height, dpi, mask_file, source_file, file_dir, out_file,
@@ -192,17 +208,41 @@ def build_canvas(width, height, dpi, mask_file, source_file, file_dir, out_file,
         source.close()
 
 
-def crop(directory):
-    for fname in os.listdir(directory):
-        new_name = fname[11:fname.find("_4x")] + '_swatch.png'
-        with wand.image.Image(filename=dest + '/' + fname) as img:
-            img.crop(left=787, top=509, width=465, height=464)
-            with wand.image.Image(filename=directory + '\\' +
-                    'circle_mask_no_aa.png') as mask:
-                img.composite(mask, top=0, left=0)
-            with wand.color.Color('#000000') as black:
-                img.transparent_color(black, alpha=0.0, fuzz=0)
-            img.save(filename=dest + '/' + new_name)
+def swatch_name(fname):
+    return fname[11:fname.find("_4x")] + '_swatch.png'
+
+
+def init_crop(mask_file):
+    """
+    Pool initializer: each worker loads the circle mask once, not once per swatch.
+    """
+    global _circle_mask
+    _circle_mask = wand.image.Image(filename=mask_file)
+
+
+def crop_file(job):
+    src, out_file = job
+    with wand.image.Image(filename=src) as img:
+        img.crop(left=787, top=509, width=465, height=464)
+        img.composite(_circle_mask, top=0, left=0)
+        with wand.color.Color('#000000') as black:
+            img.transparent_color(black, alpha=0.0, fuzz=0)
+        img.save(filename=out_file)
+    return out_file
+
+
+def crop(directory, out_dir=dest, mask_file=None, processes=None):
+    """
+    Cut a circular swatch out of every image in directory into out_dir, in parallel,
+    skipping swatches newer than both their image and the mask.
+    """
+    mask_file = mask_file or os.path.join(directory, CIRCLE_MASK)
+    jobs = [(os.path.join(directory, f), os.path.join(out_dir, swatch_name(f)))
+            for f in sorted(os.listdir(directory))
+            if f.endswith('.png') and f != CIRCLE_MASK and not f.endswith('_swatch.png')]
+    return Workers.run(crop_file, jobs, processes, init_crop, (mask_file,),
+                       label='swatches',
+                       skip=lambda j: not Workers.is_stale(j[1], j[0], mask_file))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,322 @@
+from __future__ import division
+
+import calendar
+import datetime
+import multiprocessing
+import re
+import time
+from collections import OrderedDict
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer, \
+    make_server
+
+import numpy as np
+from pydap.handlers.lib import BaseHandler
+from pydap.model import BaseType, DatasetType, GridType
+
+# The NOMADS GrADS server exposes the NARR 221 grid on regular latitude/longitude
+# axes.  The stand-in uses the same 3/16 degree spacing that Gmaps.get_route snaps to.
+GRID_RESOLUTION = 3 / 16
+GRID_LAT = np.arange(10., 70. + GRID_RESOLUTION, GRID_RESOLUTION)
+GRID_LON = np.arange(-150., -50. + GRID_RESOLUTION, GRID_RESOLUTION)
+MISSING_VALUE = 9.999e20
+STEPS_PER_DAY = 8
+MONTHLY_START = datetime.datetime(1979, 1, 1)
+MONTHLY_END = datetime.datetime(2016, 12, 1)
+
+# measure: (long_name, units, mean, amplitude)
+MEASURES = OrderedDict([
+    ('tcdc', ('total cloud cover [%]', '%', 50., 50.)),
+    ('tmp2m', ('temperature at 2 m [k]', 'K', 285., 20.)),
+    ('ugrd10m', ('u-component of wind at 10 m [m/s]', 'm/s', 0., 10.)),
+    ('vgrd10m', ('v-component of wind at 10 m [m/s]', 'm/s', 0., 10.)),
+    ('apcpsfc', ('total precipitation [kg/m^2]', 'kg/m^2', 2., 2.)),
+])
+
+DAILY_PATH = re.compile(r'/dods/NCEP_NARR_DAILY/(\d{4})(\d{2})/\d{6}/narr-a_221_\d{6}dd_hh00_000$')
+MONTHLY_PATH = re.compile(r'/dods/NCEP_NARR_MONTHLY_AGGREGATIONS/narrmon-a_221_complete$')
+
+
+def to_grads_time(date):
+    """
+    Encode a datetime the way the NOMADS GrADS server does ("days since 1-1-1"), i.e.
+    the inverse of the decoding performed in Datasets.Result.
+    """
+    return date.toordinal() + 1 + (date.hour + date.minute / 60) / 24
+
+
+def month_times(month):
+    """
+    3-hourly GrADS times covering the calendar month beginning at month.
+    """
+    days = calendar.monthrange(month.year, month.month)[1]
+    base = to_grads_time(month)
+    return base + np.arange(days * STEPS_PER_DAY) / STEPS_PER_DAY
+
+
+def monthly_times(start=MONTHLY_START, end=MONTHLY_END):
+    """
+    GrADS times for each month of the monthly aggregation, inclusive of end.
+    """
+    times = []
+    t = start
+    while t <= end:
+        times.append(to_grads_time(t))
+        t = (t + datetime.timedelta(days=32)).replace(day=1)
+    return np.array(times)
+
+
+class SyntheticField(object):
+    """
+    A lazily evaluated (time, lat, lon) array of smooth, deterministic weather-like
+    values.  Only the requested hyperslab is ever computed, so a full 221-grid month
+    can be served without materializing it.
+    """
+
+    def __init__(self, measure, time, lat, lon, dtype='>f4'):
+        self.measure = measure
+        self.time = time
+        self.lat = lat
+        self.lon = lon
+        self.dtype = np.dtype(dtype)
+        self.shape = (len(time), len(lat), len(lon))
+        self.ndim = 3
+        self.phase = sum(ord(c) for c in measure) % 17
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        axes = [np.arange(n)[k] for n, k in zip(self.shape, key)]
+        t = self.time[axes[0]]
+        la = np.radians(self.lat[axes[1]])
+        lo = np.radians(self.lon[axes[2]])
+
+        t3 = np.reshape(t, (-1, 1, 1))
+        la3 = np.reshape(la, (1, -1, 1))
+        lo3 = np.reshape(lo, (1, 1, -1))
+
+        __, __, mean, amp = MEASURES[self.measure]
+        season = np.cos(2 * np.pi * (t3 % 365.25) / 365.25 + self.phase)
+        drift = 2 * np.pi * t3 / 7.
+        field = (0.5 * np.sin(6 * la3 + drift) * np.cos(5 * lo3 - drift / 2 + self.phase) +
+                 0.3 * season * np.cos(la3) +
+                 0.2 * np.sin(11 * lo3 + 3 * la3 + drift / 3))
+        out = (mean + amp * field).astype(self.dtype)
+
+        squeeze = tuple(i for i, k in enumerate(key) if isinstance(k, (int, long, np.integer)))
+        if squeeze:
+            out = out.reshape([s for i, s in enumerate(out.shape) if i not in squeeze])
+        return out
+
+
+def build_dataset(name, time, lat=GRID_LAT, lon=GRID_LON, measures=MEASURES):
+    """
+    Assemble a pydap DatasetType shaped like a NOMADS NARR endpoint: 1-D time, lat
+    and lon axes plus one (time, lat, lon) Grid per measure.
+    """
+    time_attrs = {'units': 'days since 1-1-1 00:00:0.0', 'long_name': 'time'}
+    lat_attrs = {'units': 'degrees_north', 'long_name': 'latitude'}
+    lon_attrs = {'units': 'degrees_east', 'long_name': 'longitude'}
+
+    ds = DatasetType(name)
+    ds['time'] = BaseType('time', np.asarray(time, '>f8'), attributes=time_attrs)
+    ds['lat'] = BaseType('lat', np.asarray(lat, '>f8'), attributes=lat_attrs)
+    ds['lon'] = BaseType('lon', np.asarray(lon, '>f8'), attributes=lon_attrs)
+
+    for m in measures:
+        long_name, units, __, __ = MEASURES[m]
+        attrs = {'long_name': long_name, 'units': units,
+                 'missing_value': MISSING_VALUE}
+        grid = GridType(m, attributes=attrs)
+        grid[m] = BaseType(m, SyntheticField(m, ds['time'].data, ds['lat'].data,
+                                             ds['lon'].data),
+                           dimensions=('time', 'lat', 'lon'), attributes=attrs)
+        grid['time'] = BaseType('time', ds['time'].data, attributes=time_attrs)
+        grid['lat'] = BaseType('lat', ds['lat'].data, attributes=lat_attrs)
+        grid['lon'] = BaseType('lon', ds['lon'].data, attributes=lon_attrs)
+        ds[m] = grid
+    return ds
+
+
+class Throttle(object):
+    """
+    WSGI middleware adding a fixed latency per request and a bandwidth cap (bytes per
+    second) to response bodies, while counting requests and bytes served.  Counters
+    live in shared memory so they can be read from outside the serving process.
+
+    Bodies are buffered so that every response carries a Content-Length, which lets
+    HTTP/1.1 clients keep their connections alive.
+    """
+
+    def __init__(self, app, latency=0., bandwidth=None, chunk_size=64 * 1024):
+        self.app = app
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.requests = multiprocessing.Value('l', 0)
+        self.bytes_sent = multiprocessing.Value('l', 0)
+        self.connections = multiprocessing.Value('l', 0)
+
+    def __call__(self, environ, start_response):
+        with self.requests.get_lock():
+            self.requests.value += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        response = []
+
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers]
+
+        body = ''.join(self.app(environ, capture))
+        status, headers = response
+        headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+        start_response(status, headers + [('Content-Length', str(len(body)))])
+        return self.stream(body)
+
+    def stream(self, body):
+        for i in xrange(0, len(body), self.chunk_size):
+            chunk = body[i:i + self.chunk_size]
+            if self.bandwidth:
+                time.sleep(len(chunk) / self.bandwidth)
+            with self.bytes_sent.get_lock():
+                self.bytes_sent.value += len(chunk)
+            yield chunk
+
+    def reset(self):
+        for counter in [self.requests, self.bytes_sent, self.connections]:
+            with counter.get_lock():
+                counter.value = 0
+
+
+class NarrApp(object):
+    """
+    WSGI application answering DAP2 requests (.dds, .das, .dods, ...) for the daily and
+    monthly NARR URL layouts produced by QueryParameters.set_master_url.
+    """
+
+    def __init__(self, lat=GRID_LAT, lon=GRID_LON, measures=MEASURES):
+        self.lat = lat
+        self.lon = lon
+        self.measures = measures
+        self.datasets = {}
+
+    def get_dataset(self, path):
+        if path in self.datasets:
+            return self.datasets[path]
+
+        daily = DAILY_PATH.match(path)
+        if daily is not None:
+            month = datetime.datetime(int(daily.group(1)), int(daily.group(2)), 1)
+            time_axis = month_times(month)
+        elif MONTHLY_PATH.match(path):
+            time_axis = monthly_times()
+        else:
+            return None
+
+        ds = build_dataset(path.rsplit('/', 1)[-1], time_axis, self.lat, self.lon,
+                           self.measures)
+        self.datasets[path] = ds
+        return ds
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        base = path.rsplit('.', 1)[0] if '.' in path.rsplit('/', 1)[-1] else path
+        ds = self.get_dataset(base)
+        if ds is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['No such dataset: ' + path]
+        return BaseHandler(ds)(environ, start_response)
+
+
+class QuietHandler(WSGIRequestHandler):
+    """
+    Quiet request handler that serves successive HTTP/1.1 requests on one connection.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        connections = self.server.get_app().connections
+        with connections.get_lock():
+            connections.value += 1
+        self.close_connection = 0
+        while not self.close_connection:
+            self.raw_requestline = self.rfile.readline(65537)
+            if not self.raw_requestline or not self.parse_request():
+                return
+            handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(),
+                                    self.get_environ())
+            handler.request_handler = self
+            handler.http_version = '1.1'
+            handler.run(self.server.get_app())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class NarrStandIn(object):
+    """
+    A local, offline stand-in for the NOMADS NARR OPeNDAP server.
+
+    The server runs in a child process: netCDF4 holds the GIL while it talks to the
+    network, so a server thread in the same interpreter would deadlock.
+
+    Usage:
+        with NarrStandIn(latency=0.05, bandwidth=2e6) as server:
+            qp = QueryParameters(..., server=server.url)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0., bandwidth=None,
+                 lat=GRID_LAT, lon=GRID_LON, measures=MEASURES):
+        self.app = Throttle(NarrApp(lat, lon, measures), latency, bandwidth)
+        self.server = make_server(host, port, self.app, server_class=ThreadingWSGIServer,
+                                  handler_class=QuietHandler)
+        self.host, self.port = self.server.server_address
+        self.url = 'http://%s:%d/dods/NCEP_NARR' % (self.host, self.port)
+        self.process = None
+
+    @property
+    def requests(self):
+        return self.app.requests.value
+
+    @property
+    def bytes_sent(self):
+        return self.app.bytes_sent.value
+
+    @property
+    def connections(self):
+        return self.app.connections.value
+
+    def reset(self):
+        self.app.reset()
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self.server.serve_forever)
+        self.process.daemon = True
+        self.process.start()
+        return self
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    s = NarrStandIn(port=8080)
+    print 'serving synthetic NARR at ' + s.url
+    s.server.serve_forever()
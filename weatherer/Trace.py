@@ -0,0 +1,196 @@
+from __future__ import division
+
+import json
+import os
+import resource
+import threading
+import time
+from collections import OrderedDict
+
+
+def cpu_time():
+    t = os.times()
+    return t[0] + t[1]
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process, in bytes (Linux reports kilobytes).
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage(object):
+    """
+    A single timed span of a run, with any counters (bytes, frames, ...) reported
+    while it was the innermost open stage.
+    """
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.counters = {}
+        self.tid = threading.current_thread().ident
+        self.start = self.wall = self.cpu = 0.
+        self.rss_start = self.peak_rss = 0
+
+    def __enter__(self):
+        self.tracer.push(self)
+        self.rss_start = peak_rss()
+        self.cpu = cpu_time()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.time() - self.start
+        self.cpu = cpu_time() - self.cpu
+        self.peak_rss = peak_rss()
+        self.tracer.pop(self)
+
+    def count(self, **counters):
+        for k, v in counters.iteritems():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+    def to_dict(self):
+        return {'name': self.name, 'start': self.start - self.tracer.epoch,
+                'wall': self.wall, 'cpu': self.cpu, 'peak_rss': self.peak_rss,
+                'rss_growth': self.peak_rss - self.rss_start,
+                'counters': self.counters, 'args': self.args}
+
+
+class Tracer(object):
+    """
+    Collects Stages for one run and exports them as structured JSON or as Chrome trace
+    events (load the latter in chrome://tracing or Perfetto).
+    """
+
+    def __init__(self):
+        self.epoch = time.time()
+        self.stages = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def push(self, s):
+        self.stack().append(s)
+
+    def pop(self, s):
+        self.stack().remove(s)
+        with self.lock:
+            self.stages.append(s)
+
+    def stage(self, name, **args):
+        return Stage(self, name, args)
+
+    def count(self, **counters):
+        st = self.stack()
+        if st:
+            st[-1].count(**counters)
+
+    def summary(self):
+        """
+        Totals per stage name, in order of first appearance.
+        """
+        out = OrderedDict()
+        for s in sorted(self.stages, key=lambda x: x.start):
+            agg = out.setdefault(s.name, {'calls': 0, 'wall': 0., 'cpu': 0., 'peak_rss': 0,
+                                          'counters': {}})
+            agg['calls'] += 1
+            agg['wall'] += s.wall
+            agg['cpu'] += s.cpu
+            agg['peak_rss'] = max(agg['peak_rss'], s.peak_rss)
+            for k, v in s.counters.iteritems():
+                agg['counters'][k] = agg['counters'].get(k, 0) + v
+        return out
+
+    def report(self):
+        lines = ['%-14s %5s %9s %9s %9s  %s' % ('stage', 'calls', 'wall s', 'cpu s',
+                                               'rss MB', 'counters')]
+        for name, agg in self.summary().iteritems():
+            lines.append('%-14s %5d %9.3f %9.3f %9.1f  %s' % (
+                name, agg['calls'], agg['wall'], agg['cpu'], agg['peak_rss'] / 2 ** 20,
+                ', '.join('%s=%d' % kv for kv in sorted(agg['counters'].items()))))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return {'stages': [s.to_dict() for s in sorted(self.stages, key=lambda x: x.start)],
+                'summary': self.summary()}
+
+    def to_chrome(self):
+        pid = os.getpid()
+        events = []
+        for s in sorted(self.stages, key=lambda x: x.start):
+            args = dict(s.args)
+            args.update(s.counters)
+            args.update(cpu_s=s.cpu, peak_rss=s.peak_rss)
+            events.append({'name': s.name, 'ph': 'X', 'pid': pid, 'tid': s.tid,
+                           'ts': (s.start - self.epoch) * 1e6, 'dur': s.wall * 1e6,
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, filename, fmt=None):
+        """
+        Write the trace; fmt is 'json' or 'chrome', inferred from the filename if None.
+        """
+        if fmt is None:
+            fmt = 'chrome' if filename.endswith('.trace.json') else 'json'
+        data = self.to_chrome() if fmt == 'chrome' else self.to_json()
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=1, default=str)
+
+
+class NullStage(object):
+    """
+    Shared do-nothing stage, so that tracing costs one attribute lookup when disabled.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def count(self, **counters):
+        pass
+
+
+NULL_STAGE = NullStage()
+
+
+class NullTracer(object):
+    def stage(self, name, **args):
+        return NULL_STAGE
+
+    def count(self, **counters):
+        pass
+
+
+TRACER = NullTracer()
+
+
+def enable():
+    """
+    Start tracing a new run, returning its Tracer.
+    """
+    global TRACER
+    TRACER = Tracer()
+    return TRACER
+
+
+def disable():
+    global TRACER
+    tracer, TRACER = TRACER, NullTracer()
+    return tracer
+
+
+def stage(name, **args):
+    return TRACER.stage(name, **args)
+
+
+def count(**counters):
+    TRACER.count(**counters)
@@ -0,0 +1,262 @@
+from __future__ import division
+
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+POINTS_PER_INCH = 72
+
+
+def simplify(points, tol):
+    """
+    Douglas-Peucker simplification of an (n x 2) polyline: drop every vertex that is
+    within tol of the chord between the vertices kept around it.
+    """
+    n = len(points)
+    if n < 3:
+        return points
+    keep = np.zeros(n, bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        chord = points[b] - points[a]
+        rel = points[a + 1:b] - points[a]
+        length = np.hypot(chord[0], chord[1])
+        if length == 0:
+            d = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            d = np.abs(chord[0] * rel[:, 1] - chord[1] * rel[:, 0]) / length
+        k = d.argmax()
+        if d[k] > tol:
+            k += a + 1
+            keep[k] = True
+            stack.extend([(a, k), (k, b)])
+    return points[keep]
+
+
+def unique_segments(polylines, grid):
+    """
+    Snap polylines to a grid of the given spacing and return their distinct
+    segments as an (m x 4) int array of x0, y0, x1, y1, whatever their direction.
+    Segments that collapse to a point are dropped.
+    """
+    segments = []
+    for line in polylines:
+        q = np.round(np.asarray(line) / grid).astype(np.int64)
+        if len(q) > 1:
+            segments.append(np.hstack([q[:-1], q[1:]]))
+    if not segments:
+        return np.zeros((0, 4), np.int64)
+    s = np.ascontiguousarray(np.vstack(segments))
+    s = s[(s[:, 0] != s[:, 2]) | (s[:, 1] != s[:, 3])]
+    # Orient every segment the same way so reversed duplicates coincide
+    flip = (s[:, 0] > s[:, 2]) | ((s[:, 0] == s[:, 2]) & (s[:, 1] > s[:, 3]))
+    s[flip] = s[flip][:, [2, 3, 0, 1]]
+    return np.unique(s.view([('', s.dtype)] * 4)).view(s.dtype).reshape(-1, 4)
+
+
+def chain(segments):
+    """
+    Join segments sharing endpoints into as few polylines as possible.
+    """
+    ends = {}
+    for k, (x0, y0, x1, y1) in enumerate(segments.tolist()):
+        ends.setdefault((x0, y0), []).append(k)
+        ends.setdefault((x1, y1), []).append(k)
+    used = np.zeros(len(segments), bool)
+    points = [((s[0], s[1]), (s[2], s[3])) for s in segments.tolist()]
+
+    def walk(line):
+        # Extend line (a list of points) from its last point while segments remain
+        while True:
+            tip = line[-1]
+            nxt = [j for j in ends[tip] if not used[j]]
+            if not nxt:
+                return line
+            j = nxt[0]
+            used[j] = True
+            a, b = points[j]
+            line.append(b if a == tip else a)
+
+    lines = []
+    for k in xrange(len(segments)):
+        if used[k]:
+            continue
+        used[k] = True
+        forward = walk(list(points[k]))
+        backward = walk([points[k][0]])
+        lines.append(np.array(backward[::-1] + forward[1:]))
+    return lines
+
+
+def densify(points, step):
+    """
+    Resample a polyline so that consecutive points are at most step apart.
+    """
+    d = np.hypot(*np.diff(points, axis=0).T)
+    s = np.concatenate([[0.], np.cumsum(d)])
+    if s[-1] == 0:
+        return points[:1]
+    t = np.append(np.arange(0., s[-1], step), s[-1])
+    return np.column_stack([np.interp(t, s, points[:, 0]), np.interp(t, s, points[:, 1])])
+
+
+def cells(line, shape, cell):
+    """
+    Grid indices (i, j) of the cells of size cell that a densified line crosses.
+    """
+    i = np.clip((line[:, 1] / cell).astype(int), 0, shape[0] - 1)
+    j = np.clip((line[:, 0] / cell).astype(int), 0, shape[1] - 1)
+    return i, j
+
+
+def uncovered_runs(line, covered, cell):
+    """
+    Split a densified line into the runs that do not cross cells already drawn in,
+    then mark the cells it crosses as drawn.
+    """
+    i, j = cells(line, covered.shape, cell)
+    fresh = ~covered[i, j]
+    covered[i, j] = True
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], fresh.view(np.int8), [0]])))
+    return [line[a:b] for a, b in zip(edges[::2], edges[1::2]) if b - a > 1]
+
+
+def scanlines(covered, cell, grid):
+    """
+    The drawn cells as one horizontal stroke per run of cells in each row, in grid
+    units; drawn one cell wide they fill exactly the area the lines covered.
+    """
+    lines = []
+    padded = np.zeros((covered.shape[0], covered.shape[1] + 2), np.int8)
+    padded[:, 1:-1] = covered
+    for i, row in enumerate(np.diff(padded, axis=1)):
+        edges = np.flatnonzero(row)
+        y = (i + 0.5) * cell
+        for a, b in zip(edges[::2], edges[1::2]):
+            lines.append(np.round(np.array([[(a + 0.25) * cell, y],
+                                            [(b - 0.25) * cell, y]]) / grid).astype(int))
+    return lines
+
+
+def count(lines):
+    return sum(len(l) for l in lines)
+
+
+def merge_layers(layers, tol, width, height, cell):
+    """
+    Merge the isolines of every frame, per style, into a compact set of polylines.
+
+    layers is a list of (style, polylines) in output units (points, within width x
+    height); entries sharing a style (e.g. the colour of a contour level) are merged
+    first.  Wherever a line retraces cells of size cell already drawn in its style,
+    as the same isoline does from frame to frame, that stretch is dropped; what
+    remains is snapped to a tol grid, deduplicated segment by segment, re-chained
+    and only then simplified to tol.  Each style is written in whichever of three
+    forms is smallest: those merged lines, the input lines simplified on their own
+    (so the output never has more vertices than the input), or the covered cells as
+    scanlines one cell wide (so it never grows past the size of the grid, however
+    many frames are stacked).
+
+    Returns ({style: (int polylines in grid units, stroke width in grid units or
+    None for the default)}, stats).
+    """
+    grouped = OrderedDict()
+    for style, polylines in layers:
+        grouped.setdefault(style, []).extend(polylines)
+
+    shape = (int(np.ceil(height / cell)) + 1, int(np.ceil(width / cell)) + 1)
+    stats = {'vertices_in': 0, 'vertices_out': 0, 'segments': 0, 'paths': 0}
+    merged = OrderedDict()
+    for style, polylines in grouped.iteritems():
+        covered = np.zeros(shape, bool)
+        pieces, plain = [], []
+        for line in polylines:
+            line = np.asarray(line, float)
+            stats['vertices_in'] += len(line)
+            plain.append(np.round(simplify(line, tol) / tol))
+            pieces.extend(uncovered_runs(densify(line, cell / 2), covered, cell))
+        segments = unique_segments([simplify(r, tol / 2) for r in pieces], tol)
+        forms = [([simplify(l, 1.) for l in chain(segments)], None),
+                 ([l for l in plain if len(l) > 1], None),
+                 (scanlines(covered, cell, tol), cell / tol)]
+        lines, stroke = min(forms, key=lambda f: count(f[0]))
+        if lines:
+            merged[style] = (lines, stroke)
+        stats['segments'] += len(segments)
+        stats['vertices_out'] += count(lines)
+        stats['paths'] += len(lines)
+    return merged, stats
+
+
+def path_data(lines):
+    """
+    SVG path data with integer, relative coordinates.
+    """
+    parts = []
+    for line in lines:
+        line = np.asarray(line, np.int64)
+        steps = np.diff(line, axis=0)
+        parts.append('M%d %d' % tuple(line[0]))
+        parts.append('l' + ' '.join('%d %d' % tuple(s) for s in steps))
+    return ''.join(parts)
+
+
+def hex_color(rgba):
+    return '#%02x%02x%02x' % tuple(int(round(c * 255)) for c in rgba[:3])
+
+
+def write_svg(filename, merged, width, height, grid, stroke_width=1.0):
+    """
+    One path element per style, in a viewBox measured in grid units so that
+    coordinates are small integers.  width and height are in points.
+    """
+    with open(filename, 'w') as f:
+        f.write('<svg xmlns="http://www.w3.org/2000/svg" width="%gpt" height="%gpt" '
+                'viewBox="0 0 %d %d" fill="none" stroke-linecap="round" '
+                'stroke-linejoin="round" stroke-width="%g">\n'
+                % (width, height, int(np.ceil(width / grid)),
+                   int(np.ceil(height / grid)), stroke_width / grid))
+        for rgba, (lines, stroke) in merged.iteritems():
+            line_width = ' stroke-width="%g"' % stroke if stroke else ''
+            f.write('<path stroke="%s" stroke-opacity="%g"%s d="%s"/>\n'
+                    % (hex_color(rgba), rgba[3], line_width, path_data(lines)))
+        f.write('</svg>\n')
+
+
+def write_pdf(filename, merged, width, height, grid, stroke_width=1.0):
+    from matplotlib.backends.backend_pdf import FigureCanvasPdf
+    from matplotlib.collections import LineCollection
+    from matplotlib.figure import Figure
+
+    figure = Figure(figsize=(width / POINTS_PER_INCH, height / POINTS_PER_INCH))
+    FigureCanvasPdf(figure)
+    axis = figure.add_axes([0., 0., 1., 1.])
+    axis.set_axis_off()
+    axis.set_xlim(0, width / grid)
+    axis.set_ylim(height / grid, 0)
+    for rgba, (lines, stroke) in merged.iteritems():
+        line_width = stroke * grid if stroke else stroke_width
+        axis.add_collection(LineCollection(lines, colors=[rgba], linewidths=line_width))
+    figure.savefig(filename)
+
+
+def export(filename, layers, width, height, dpi, stroke_width=1.0):
+    """
+    Write stacked contour layers (see merge_layers; coordinates in points from the
+    top left) to an SVG or PDF of width x height points, simplified to half a pixel
+    at dpi and merged wherever lines overlap within a stroke width.  Returns the
+    vertex statistics.
+    """
+    tol = 0.5 * POINTS_PER_INCH / dpi
+    merged, stats = merge_layers(layers, tol, width, height, max(stroke_width, 2 * tol))
+    if os.path.splitext(filename)[1].lower() == '.pdf':
+        write_pdf(filename, merged, width, height, tol, stroke_width)
+    else:
+        write_svg(filename, merged, width, height, tol, stroke_width)
+    stats['bytes'] = os.path.getsize(filename)
+    return stats
@@ -1,21 +1,44 @@
 import csv
 import os
 import pickle
+import struct
+from collections import OrderedDict
 from datetime import datetime
+from fractions import gcd
+from multiprocessing.pool import ThreadPool
 from shutil import copyfile
 
 import numpy as np
-from pydap.client import open_url
 
+import Artifacts
+import Climatology
+import Gazetteer
 import Gmaps
-import ShapeSVG
-from Datasets import Dataset, Result
-from Draw import Animator
-from Query import QueryParameters
+import Planner
+import Trace
+from Datasets import Cube, Dataset, Result, bilinear_sample
+from Query import USA_BOX, QueryParameters
+
+# pydap, Draw (matplotlib/basemap) and ShapeSVG (wand) are imported inside the
+# stages that use them, so fetch-only and cache commands start quickly.
 
 SAVEDIR = os.path.join('outputs', '_orders')
 VIZ_SUBDIR = 'visualizations'
 
+# Proofs (any flag other than 'order') are rendered straight to this size
+PREVIEW_SIZE = 1000  # px along the longer side
+PREVIEW_CELL_PX = 4  # px per grid cell that still gives smooth contours
+PREVIEW_FRAMES = 120  # stacked frames beyond which a proof looks no different
+
+# Transformed series larger than this are processed in chunks on disk
+CHUNKED_BYTES = 2 ** 30
+SCRATCH_DIR = os.path.join('..', 'outputs', 'scratch')
+
+# Orders served from a shared fetch: order query name -> union QueryParameters,
+# and union query name -> its Dataset once loaded
+_shared_queries = {}
+_shared_datasets = {}
+
 
 def load_requests(csv_file):
     with open(csv_file) as f:
@@ -32,61 +55,661 @@ def load_requests(csv_file):
                  bleed=float(e['bleed']), mat_width=float(e['mat_width']),
                  pad_width=float(e['pad_width']), colorspace=e['colorspace'],
                  height=int(e['height']), dpi=int(e['dpi']), flag=e['flag'],
-                 mat_color=e['mat_color'], pad_color=e['pad_color']))
+                 mat_color=e['mat_color'], pad_color=e['pad_color'],
+                 anomaly=e.get('anomaly') or '', vector=e.get('vector') or ''))
 
         queries.append(dict(time_start=datetime.strptime(e['time_start'], "%Y%m%d"),
                             time_end=datetime.strptime(e['time_end'], "%Y%m%d"),
-                            measure=e['measure'], time_resolution=e['time_resolution'],
+                            measure=e['measure'].split('+') if '+' in e['measure']
+                            else e['measure'], time_resolution=e['time_resolution'],
                             geo_range=e['geo_range'], state=e['state']))
 
     return zip(viz_params, queries)
 
 
 def load_ds(query_params):
+    if query_params.query_name in _shared_queries:
+        return region_ds(query_params)
     if query_params.query_name in os.listdir('../outputs/pickles/'):
         print 'loading saved ds'
         data = pickle.load(open('../outputs/pickles/' + query_params.query_name, 'rb'))
     else:
         print 'generating new ds'
-        data = Dataset(execute_query(query_params.queries))
+        with Trace.stage('fetch', query=query_params.query_name):
+            data = execute_plan(Planner.QueryPlan(query_params))
+            if not isinstance(data, Cube):
+                data = Dataset(data)
+        with Trace.stage('climatology', query=query_params.query_name) as s:
+            s.count(observations=Climatology.record(query_params, first_measure(data)))
         pickle.dump(data, open('../outputs/pickles/' + query_params.query_name, 'wb'))
     return data
 
 
+def first_measure(data):
+    """
+    The Dataset of a single-measure order, or of the first measure of a Cube.
+    """
+    return data.dataset(data.measures[0]) if isinstance(data, Cube) else data
+
+
+def region_ds(query_params):
+    """
+    An order's dataset as a view of the shared fetch covering it (see share_fetches),
+    over exactly the cells its own query would have fetched.
+    """
+    shared = _shared_queries[query_params.query_name]
+    if shared.query_name not in _shared_datasets:
+        _shared_datasets[shared.query_name] = load_ds(shared)
+    q, s = query_params.queries.values()[0], shared.queries.values()[0]
+    rows = slice(q['lat_indices'][0] - s['lat_indices'][0],
+                 q['lat_indices'][1] - s['lat_indices'][0])
+    cols = slice(q['lon_indices'][0] - s['lon_indices'][0],
+                 q['lon_indices'][1] - s['lon_indices'][0])
+    with Trace.stage('region', query=query_params.query_name):
+        return _shared_datasets[shared.query_name].region(rows, cols,
+                                                          query_params.geo_range)
+
+
 def load_query(query_params):
     query_name = QueryParameters.generate_query_name(query_params)
     if query_name in os.listdir('../outputs/ds_queries/'):
         qp = pickle.load(open('../outputs/ds_queries/' + query_name, 'rb'))
     else:
         print 'generating new query'
-        qp = QueryParameters(**query_params)
+        with Trace.stage('query', query=query_name):
+            qp = QueryParameters(**query_params)
         pickle.dump(qp, open('../outputs/ds_queries/' + query_name, 'wb'))
     return qp
 
 
+def query_slabs(access, q):
+    """
+    The time, lat and lon hyperslabs of a month query (time is None if empty).
+    """
+    shape = access.open(q['domain_url'])[q['measurement']].shape
+    return (hyperslab(q['time_indices'], shape[0]),
+            hyperslab(q['lat_indices'] + [None], shape[1]),
+            hyperslab(q['lon_indices'] + [None], shape[2]))
+
+
 def execute_query(queries):
+    import Access
+    access = Access.get_access()
     results = []
     for k, q in queries.iteritems():
-        ti = q['time_indices']
-        la = q['lat_indices']
-        lo = q['lon_indices']
-        model = open_url(q['domain_url'])
-        d = model[q['measurement']][ti[0]:ti[1]:ti[2], la[0]:la[1], lo[0]:lo[1]]
-
-        for i, t in enumerate(d.time):
+        m = q['measurement']
+        ti, la, lo = query_slabs(access, q)
+        if ti is None:
+            continue
+        d = access.fetch(q['domain_url'], m + ti + la + lo)[m]
+        val = np.array(d[m].data)
+        lat, lon = np.array(d['lat'].data), np.array(d['lon'].data)
+
+        for i, t in enumerate(np.array(d['time'].data)):
             try:
                 unit = d.attributes['units']
             except KeyError:
                 unit = 'NA'
-            r = Result(q['geo_range'], q['measurement'], t, q['time_resolution'], unit,
+            r = Result(q['geo_range'], m, t, q['time_resolution'], unit,
                        d.attributes['long_name'], d.attributes['missing_value'],
-                       np.array(d[q['measurement']][i]), np.array(d['lat'][:]),
-                       np.array(d['lon'][:]))
+                       val[i], lat, lon)
             results.append(r)
+            Trace.count(bytes=r.val.nbytes, frames=1)
+    return results
+
+
+def execute_plan(plan):
+    """
+    Run a Planner.QueryPlan chunk by chunk, stitching the latitude bands of each
+    block back into whole frames.  A plan for several measures returns a Cube
+    holding all of them; otherwise a list of Results.
+    """
+    if plan.chunks and len(plan.chunks[0]['measurements']) > 1:
+        return execute_multi_plan(plan)
+    results = []
+    for block in plan.blocks:
+        tiles = [execute_query(OrderedDict([(c['domain_url'], c)])) for c in block]
+        if len(tiles) == 1:
+            results.extend(tiles[0])
+            continue
+        for frames in zip(*tiles):
+            r = frames[0]
+            results.append(Result(r.geo_range, r.measurement, r.time, r.time_resolution,
+                                  r.unit, r.long_name, r.missing_value,
+                                  np.concatenate([f.val for f in frames]),
+                                  np.concatenate([f.lat for f in frames]), r.lon))
     return results
 
 
-def visualize(p, query, prefix=''):
+def execute_multi_plan(plan):
+    times, values, cube = [], OrderedDict(), None
+    for block in plan.blocks:
+        tiles = [execute_multi_query(OrderedDict([(c['domain_url'], c)])) for c in block]
+        cube = tiles[0]
+        times.append(cube.time)
+        for m in cube.measures:
+            values.setdefault(m, []).append(np.concatenate([t.values[m] for t in tiles],
+                                                           axis=1))
+    lat = np.concatenate([t.lat for t in tiles])
+    for m in values:
+        values[m] = np.concatenate(values[m])
+    return Cube(cube.geo_range, cube.time_resolution, np.concatenate(times), lat, cube.lon,
+                values, cube.attributes)
+
+
+def route_weather(start, end, time_start, time_end, measure='tmp2m',
+                  time_resolution='monthly'):
+    """
+    Sample the weather along the driving route from start to end.
+
+    Returns the densified route points and a (route_points x time) array of values,
+    interpolated bilinearly from a single dataset covering the route's bounds.
+    """
+    route, bounds = Gmaps.get_route(start, end)
+    qp = load_query(dict(time_start=time_start, time_end=time_end, measure=measure,
+                         time_resolution=time_resolution, geo_range=list(bounds),
+                         state='route'))
+    dataset = load_ds(qp)
+    dataset.fix_nans()
+    with Trace.stage('sample', points=len(route)):
+        values = dataset.sample(route[:, 0], route[:, 1])
+    return route, values
+
+
+def hyperslab(index, length):
+    """
+    DAP hyperslab ("[start:stride:stop]", stop inclusive) for a [start, stop, step]
+    index as stored in a query, or None if the selection is empty.
+    """
+    start, stop, step = slice(*index).indices(length)
+    if stop <= start:
+        return None
+    return '[%d:%d:%d]' % (start, step, stop - 1)
+
+
+def execute_multi_query(queries):
+    """
+    Fetch every measure of a multi-measure query into a Cube.
+
+    Each month is opened once, and all measures plus the time, lat and lon
+    coordinates come back in a single combined DAP request.
+    """
+    import Access
+    access = Access.get_access()
+    times, values, attributes = [], OrderedDict(), OrderedDict()
+    lat = lon = q = None
+
+    for k, q in queries.iteritems():
+        t, la, lo = query_slabs(access, q)
+        if t is None:
+            continue
+
+        ce = ['time' + t, 'lat' + la, 'lon' + lo]
+        ce += ['%s.%s%s%s%s' % (m, m, t, la, lo) for m in q['measurements']]
+        d = access.fetch(q['domain_url'], ','.join(ce))
+
+        times.append(np.array(d['time'].data))
+        lat, lon = np.array(d['lat'].data), np.array(d['lon'].data)
+        for m in q['measurements']:
+            attributes[m] = d[m].attributes
+            values.setdefault(m, []).append(np.array(d[m][m].data))
+            Trace.count(bytes=values[m][-1].nbytes)
+        Trace.count(frames=len(times[-1]))
+
+    for m in values:
+        values[m] = np.concatenate(values[m])
+    return Cube(q['geo_range'], q['time_resolution'], np.concatenate(times), lat, lon,
+                values, attributes)
+
+
+def stencil_blocks(cells):
+    """
+    Group the 2x2 stencils at cells (lower-left (i, j) indices) whose blocks overlap
+    or touch into rectangles, returning a list of ([i0, i1, j0, j1], cells) with
+    exclusive ends, so neighbouring points are fetched in one hyperslab.
+    """
+    groups = []
+    for c in sorted(set(cells)):
+        rect, members = [c[0], c[0] + 2, c[1], c[1] + 2], [c]
+        while True:
+            near = [g for g in groups if g[0][0] <= rect[1] and rect[0] <= g[0][1] and
+                    g[0][2] <= rect[3] and rect[2] <= g[0][3]]
+            if not near:
+                break
+            for g in near:
+                groups.remove(g)
+                rect = [min(rect[0], g[0][0]), max(rect[1], g[0][1]),
+                        min(rect[2], g[0][2]), max(rect[3], g[0][3])]
+                members = sorted(members + g[1])
+        groups.append((rect, members))
+    return groups
+
+
+def execute_point_query(queries, workers=8):
+    """
+    Fetch point time series for a QueryParameters built with points.
+
+    Only the 2x2 interpolation stencils of the points are requested, one hyperslab
+    per group of touching stencils, and all groups of all month domains are fetched
+    concurrently.  Returns the observation times and a compact (points x time) array.
+    """
+    import Access
+    access = Access.get_access()
+    queries = [q for q in queries.values()
+               if query_slabs(access, q)[0] is not None]
+    pool = ThreadPool(workers)
+
+    def open_domain(q):
+        t = query_slabs(access, q)[0]
+        return t, np.array(access.fetch(q['domain_url'], 'time' + t)['time'].data)
+
+    def fetch_block(job):
+        t, q, (i0, i1, j0, j1) = job
+        m = q['measurement']
+        ce = '%s.%s%s[%d:1:%d][%d:1:%d]' % (m, m, t, i0, i1 - 1, j0, j1 - 1)
+        d = access.fetch(q['domain_url'], ce)[m]
+        val = np.array(d[m].data).astype(float)
+        val[val >= d.attributes['missing_value']] = np.nan
+        return val
+
+    try:
+        domains = pool.map(open_domain, queries)
+        jobs, groups = [], []
+        for (t, __), q in zip(domains, queries):
+            groups.append(stencil_blocks(zip(q['points']['i'], q['points']['j'])))
+            jobs.extend((t, q, rect) for rect, __ in groups[-1])
+        blocks = iter(pool.map(fetch_block, jobs))
+    finally:
+        pool.close()
+
+    times, values, nbytes = [], [], 0
+    for (__, t), q, group in zip(domains, queries, groups):
+        p = q['points']
+        # Cut each point's 2x2 stencil out of its block into a (time x stencil x 2 x 2)
+        # stack and index it as a tiny grid, so the usual bilinear gather applies
+        stencils, lookup = [], {}
+        for (i0, i1, j0, j1), cells in group:
+            block = next(blocks)
+            nbytes += block.nbytes
+            for i, j in cells:
+                lookup[(i, j)] = len(stencils)
+                stencils.append(block[:, i - i0:i - i0 + 2, j - j0:j - j0 + 2])
+        n = np.array([lookup[c] for c in zip(p['i'], p['j'])])
+        cube = np.array(stencils).transpose(1, 0, 2, 3).reshape(len(t), len(stencils) * 2, 2)
+        values.append(bilinear_sample(cube, n * 2, np.zeros_like(n), p['wy'], p['wx']))
+        times.append(t)
+    # The tracer's stage stack is per thread, so count here rather than in the workers
+    Trace.count(bytes=nbytes)
+    return np.concatenate(times), np.concatenate(values, axis=1)
+
+
+def is_preview(p):
+    return p['flag'] not in ('order', 'outline_only')
+
+
+def expected_frames(query_params):
+    """
+    Number of time steps a query will return, estimated from its dates alone.
+    """
+    start, end = query_params['time_start'], query_params['time_end']
+    if query_params['time_resolution'] == 'monthly':
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return max(1, (end - start).days * 8)
+
+
+def preview_time_step(query_params):
+    """
+    Time stride that keeps a proof's fetch to about PREVIEW_FRAMES frames.  The
+    stride is coprime with the data's cycle (12 months, or 8 three-hour periods a
+    day) so the proof samples every month or hour rather than the same few.
+    """
+    cycle = 12 if query_params['time_resolution'] == 'monthly' else 8
+    step = int(np.ceil(expected_frames(query_params) / float(PREVIEW_FRAMES)))
+    while gcd(step, cycle) > 1:
+        step += 1
+    return step
+
+
+def preview_plan(p, dataset):
+    """
+    Decimation, zoom, interpolation and DPI that render dataset at about
+    PREVIEW_SIZE px, never exceeding the order's own settings.
+    """
+    cells = max(len(dataset.lat_array), len(dataset.lon_array))
+    target = PREVIEW_SIZE // PREVIEW_CELL_PX
+    decimate = max(1, -(-cells // target))
+    zoom = max(1, min(p['zoom'], target // -(-cells // decimate)))
+    interpolate = max(1, min(p['interpolate'], PREVIEW_FRAMES // max(1, dataset.length)))
+    return {'decimate': decimate, 'zoom': zoom, 'interpolate': interpolate,
+            'dpi': preview_dpi(p), 'max_size': PREVIEW_SIZE}
+
+
+def preview_dpi(p):
+    """
+    The DPI at which an order's print size comes to about PREVIEW_SIZE px.
+    """
+    return min(p['dpi'], int(np.ceil(PREVIEW_SIZE / float(max(p['width'], p['height'])))))
+
+
+def output_names(p):
+    """
+    The output directory (ending in a separator, so stems append to it) and file
+    stem for an order, creating the directory.  Proofs get their own stem so they
+    never stand in for a full-size render.
+    """
+    output_path = os.path.join(SAVEDIR, VIZ_SUBDIR, p['address'], '')
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    output_filename = '_'.join([p['state'], p['prefix'], p['measure'], p['cmap_name'],
+                                str(p['zoom']) + 'xzoom', str(p['interpolate']) + 'intrp',
+                                p['stroke_width'] + 'px', str(p['dpi']) + 'dpi',
+                                str(p['bleed']) + 'in_bleed',
+                                str(p['mat_width']) + 'in_mat'])
+    if is_preview(p):
+        output_filename += '_preview'
+    return output_path, output_filename
+
+
+def image_orientation(filename):
+    """
+    Orientation of a saved PNG, read from its header without decoding the image.
+    """
+    with open(filename, 'rb') as f:
+        w, h = struct.unpack('>2I', f.read(24)[16:24])
+    return 'landscape' if w > h else 'portrait'
+
+
+def data_file(p):
+    output_path, output_filename = output_names(p)
+    return output_path + output_filename + '.png'
+
+
+def vector_file(p):
+    output_path, output_filename = output_names(p)
+    return output_path + output_filename + '.' + p['vector']
+
+
+def outline_file(p):
+    output_path, output_filename = output_names(p)
+    return output_path + output_filename + '_outline.png'
+
+
+def render_files(p):
+    """
+    The files a render of an order produces: its data image, and its vector
+    export if it asks for one.
+    """
+    return [data_file(p)] + ([vector_file(p)] if p.get('vector') else [])
+
+
+def raster_file(p):
+    """
+    The scalar raster shared by every colormap variant of an order.
+    """
+    output_path, output_filename = output_names(dict(p, cmap_name='raster'))
+    return output_path + output_filename + '.npz'
+
+
+def transformed_bytes(dataset, plan):
+    """
+    Size of the dataset after zoom and interpolation, without computing it.
+    """
+    frame = np.asarray(dataset.results[0].val)
+    rows, cols = frame.shape
+    cells = -(-rows // plan['decimate']) * -(-cols // plan['decimate']) * plan['zoom'] ** 2
+    frames = (dataset.length - 1) * plan['interpolate'] + 1
+    return frames * cells * max(frame.itemsize, 4)
+
+
+def transform(dataset, plan, store=None, zscore=False, scratch=None):
+    """
+    Apply a render plan (see preview_plan) to a dataset, first replacing it by its
+    anomaly from the climatology store if one is given.  The anomaly is taken before
+    decimating, while the grid still lines up with the climatology's.  With a
+    scratch filename the transform runs out of core (see Dataset.transform_chunked).
+    """
+    if store is not None:
+        with Trace.stage('anomaly', zscore=zscore):
+            dataset.anomaly(store, zscore=zscore)
+    with Trace.stage('decimate', step=plan['decimate']):
+        dataset.decimate(plan['decimate'])
+    if scratch is not None:
+        with Trace.stage('transform_chunked', zoom=plan['zoom'],
+                         interpolate=plan['interpolate']) as s:
+            dataset = dataset.transform_chunked(scratch, zoom=plan['zoom'],
+                                                interpolate=plan['interpolate'])
+            s.count(frames=dataset.length)
+        return dataset
+
+    with Trace.stage('fix_nans'):
+        dataset.fix_nans()
+    with Trace.stage('zoom', multiplier=plan['zoom']):
+        dataset.zoom(plan['zoom'])
+    with Trace.stage('interpolate', multiplier=plan['interpolate']) as s:
+        dataset.interpolate(plan['interpolate'])
+        s.count(frames=dataset.length)
+    return dataset
+
+
+def render(p, query, raster=False):
+    """
+    Fetch and transform the dataset for an order and draw its outline and data
+    images.  Returns the orientation of the data image (None if outline only).
+    If raster, the data are saved as a scalar raster for Palette to recolor instead.
+    """
+    import Draw
+
+    output_path, output_filename = output_names(p)
+
+    dataset = first_measure(load_ds(query))
+    if is_preview(p):
+        plan = preview_plan(p, dataset)
+    else:
+        plan = {'decimate': 1, 'zoom': p['zoom'], 'interpolate': p['interpolate'],
+                'dpi': p['dpi'], 'max_size': None}
+    scratch = None
+    if transformed_bytes(dataset, plan) > CHUNKED_BYTES:
+        if not os.path.exists(SCRATCH_DIR):
+            os.makedirs(SCRATCH_DIR)
+        scratch = os.path.join(SCRATCH_DIR, output_filename + '.npy')
+    store = Climatology.get_store(query) if p.get('anomaly') else None
+    a = None
+    try:
+        dataset = transform(dataset, plan, store, p.get('anomaly') == 'zscore', scratch)
+
+        a = Draw.get_renderer().animator(dataset, clear_frames=False, repeat=False,
+                                         contour_levels=20, cmap=p['cmap'])
+        with Trace.stage('draw_region', state=p['state']):
+            a.draw_region(stroke_width=p['stroke_width'], state=p['state'])
+
+        if 'mask.png' not in os.listdir(output_path):
+            with Trace.stage('save_plt', output='outline', dpi=600):
+                a.save_plt(outline_file(p), width=p['width'], height=p['height'], dpi=600)
+
+        dims = None
+        if p['flag'] != 'outline_only':
+            with Trace.stage('stack') as s:
+                a.stack('contour', stroke_width=p['stroke_width'])
+                s.count(frames=dataset.length)
+            if p.get('vector') and not raster:
+                # The lines keep their colormap, so a shared raster never carries them
+                with Trace.stage('save_vector', format=p['vector']) as s:
+                    stats = a.save_vector(vector_file(p), width=p['width'],
+                                          height=p['height'], dpi=plan['dpi'],
+                                          stroke_width=float(p['stroke_width']))
+                    s.count(**stats)
+            if raster:
+                with Trace.stage('save_raster', dpi=plan['dpi']):
+                    dims = a.save_raster(raster_file(p), width=p['width'],
+                                         height=p['height'], dpi=plan['dpi'],
+                                         max_size=plan['max_size'])
+            else:
+                with Trace.stage('save_plt', output='data', dpi=plan['dpi']):
+                    dims = a.save_plt(data_file(p), width=p['width'], height=p['height'],
+                                      dpi=plan['dpi'], max_size=plan['max_size'])
+    finally:
+        # Remove the scratch memmaps even if the transform or drawing failed
+        if a is not None:
+            a.close()
+        if scratch is not None:
+            a = dataset = None
+            for f in (scratch, scratch + '.in.npy'):
+                if os.path.exists(f):
+                    os.remove(f)
+    return dims
+
+
+def composite(p, dims=None):
+    """
+    Mask, pad, mat and mock up an already rendered data image.  If dims is None the
+    orientation is read from the rendered file.
+    """
+    import ShapeSVG
+
+    output_path, output_filename = output_names(p)
+    if dims is None:
+        dims = image_orientation(output_path + output_filename + '.png')
+
+    if dims == 'landscape' and p['width'] < p['height']:
+        new_w = p['height']
+        p['height'] = p['width']
+        p['width'] = new_w
+    elif dims == 'portrait' and p['height'] < p['width']:
+        new_h = p['width']
+        p['width'] = p['height']
+        p['height'] = new_h
+
+    if p['flag'] == 'order':
+        dpi = p['dpi']
+        final_size = max(p['width'] * p['dpi'], p['height'] * p['dpi'])
+    else:
+        # Proofs are built at their own size rather than shrunk from a print canvas
+        dpi = preview_dpi(p)
+        final_size = PREVIEW_SIZE
+
+    with Trace.stage('build_canvas', final_size=final_size, dpi=dpi):
+        ShapeSVG.build_canvas(width=p['width'], height=p['height'],
+                              dpi=dpi, mask_file='mask.png',
+                              source_file=output_filename + '.png',
+                              file_dir=output_path,
+                              out_file=output_filename + '_final.png',
+                              mat_width=p['mat_width'],
+                              pad_width=p['pad_width'], bleed=p['bleed'],
+                              colorspace=p['colorspace'],
+                              mat_color=p['mat_color'], pad_color=p['pad_color'],
+                              final_size=final_size)
+
+
+def composite_outputs(p):
+    """
+    The files build_canvas writes for an order.
+    """
+    output_path, output_filename = output_names(p)
+    out_file = output_filename + '_final.png'
+    return [output_path + prefix + out_file + '.png'
+            for prefix in ('1_mockup_', '2_mat_', '3_nomat_', '4_detail_')]
+
+
+def order_keys(p, query_params):
+    output_path, output_filename = output_names(p)
+    return Artifacts.stage_keys(p, QueryParameters.generate_query_name(query_params),
+                                preview=is_preview(p), mask=output_path + 'mask.png')
+
+
+def store_outline(p, keys):
+    """
+    Cache the region outline a render drew (only drawn while there is no mask yet).
+    """
+    if os.path.exists(outline_file(p)) and not Artifacts.get_cache().has(keys['outline']):
+        Artifacts.get_cache().put(keys['outline'], [outline_file(p)])
+
+
+def restore_outline(p, keys):
+    """
+    Give an order whose data image came from the cache the outline its mask is cut
+    from, as render would have drawn it.
+    """
+    output_path = output_names(p)[0]
+    cache = Artifacts.get_cache()
+    if not os.path.exists(output_path + 'mask.png') and \
+            not os.path.exists(outline_file(p)) and cache.has(keys['outline']):
+        cache.restore(keys['outline'], [outline_file(p)])
+
+
+def render_stage(p, query_params):
+    """
+    The data image of an order, restored from the artifact cache when the dataset,
+    transform and render settings are unchanged and rendered (then stored) otherwise.
+    Returns its orientation.
+    """
+    cache = Artifacts.get_cache()
+    keys = order_keys(p, query_params)
+    if cache.has(keys['render']):
+        with Trace.stage('restore', artifact='render'):
+            restore_outline(p, keys)
+            return cache.restore(keys['render'], render_files(p))['orientation']
+    if cache.has(keys['raster']) and not p.get('vector'):
+        return render_palettes([p], query_params)
+
+    dims = render(p, load_query(query_params))
+    cache.put(keys['render'], render_files(p), orientation=dims)
+    store_outline(p, keys)
+    return dims
+
+
+def render_palettes(orders, query_params, processes=None):
+    """
+    Render several orders that differ only in colormap: the data are drawn once as
+    a scalar raster (or taken from the artifact cache) and each palette is a lookup
+    table applied to it, in parallel.  Returns the orientation shared by all.  Orders
+    asking for a vector export are rendered on their own (see render_stage).
+    """
+    import Palette
+
+    cache = Artifacts.get_cache()
+    p = orders[0]
+    keys = order_keys(p, query_params)
+    if cache.has(keys['raster']):
+        dims = cache.restore(keys['raster'], [raster_file(p)])['orientation']
+    else:
+        dims = render(p, load_query(query_params), raster=True)
+        cache.put(keys['raster'], [raster_file(p)], orientation=dims)
+        store_outline(p, keys)
+    for o in orders:
+        restore_outline(o, order_keys(o, query_params))
+
+    todo = [o for o in orders if not cache.has(order_keys(o, query_params)['render'])]
+    with Trace.stage('recolor', palettes=len(todo)):
+        Palette.recolor_many(raster_file(p), [(o['cmap'], data_file(o)) for o in todo],
+                             processes)
+    for o in todo:
+        cache.put(order_keys(o, query_params)['render'], [data_file(o)], orientation=dims)
+    return dims
+
+
+def composite_stage(p, query_params, dims=None):
+    """
+    Composite an order against its cached data image, skipping the work entirely when
+    the composite settings and mask are unchanged too.
+    """
+    cache = Artifacts.get_cache()
+    keys = order_keys(p, query_params)
+    if cache.has(keys['composite']):
+        with Trace.stage('restore', artifact='composite'):
+            cache.restore(keys['composite'], composite_outputs(p))
+        return
+
+    output_path, output_filename = output_names(p)
+    if not os.path.exists(output_path + output_filename + '.png') and \
+            cache.has(keys['render']):
+        restore_outline(p, keys)
+        dims = cache.restore(keys['render'], render_files(p))['orientation']
+    composite(dict(p), dims)
+    cache.put(keys['composite'], composite_outputs(p))
+
+
+def visualize(p, query_params, prefix=''):
     """
     Generate and save visualizations based on the passed parameters.
 
@@ -111,82 +734,215 @@ def visualize(p, query, prefix=''):
         1. High-res (~8k) PNG
         2. Low-res (~720p) PNG
         2. Unmasked Data SVG
+
+    Rendering and compositing are skipped when their artifacts are already cached
+    (see render_stage and composite_stage).
     """
     if p['flag'] == 'skip':
         return
-
-    output_path = os.path.join(SAVEDIR, VIZ_SUBDIR, p['address'])
-    if not os.path.exists(output_path):
-        os.makedirs(output_path)
-
-    output_filename = '_'.join([p['state'], p['prefix'], p['measure'], p['cmap_name'],
-                                str(p['zoom']) + 'xzoom', str(p['interpolate']) + 'intrp',
-                                p['stroke_width'] + 'px', str(p['dpi']) + 'dpi',
-                                str(p['bleed']) + 'in_bleed',
-                                str(p['mat_width']) + 'in_mat'])
-
-    if (output_filename + '.png') in os.listdir(output_path):
-        print 'file ' + output_filename + '  exists, returning...'
+    if p['flag'] == 'outline_only':
+        render(p, load_query(query_params))
         return
 
-    dataset = load_ds(query)
-    dataset.fix_nans()
-    dataset.zoom(p['zoom'])
-    dataset.interpolate(p['interpolate'])
-
-    a = Animator(dataset, clear_frames=False, repeat=False,
-                 contour_levels=20, cmap=p['cmap'])
-    a.draw_region(stroke_width=p['stroke_width'], state=p['state'])
-
-    if 'mask.png' not in os.listdir(output_path):
-        a.save_plt(output_path + output_filename + '_outline.png', width=p['width'],
-                   height=p['height'], dpi=600)
-
-    if p['flag'] != 'outline_only':
-        a.stack('contour', stroke_width=p['stroke_width'])
-        dims = a.save_plt(output_path + output_filename + '.png', width=p['width'],
-                          height=p['height'], dpi=p['dpi'])
-
-        if dims == 'landscape' and p['width'] < p['height']:
-            new_w = p['height']
-            p['height'] = p['width']
-            p['width'] = new_w
-        elif dims == 'portrait' and p['height'] < p['width']:
-            new_h = p['width']
-            p['width'] = p['height']
-            p['height'] = new_h
-
-        if p['flag'] == 'order':
-            final_size = max(p['width'] * p['dpi'], p['height'] * p['dpi'])
-        else:
-            final_size = 1000
-
-        ShapeSVG.build_canvas(width=p['width'], height=p['height'],
-                              dpi=p['dpi'], mask_file='mask.png',
-                              source_file=output_filename + '.png', file_dir=output_path,
-                              out_file=output_filename + '_final.png',
-                              mat_width=p['mat_width'],
-                              pad_width=p['pad_width'], bleed=p['bleed'],
-                              colorspace=p['colorspace'],
-                              mat_color=p['mat_color'], pad_color=p['pad_color'],
-                              final_size=final_size)
+    output_path, output_filename = output_names(p)
+    composite_stage(p, query_params, render_stage(p, query_params))
 
     copyfile('D:\Dropbox\Etsy\swatches\swatch_menu_r2.png',
              output_path + '5_palette_menu.png')
 
-    a.close()
-    del a
-
 
-if __name__ == '__main__':
-    requests = load_requests('../inputs/20170131_order.csv')
+def resolve_geo_ranges(requests):
+    """
+    Fill in each query's geo_range: admin regions resolve offline from the
+    gazetteer, and everything else is geocoded with a single cache lookup up front.
+    """
+    gazetteer = Gazetteer.get_gazetteer()
+    addresses = [v['address'] for v, q in requests if q['geo_range'] == '' and
+                 (gazetteer is None or gazetteer.lookup(v['address']) is None)]
+    with Trace.stage('geocode', addresses=len(addresses)):
+        Gmaps.geocode_many(addresses)
 
     for viz_params, query_params in requests:
         if query_params['geo_range'] == '':
-            geo_box = Gmaps.get_bounding_box(address=viz_params['address'], pad=0.25)
-        else:
+            geo_box = Gazetteer.get_bounding_box(address=viz_params['address'], pad=0.25)
+        elif isinstance(query_params['geo_range'], basestring):
             geo_box = [float(bound) for bound in query_params['geo_range'].split(',')]
-
+        else:
+            geo_box = query_params['geo_range']
         query_params['geo_range'] = geo_box
+    return requests
+
+
+def prepare_requests(csv_file, server=None):
+    requests = resolve_geo_ranges(load_requests(csv_file))
+    for viz_params, query_params in requests:
+        if server is not None:
+            query_params['server'] = server
+        if is_preview(viz_params):
+            query_params['time_step'] = preview_time_step(query_params)
+    return requests
+
+
+def is_fetched(query_params):
+    return query_params.query_name in os.listdir('../outputs/pickles/')
+
+
+def union_box(boxes):
+    boxes = np.array(boxes, float)
+    return [boxes[:, 0].min(), boxes[:, 1].max(), boxes[:, 2].min(), boxes[:, 3].max()]
+
+
+def within(box, outer):
+    return (box[0] >= outer[0] and box[1] <= outer[1] and
+            box[2] >= outer[2] and box[3] <= outer[3])
+
+
+def share_fetches(requests):
+    """
+    Multi-region mode: orders that differ only in region (same measure, period,
+    resolution and server) and still need fetching are fetched once, over the union
+    of their boxes, and each is then rendered from a view of that dataset.  An order
+    joins a union only while it stays inside USA_BOX and the planner estimates fewer
+    bytes for it than for fetching its members separately, so far-apart regions are
+    still fetched on their own.  Returns the number of union fetches set up.
+    """
+    groups = OrderedDict()
+    for viz_params, query_params in requests:
+        if viz_params['flag'] == 'skip':
+            continue
+        key = tuple(sorted((k, tuple(v) if isinstance(v, list) else v)
+                           for k, v in query_params.items()
+                           if k not in ('geo_range', 'state')))
+        groups.setdefault(key, []).append(query_params)
+
+    shared = 0
+    for group in groups.values():
+        todo = OrderedDict()
+        for q in group:
+            qp = load_query(q)
+            if not is_fetched(qp):
+                todo.setdefault(qp.query_name, qp)
+        if len(todo) < 2:
+            continue
+
+        # Greedily add each order to the first union it makes cheaper to fetch
+        clusters = []
+        for qp in todo.values():
+            alone = Planner.QueryPlan(qp).bytes
+            for c in clusters:
+                box = union_box([m.geo_range for m in c['members']] + [qp.geo_range])
+                if not within(box, USA_BOX):
+                    continue
+                union = QueryParameters(**dict(group[0], state='shared', geo_range=box))
+                together = Planner.QueryPlan(union).bytes
+                if together < c['separate'] + alone:
+                    c['members'].append(qp)
+                    c['separate'] += alone
+                    c['box'] = box
+                    break
+            else:
+                clusters.append({'members': [qp], 'separate': alone, 'box': qp.geo_range})
+
+        for c in clusters:
+            if len(c['members']) < 2:
+                continue
+            union_qp = load_query(dict(group[0], state='shared', geo_range=c['box']))
+            for qp in c['members']:
+                _shared_queries[qp.query_name] = union_qp
+            shared += 1
+    return shared
+
+
+def plan_orders(csv_file, server=None, max_bytes=Planner.DEFAULT_MAX_BYTES):
+    """
+    Dry run: the QueryPlan of every order whose dataset is not downloaded yet.
+    """
+    plans = []
+    for viz_params, query_params in prepare_requests(csv_file, server):
+        if viz_params['flag'] == 'skip':
+            continue
         qp = load_query(query_params)
-        visualize(p=viz_params, query=qp)
+        if not is_fetched(qp):
+            plans.append(Planner.QueryPlan(qp, max_bytes=max_bytes))
+    return plans
+
+
+def within_budget(query_params, budget):
+    qp = load_query(query_params)
+    qp = _shared_queries.get(qp.query_name, qp)
+    if is_fetched(qp):
+        return True
+    plan = Planner.QueryPlan(qp)
+    if plan.bytes <= budget:
+        return True
+    print 'refusing order over budget (%.1f MB): %s' % (budget / 2. ** 20, plan.report())
+    return False
+
+
+def batch(csv_file, server=None, stages=('render', 'composite'), budget=None,
+          shared=False):
+    """
+    Run every order in csv_file through the given stages: 'fetch' only downloads
+    (or unpickles) the datasets, 'render' draws the data images, and 'composite'
+    rebuilds the matted outputs from existing renders.  Orders whose download is
+    estimated at more than budget bytes are refused up front.  If shared, orders
+    for the same data over different regions share one fetch (see share_fetches).
+    """
+    import Access
+    requests = prepare_requests(csv_file, server)
+
+    try:
+        if shared and ('render' in stages or 'fetch' in stages):
+            share_fetches(requests)
+        if budget is not None and ('render' in stages or 'fetch' in stages):
+            requests = [(v, q) for v, q in requests
+                        if v['flag'] == 'skip' or within_budget(q, budget)]
+
+        if 'render' in stages:
+            # Orders differing only in colormap are drawn once and recolored
+            variants = OrderedDict()
+            for viz_params, query_params in requests:
+                if viz_params['flag'] not in ('skip', 'outline_only') and \
+                        not viz_params.get('vector'):
+                    key = order_keys(viz_params, query_params)['raster']
+                    variants.setdefault(key, []).append((viz_params, query_params))
+            for group in variants.values():
+                if len(group) > 1:
+                    render_palettes([v for v, q in group], group[0][1])
+
+        for viz_params, query_params in requests:
+            if viz_params['flag'] == 'skip':
+                continue
+            with Trace.stage('order', address=viz_params['address'],
+                             flag=viz_params['flag']):
+                if 'render' in stages and 'composite' in stages:
+                    visualize(p=viz_params, query_params=query_params)
+                elif 'render' in stages:
+                    if viz_params['flag'] == 'outline_only':
+                        render(viz_params, load_query(query_params))
+                    else:
+                        render_stage(viz_params, query_params)
+                elif 'composite' in stages:
+                    if viz_params['flag'] != 'outline_only':
+                        composite_stage(viz_params, query_params)
+                elif 'fetch' in stages:
+                    load_ds(load_query(query_params))
+    finally:
+        _shared_queries.clear()
+        _shared_datasets.clear()
+        Access.close_access()
+
+
+if __name__ == '__main__':
+    # Set WEATHERER_TRACE to a filename to record per-stage timings for this run;
+    # a name ending in .trace.json is written as Chrome trace events.
+    trace_file = os.environ.get('WEATHERER_TRACE')
+    if trace_file:
+        Trace.enable()
+
+    batch('../inputs/20170131_order.csv')
+
+    if trace_file:
+        tracer = Trace.disable()
+        tracer.save(trace_file)
+        print tracer.report()
@@ -0,0 +1,50 @@
+from __future__ import division
+
+import multiprocessing
+import os
+import time
+
+DEFAULT_PROCESSES = multiprocessing.cpu_count()
+
+
+def is_stale(out_file, *inputs):
+    """
+    Whether out_file is missing or older than any of the files it is made from.
+    """
+    if not os.path.exists(out_file):
+        return True
+    built = os.path.getmtime(out_file)
+    return any(os.path.getmtime(f) > built for f in inputs)
+
+
+def run(fun, jobs, processes=None, initializer=None, initargs=(),
+        skip=None, label='jobs'):
+    """
+    Map fun over jobs in a process pool, one process per core by default.  Each
+    worker runs initializer(*initargs) once, e.g. to load an asset every job
+    composites with, and jobs for which skip(job) is true (outputs already up to
+    date) are left out.  Returns the results and throughput statistics, which are
+    also printed.
+    """
+    todo = [j for j in jobs if skip is None or not skip(j)]
+    processes = max(1, min(processes or DEFAULT_PROCESSES, len(todo)))
+    start = time.time()
+    if processes == 1:
+        if initializer is not None and todo:
+            initializer(*initargs)
+        results = map(fun, todo)
+    else:
+        pool = multiprocessing.Pool(processes, initializer, initargs)
+        try:
+            results = pool.map(fun, todo, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    seconds = time.time() - start
+    stats = {'jobs': len(todo), 'skipped': len(jobs) - len(todo), 'seconds': seconds,
+             'per_second': len(todo) / seconds if seconds > 0 else 0.,
+             'processes': processes}
+    print '%s: %d done, %d up to date, %.1f s (%.1f/s on %d processes)' % (
+        label, stats['jobs'], stats['skipped'], seconds, stats['per_second'], processes)
+    return results, stats